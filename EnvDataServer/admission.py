@@ -0,0 +1,180 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from contextlib import contextmanager
+import itertools
+import logging
+import math
+import threading
+import time
+
+from EnvironmentalData import fetch_planner
+
+logger = logging.getLogger(__name__)
+
+# bytes per value of the generated files, csv values are written as text with their coordinates
+OUTPUT_BYTES_PER_VALUE = {'csv': 12, 'netcdf': fetch_planner.BYTES_PER_VALUE, 'zarr': fetch_planner.BYTES_PER_VALUE}
+# bounds of the `Retry-After` seconds estimated from the queue
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 600
+# weight of the last request in the moving average of the processing seconds per cost
+DURATION_SMOOTHING = 0.2
+
+
+def get_output_bytes(n_values: int, data_format: str) -> int:
+    return n_values * OUTPUT_BYTES_PER_VALUE.get(data_format.lower(), fetch_planner.BYTES_PER_VALUE)
+
+
+def get_cost(products: dict, output_bytes: int = 0) -> int:
+    """
+        Cost of a request in bytes: the transferred subsets of the `products` estimated by `fetch_planner.estimate`,
+        the fixed overhead of their requests and the generated output.
+    """
+    return sum(product['transfer_bytes'] + product['remote_requests'] * fetch_planner.REQUEST_OVERHEAD_BYTES
+               for product in products.values()) + output_bytes
+
+
+class AdmissionRejected(Exception):
+    """
+        Rejected request with the HTTP status of the response: 400 if it is too costly, 429 if too many requests are
+        waiting and 503 if its turn did not come in time. Busy rejections suggest a `retry_after` in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: int = None, status_code: int = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code if status_code is not None else 400 if retry_after is None else 503
+
+
+class AdmissionController:
+    """
+        Admission control by estimated cost. Requests costing more than `max_cost` are rejected right away, the others
+        are processed as long as the costs in flight stay below `capacity`. Waiting requests are served by start-time
+        fair queueing over the clients: each request is tagged with the cost its client was granted before, so cheap
+        requests of other clients are not starved by a client sending expensive ones. As waiting requests block a
+        worker thread, at most `max_waiting` requests wait, further ones are rejected right away, and a request gives
+        up after `timeout` seconds.
+    """
+
+    def __init__(self, capacity: int, max_cost: int, timeout: float, max_waiting: int = None):
+        self.capacity = capacity
+        self.max_cost = max_cost
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        # moving average of the processing seconds per cost of the released requests
+        self.seconds_per_cost = None
+        self.in_flight = 0
+        # virtual time, the start tag of the request admitted last
+        self.virtual_time = 0
+        # finish tag of the last request of each client
+        self.finish = dict()
+        # waiting requests as [start tag, sequence number, cost]
+        self.waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _can_start(self, entry: list) -> bool:
+        # a request costlier than the capacity runs alone
+        return entry == min(self.waiting) and (self.in_flight + entry[2] <= self.capacity or self.in_flight == 0)
+
+    def get_retry_after(self, cost: int) -> int:
+        """
+            Seconds until the costs in flight and waiting ahead have drained enough to admit `cost`, estimated from the
+            processing time of the previous requests. Expects the lock to be held.
+        """
+        if self.seconds_per_cost is None:
+            return max(int(self.timeout), RETRY_AFTER_MIN)
+        backlog = self.in_flight + sum(entry[2] for entry in self.waiting) + cost - self.capacity
+        return min(max(math.ceil(max(backlog, 0) * self.seconds_per_cost), RETRY_AFTER_MIN), RETRY_AFTER_MAX)
+
+    def acquire(self, client: str, cost: int) -> float:
+        """
+            Block until the request of `client` is admitted, raise `AdmissionRejected` if it is too costly, too many
+            requests are waiting already or its turn does not come within the timeout.
+
+            :returns: admission time to be passed to `release`
+        """
+        if cost > self.max_cost:
+            raise AdmissionRejected('Estimated cost of %.1f MB exceeds the maximum of %.1f MB per request' % (
+                cost / 2 ** 20, self.max_cost / 2 ** 20))
+        with self._condition:
+            can_start = len(self.waiting) == 0 and (self.in_flight + cost <= self.capacity or self.in_flight == 0)
+            if not can_start and self.max_waiting is not None and len(self.waiting) >= self.max_waiting:
+                logger.info('Rejecting a request of %s, %d request(s) waiting' % (client, len(self.waiting)))
+                raise AdmissionRejected('Too many requests are waiting, please try again later',
+                                        retry_after=self.get_retry_after(cost), status_code=429)
+            start = max(self.virtual_time, self.finish.get(client, 0))
+            self.finish[client] = start + cost
+            entry = [start, next(self._sequence), cost]
+            self.waiting.append(entry)
+            deadline = time.monotonic() + self.timeout
+            try:
+                while not self._can_start(entry):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if self.finish.get(client) == start + cost:
+                            # a rejected request does not count against its client
+                            self.finish[client] = start
+                        logger.info('Rejecting a request of %s after waiting %d s, %d request(s) waiting' % (
+                            client, self.timeout, len(self.waiting)))
+                        # the cost of the request is still part of the waiting costs
+                        raise AdmissionRejected('The service is busy, please try again later',
+                                                retry_after=self.get_retry_after(0))
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting.remove(entry)
+                self._condition.notify_all()
+            self.in_flight += cost
+            self.virtual_time = start
+            # clients without pending requests do not keep their tags
+            for idle in [c for c, finish in self.finish.items() if finish <= self.virtual_time]:
+                del self.finish[idle]
+            return time.monotonic()
+
+    def release(self, cost: int, admitted: float = None) -> None:
+        """
+            Release the `cost` of a finished request, admitted at the time returned by `acquire`.
+        """
+        with self._condition:
+            self.in_flight -= cost
+            if admitted is not None and cost > 0:
+                seconds_per_cost = (time.monotonic() - admitted) / cost
+                self.seconds_per_cost = seconds_per_cost if self.seconds_per_cost is None else \
+                    (1 - DURATION_SMOOTHING) * self.seconds_per_cost + DURATION_SMOOTHING * seconds_per_cost
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, client: str, cost: int):
+        admitted = self.acquire(client, cost)
+        try:
+            yield
+        finally:
+            self.release(cost, admitted)
+
+    def status(self) -> dict:
+        with self._condition:
+            return dict(in_flight=self.in_flight, waiting=len(self.waiting), capacity=self.capacity,
+                        max_waiting=self.max_waiting)
@@ -24,8 +24,10 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
 # Public License for more details.
 #
+import itertools
 import json
 import logging
+import mimetypes
 import os
 import threading
 import time
@@ -33,18 +35,26 @@ import traceback
 import uuid
 from datetime import timedelta, datetime
 from pathlib import Path
+from urllib.parse import quote
 
 import numpy as np
 import pytz
 import xarray as xr
-from flask import Flask, render_template, request, send_from_directory, jsonify
+from flask import Flask, Response, render_template, request, send_from_directory, jsonify, make_response, \
+    stream_with_context, g, abort
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from paste.translogger import TransLogger
 from waitress import serve
 
-from EnvironmentalData.weather import *
-from utilities.helper_functions import str_to_date_min, create_csv, FileFailedException
+from EnvDataServer.admission import AdmissionController, AdmissionRejected, get_cost, get_output_bytes
+from EnvDataServer.output_encoding import write_netcdf, write_zarr_zip
+from EnvironmentalData import config as secrets, fetch_planner, merged_store
+from EnvDataServer.request_cache import RequestCache, normalize_request
+from EnvironmentalData.weather import WAVE_VAR_LIST, WIND_VAR_LIST, GFS_25_VAR_LIST, DAILY_PHY_VAR_LIST, \
+    get_global_wave, get_global_wind, get_global_phy_daily, get_GFS, check_extent, iter_merged_chunks, scan_envelope, regrid_nearest, SAMPLING_MODES
+from utilities import profiling
+from utilities.helper_functions import str_to_date_min, create_csv, csv_with_metadata, TeeReader
 
 logger = logging.getLogger('EnvDataServer.app')
 
@@ -55,6 +65,8 @@ limiter = Limiter(
     default_limits=["70 per hour"]
 )
 app.config.from_object('EnvDataServer.config')
+# fail at start-up instead of on the first request if the service credentials are missing
+secrets.load()
 
 # global variables
 # TODO move to a config file
@@ -68,12 +80,25 @@ spatial_interpolation_rate = 0.083
 temporal_interpolation_rate = 3
 # max bounding box
 max_lat, max_lon, max_days = 20, 20, 10
+# in Minutes, how long a generated file is reused for identical requests. Must be less than FILE_LIFE_SPAN to hand
+# out links that are still valid for a reasonable time.
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", FILE_LIFE_SPAN // 2))
+if RESULT_CACHE_TTL >= FILE_LIFE_SPAN:
+    raise ValueError('RESULT_CACHE_TTL of %d minutes must be less than FILE_LIFE_SPAN of %d minutes' % (
+        RESULT_CACHE_TTL, FILE_LIFE_SPAN))
+# an expired file is not handed out again even if the cleaner thread has not deleted it yet
+result_cache = RequestCache(timedelta(minutes=RESULT_CACHE_TTL),
+                            is_cacheable=lambda result: 'file_path' in result and len(result['error_msg']) == 0,
+                            is_valid=lambda result: not is_expired(Path(result['file_path'])))
+admission = AdmissionController(app.config['ADMISSION_CAPACITY'], app.config['ADMISSION_MAX_COST'],
+                                app.config['ADMISSION_TIMEOUT'], app.config['ADMISSION_MAX_WAITING'])
 
 def remove_files():
     while True:
         _deep_copy = delete_file_queue.copy()
         for f_path, created_time in _deep_copy.items():
             if (datetime.now() - created_time).seconds > FILE_LIFE_SPAN * 60:
+                result_cache.evict(f_path)
                 Path(f_path).unlink(missing_ok=True)
                 del delete_file_queue[f_path]
                 logger.debug('Deleting expired file %s ' % f_path)
@@ -85,6 +110,36 @@ dir_cleaner_thread.daemon = True
 dir_cleaner_thread.start()
 
 
+def start_profiling():
+    if request.headers.get('X-Profile') or request.args.get('profile'):
+        g.profiler = profiling.start()
+
+
+def save_profile() -> list:
+    # the profile of a streamed response ends when the response is returned, before the stream is consumed
+    stem = Path(app.config['PROFILE_DIR'], '%s_%s' % (request.endpoint, uuid.uuid1()))
+    return profiling.save(profiling.stop(g.pop('profiler')), stem)
+
+
+def stop_profiling(response):
+    if 'profiler' in g:
+        response.headers['X-Profile'] = ', '.join(path.name for path in save_profile())
+    return response
+
+
+def finish_profiling(exception=None):
+    # requests failing with an exception skip `stop_profiling`
+    if 'profiler' in g:
+        save_profile()
+
+
+# the hooks are only registered if enabled, so requests are not slowed down otherwise
+if app.config['PROFILING_ENABLED']:
+    app.before_request(start_profiling)
+    app.after_request(stop_profiling)
+    app.teardown_request(finish_profiling)
+
+
 def parse_requested_var(args):
     logger.debug(type(args))
 
@@ -125,6 +180,154 @@ def parse_requested_var(args):
     return wave, wind, gfs, phy, unknown_values
 
 
+def parse_env_data_args(args) -> tuple:
+    """
+        Parse and validate the query parameters of `/request_env_data` and `/estimate`. The bbox and time range are
+        extended by the interpolation rates.
+
+        :returns: `(parameters, None)` or `(None, error)` for invalid parameters
+    """
+    error = []
+    # check for mandatory parameter
+    for key in ['date_lo', 'date_hi', 'lat_lo', 'lat_hi', 'lon_lo', 'lon_hi']:
+        if key not in args:
+            error.append(key)
+    if len(error) > 0:
+        error = 'Missing mandatory parameter{}: {}'.format('s' if len(error) > 1 else '', error)
+        logger.debug(error)
+        return None, error
+
+    unknown_parameter = []
+    for key in args.keys():
+        if key not in ["date_lo", "date_hi" ,"lat_lo", "lat_hi", "lon_lo", "lon_hi", "format", "GFS", "Physical", "Wave", "Wind",
+                       "profile", "sampling"]:
+            unknown_parameter.append(key)
+    if len(unknown_parameter) > 0:
+        error = 'Received unknown parameter{}: {}'.format('s' if len(unknown_parameter) > 1 else '', unknown_parameter)
+        logger.debug(error)
+        return None, error
+
+    try:
+        date_lo = str_to_date_min(args.get('date_lo')) - timedelta(hours=temporal_interpolation_rate)
+        date_hi = str_to_date_min(args.get('date_hi')) + timedelta(hours=temporal_interpolation_rate)
+        lat_lo = float(args.get('lat_lo')) - spatial_interpolation_rate
+        lat_hi = float(args.get('lat_hi')) + spatial_interpolation_rate
+        lon_lo = float(args.get('lon_lo')) - spatial_interpolation_rate
+        lon_hi = float(args.get('lon_hi')) + spatial_interpolation_rate
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        error = 'Error occurred: not all submitted parameters could not be parsed as date: {}, {}, or float: {}, {}, {}, {}. {}'.format(
+            args.get('date_lo'),
+            args.get('date_hi'),
+            args.get('lat_lo'),
+            args.get('lat_hi'),
+            args.get('lon_lo'),
+            args.get('lon_hi'),
+            str(e)
+        )
+        logger.debug(error)
+        return None, error
+
+    #
+    #   rounding coordinates to reasonable accuracy
+    #
+    #   see https://gis.stackexchange.com/a/208739
+    #
+    lat_lo = round(lat_lo, 4)
+    lat_hi = round(lat_hi, 4)
+    lon_hi = round(lon_hi, 4)
+    lon_lo = round(lon_lo, 4)
+    logger.debug("Rounded coordinates to 4 decimal places: Lat: [{}, {}]; Lon: [{}, {}]".format(
+        lat_lo, lat_hi, lon_lo, lon_hi
+    ))
+    data_format = args.get('format')
+    error = []
+    if data_format is None or len(data_format) == 0 or data_format.lower() not in ["csv", "netcdf", "zarr"]:
+        error.append('format parameter wrong/missing. Allowed values: csv, netcdf, zarr')
+    sampling = args.get('sampling', 'linear')
+    if sampling not in SAMPLING_MODES:
+        error.append('sampling parameter wrong. Allowed values: %s' % ', '.join(SAMPLING_MODES))
+    if lat_lo > lat_hi:
+        error.append('lat_lo > lat_hi')
+    if lon_lo > lon_hi:
+        error.append('lon_lo > lon_hi')
+    if date_lo > date_hi:
+        error.append('date_lo > date_hi')
+    # the submitted values without the interpolation rates
+    if not -90 <= float(args.get('lat_lo')) <= 90 or not -90 <= float(args.get('lat_hi')) <= 90:
+        error.append('latitude out of range [-90, 90]')
+    if not -180 <= float(args.get('lon_lo')) <= 180 or not -180 <= float(args.get('lon_hi')) <= 180:
+        error.append('longitude out of range [-180, 180]')
+
+    wave, wind, gfs, phy, unknown_values = parse_requested_var(args)
+
+    logger.debug("Requested variables: wind: {}; wave: {}; gfs: {}; physical: {}; unknown: {}".format(
+        wind, wave, gfs, phy, unknown_values
+    ))
+
+    if len(unknown_values) > 0:
+        error = 'Error: unknown variables submitted: {}'.format(unknown_values)
+        logger.error(error)
+        return None, error
+
+    if len(wave + wind + gfs + phy) == 0:
+        error.append('No variables are selected')
+
+    if len(error) > 0:
+        logger.debug('Error{}: {}'.format('s' if len(error) > 1 else '', error))
+        return None, error
+
+    if int(lat_hi - lat_lo) > max_lat or int(lon_hi - lon_lo) > max_lon or (date_hi - date_lo).days > max_days:
+        error = ('Error occurred: requested bbox ({0}° lat x {1}° lon x {2} days) is too large. Maximal bbox ' +
+                 'dimension ({3}° lat x {4}° lon x {5} days).').format(
+                    int(lat_hi - lat_lo),
+                    int(lon_hi - lon_lo),
+                    (date_hi - date_lo).days,
+                    max_lat,
+                    max_lon,
+                    max_days)
+        logger.debug(error)
+        return None, error
+
+    return dict(date_lo=date_lo, date_hi=date_hi, lat_lo=lat_lo, lat_hi=lat_hi, lon_lo=lon_lo, lon_hi=lon_hi,
+                wave=wave, wind=wind, gfs=gfs, phy=phy, data_format=data_format.lower(), sampling=sampling), None
+
+
+def estimate_env_data(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, wave, wind, gfs, phy, data_format) -> dict:
+    """
+        Estimate of a `/request_env_data` query for the bbox and time range extended by the interpolation rates.
+    """
+    products = fetch_planner.estimate(dict(date_lo=date_lo, date_hi=date_hi, lat_lo=lat_lo, lat_hi=lat_hi,
+                                           lon_lo=lon_lo, lon_hi=lon_hi), dict(gfs=gfs, phy=phy, wind=wind, wave=wave))
+    # points of the output grid, see compute_env_data
+    n_points = len(np.arange(lat_lo, lat_hi, spatial_interpolation_rate)) * \
+        len(np.arange(lon_lo, lon_hi, spatial_interpolation_rate)) * \
+        len(range(0, int((date_hi - date_lo).total_seconds()) // 3600, temporal_interpolation_rate))
+    output_bytes = get_output_bytes(n_points * len(wave + wind + gfs + phy), data_format)
+    return dict(products=products, output_bytes=output_bytes, cost=get_cost(products, output_bytes),
+                max_cost=admission.max_cost)
+
+
+def rejected_response(e: AdmissionRejected):
+    """
+        400 for requests exceeding the maximal cost, 429 or 503 with `Retry-After` if the service is busy.
+    """
+    if request.accept_mimetypes['text/html']:
+        response = make_response(render_template('error.html', error=str(e)), e.status_code)
+    else:
+        response = jsonify(error=str(e))
+        response.status_code = e.status_code
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def get_output_settings() -> dict:
+    return dict(compression=app.config['OUTPUT_COMPRESSION'], complevel=app.config['OUTPUT_COMPLEVEL'],
+                dtype=app.config['OUTPUT_DTYPE'], packed_variables=app.config['OUTPUT_PACKED_VARIABLES'],
+                spatial_chunk=app.config['OUTPUT_SPATIAL_CHUNK'])
+
+
 @app.route('/merge_data', methods=['POST'])
 @limiter.limit("1/10second")
 def merge_data():
@@ -132,12 +335,15 @@ def merge_data():
     logger.debug(request)
     error_msg = ''
 
+    # a raw csv body is parsed while it is read, the parameters are passed as query parameters then
+    streamed_upload = request.mimetype == 'text/csv'
+    form = request.args if streamed_upload else request.form
     error = []
-    if 'col' not in request.form.keys():
+    if 'col' not in form.keys():
         error.append('col')
-    if 'var' not in request.form.keys():
+    if 'var' not in form.keys():
         error.append('var')
-    if len(request.files) == 0 or 'file' not in request.files.keys():
+    if not streamed_upload and (len(request.files) == 0 or 'file' not in request.files.keys()):
         error.append('file')
 
     if len(error) > 0:
@@ -151,7 +357,7 @@ def merge_data():
             response.status_code = 400
             return response
 
-    col_dict = json.loads(request.form['col'])
+    col_dict = json.loads(form['col'])
     unknown_cols = []
     for key in col_dict.keys():
         if key not in ['time', 'lat', 'lon']:
@@ -168,7 +374,19 @@ def merge_data():
             response.status_code = 400
             return response
 
-    selected_variables = json.loads(request.form['var'])
+    sampling = form.get('sampling', 'linear')
+    if sampling not in SAMPLING_MODES:
+        error = 'Received unknown sampling: {}. Allowed values: {}'.format(sampling, ', '.join(SAMPLING_MODES))
+        logger.debug(error)
+        if request.accept_mimetypes['text/html']:
+            response = render_template('error.html', error=error)
+            return response, 400
+        else:
+            response = jsonify(error=error)
+            response.status_code = 400
+            return response
+
+    selected_variables = json.loads(form['var'])
     unknown_variables = []
     for key in selected_variables.keys():
         # TODO make list of supported variables configurable to be able to disable them
@@ -208,7 +426,6 @@ def merge_data():
             response = jsonify(error=error)
             response.status_code = 400
             return response
-    file = request.files['file']
     dir_path_up = Path(Path(__file__).parent, 'upload')
     dir_path_up.mkdir(exist_ok=True)
     dir_path_down = Path(Path(__file__).parent, 'download')
@@ -216,26 +433,104 @@ def merge_data():
     filename = str(uuid.uuid1()) + '.csv'
     file_path_up = Path(dir_path_up, filename)
     file_path_down = Path(dir_path_down, filename)
-    file.save(file_path_up)
+    metadata_dict = dict(
+        credit_CMEMS='Credit (Wave-Wind-Physical): E.U. Copernicus Marine Service Information (CMEMS)',
+        credit_GFS='Credit (GFS): National Centers for Environmental Prediction/National Weather Service/NOAA',
+        created='Accessed on %s' % datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        errors='Error(s): ' + error_msg.replace(',', ' ').replace('\n', ' ')
+    )
     try:
-        metadata_dict = dict(
-            credit_CMEMS='Credit (Wave-Wind-Physical): E.U. Copernicus Marine Service Information (CMEMS)',
-            credit_GFS='Credit (GFS): National Centers for Environmental Prediction/National Weather Service/NOAA',
-            created='Accessed on %s' % datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            errors='Error(s): ' + error_msg.replace(',', ' ').replace('\n', ' ')
-        )
-        append_to_csv(file_path_up, file_path_down, wave=wave, wind=wind, gfs=gfs, phy=phy, col_dict=col_dict,
-                      metadata=metadata_dict, webapp=True)
-    except FileFailedException as e:
+        if streamed_upload:
+            # first pass: determine the space-time envelope while spooling the upload to disk
+            with open(file_path_up, 'wb') as upload:
+                upload_reader = TeeReader(request.stream, upload)
+                envelope = scan_envelope(upload_reader, col_dict)
+                upload_reader.read()
+        else:
+            request.files['file'].save(file_path_up)
+            envelope = scan_envelope(file_path_up, col_dict)
+        if envelope is None:
+            raise ValueError('No rows found')
+        check_extent(**envelope)
+        cost = get_cost(fetch_planner.estimate(envelope, dict(gfs=gfs, phy=phy, wind=wind, wave=wave)))
+        admitted = admission.acquire(get_remote_address(), cost)
+    except AdmissionRejected as e:
+        file_path_up.unlink(missing_ok=True)
+        return rejected_response(e)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        file_path_up.unlink(missing_ok=True)
+        error_msg = 'CSV file is not valid: Error occurred while appending env data: \"' + str(e) + '\"'
+        if request.accept_mimetypes['text/html']:
+            return render_template('error.html', error=error_msg), 400
+        else:
+            response = jsonify(error=error_msg)
+            response.status_code = 400
+            return response
+
+    # the subsets are retrieved per time window of a chunk and released before the next window, so the memory does
+    # not grow with the extent of the track
+    merged_chunks = iter_merged_chunks(file_path_up, col_dict, gfs=gfs, wind=wind, wave=wave, phy=phy,
+                                       sampling=sampling)
+    if request.accept_mimetypes.best_match(['text/html', 'application/json', 'text/csv']) == 'text/csv':
+        try:
+            # errors of the first chunk are still reported with a status code
+            first_chunk = next(merged_chunks, None)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            admission.release(cost, admitted)
+            file_path_up.unlink(missing_ok=True)
+            error_msg = 'CSV file is not valid: Error occurred while appending env data: \"' + str(e) + '\"'
+            if request.accept_mimetypes['text/html']:
+                return render_template('error.html', error=error_msg), 400
+            else:
+                response = jsonify(error=error_msg)
+                response.status_code = 400
+                return response
+
+        # second pass: stream the enriched rows back chunk by chunk
+        def generate_merged_csv():
+            try:
+                if first_chunk is not None:
+                    yield csv_with_metadata(first_chunk, metadata_dict, index=False)
+                for df_chunk in merged_chunks:
+                    yield df_chunk.to_csv(header=False, index=False)
+            except Exception:
+                # the response has already been started, hence the client only receives a truncated file
+                logger.error(traceback.format_exc())
+
+        def clean_up():
+            merged_chunks.close()
+            admission.release(cost, admitted)
+            file_path_up.unlink(missing_ok=True)
+
+        response = Response(stream_with_context(generate_merged_csv()), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+        # the server closes the response also if the client disconnects before the body is iterated, a generator
+        # that has not been started would skip its finally block
+        response.call_on_close(clean_up)
+        return response
+
+    try:
+        header = True
+        for df_chunk in merged_chunks:
+            if header:
+                create_csv(df_chunk, metadata_dict, file_path_down, index=False)
+                header = False
+            else:
+                df_chunk.to_csv(file_path_down, mode='a', header=False, index=False)
+    except Exception as e:
         logger.error(traceback.format_exc())
-        error_msg = 'CSV file is not valid: Error occurred while appending env data: \"' + str(
-            e.original_exception) + '\"'
+        file_path_down.unlink(missing_ok=True)
+        error_msg = 'CSV file is not valid: Error occurred while appending env data: \"' + str(e) + '\"'
         if request.accept_mimetypes['text/html']:
             return render_template('error.html', error=error_msg), 400
         else:
             response = jsonify(error=error_msg)
             response.status_code = 400
             return response
+    finally:
+        admission.release(cost, admitted)
     # TODO should we remove uploaded data?
     delete_file_queue[str(file_path_up)] = datetime.now() + timedelta(minutes=FILE_LIFE_SPAN)
     delete_file_queue[str(file_path_down)] = datetime.now()
@@ -266,259 +561,173 @@ def merge_data():
         return jsonify(json_response)
 
 @app.route('/request_env_data', methods=['GET'])
-@limiter.limit("1/10second")
+# served from the result cache => not counted against the limit
+@limiter.limit("1/10second", deduct_when=lambda response: response.headers.get('X-Cache') != 'HIT')
 def request_env_data():
     logger.debug("Accept header: {}".format(request.accept_mimetypes))
     logger.debug(request)
-    error = []
-    # check for mandatory parameter
-    if 'date_lo' not in request.args:
-        error.append('date_lo')
-    if 'date_hi' not in request.args:
-        error.append('date_hi')
-    if 'lat_lo' not in request.args:
-        error.append('lat_lo')
-    if 'lat_hi' not in request.args:
-        error.append('lat_hi')
-    if 'lon_lo' not in request.args:
-        error.append('lon_lo')
-    if 'lon_hi' not in request.args:
-        error.append('lon_hi')
-
-    if len(error) > 0:
-        error = 'Missing mandatory parameter{}: {}'.format('s' if len(error) > 1 else '', error)
-        logger.debug(error)
-        if request.accept_mimetypes['text/html']:
-            response = render_template('error.html', error=error)
-            return response, 400
-        else:
-            response = jsonify(error=error)
-            response.status_code = 400
-            return response
-
-    unknown_parameter = []
-    for key in request.args.keys():
-        if key not in ["date_lo", "date_hi" ,"lat_lo", "lat_hi", "lon_lo", "lon_hi", "format", "GFS", "Physical", "Wave", "Wind"]:
-            unknown_parameter.append(key)
-
-    if len(unknown_parameter) > 0:
-        error = 'Received unknown parameter{}: {}'.format('s' if len(unknown_parameter) > 1 else '', unknown_parameter)
-        logger.debug(error)
-        if request.accept_mimetypes['text/html']:
-            response = render_template('error.html', error=error)
-            return response, 400
-        else:
-            response = jsonify(error=error)
-            response.status_code = 400
-            return response
-
-    try:
-        date_lo = str_to_date_min(request.args.get('date_lo')) - timedelta(hours=temporal_interpolation_rate)
-        date_hi = str_to_date_min(request.args.get('date_hi')) + timedelta(hours=temporal_interpolation_rate)
-        lat_lo = float(request.args.get('lat_lo')) - spatial_interpolation_rate
-        lat_hi = float(request.args.get('lat_hi')) + spatial_interpolation_rate
-        lon_lo = float(request.args.get('lon_lo')) - spatial_interpolation_rate
-        lon_hi = float(request.args.get('lon_hi')) + spatial_interpolation_rate
-    except Exception as e:
-        logger.error(traceback.format_exc())
-        error = 'Error occurred: not all submitted parameters could not be parsed as date: {}, {}, or float: {}, {}, {}, {}. {}'.format(
-            request.args.get('date_lo'),
-            request.args.get('date_hi'),
-            request.args.get('lat_lo'),
-            request.args.get('lat_hi'),
-            request.args.get('lon_lo'),
-            request.args.get('lon_hi'),
-            str(e)
-        )
-        logger.debug(error)
-        if request.accept_mimetypes['text/html']:
-            return render_template('error.html', error=error), 400
-        else:
-            response = jsonify(error=error)
-            response.status_code = 400
-            return response
-
-    #
-    #   rounding coordinates to reasonable accuracy
-    #
-    #   see https://gis.stackexchange.com/a/208739
-    #
-    lat_lo = round(lat_lo, 4)
-    lat_hi = round(lat_hi, 4)
-    lon_hi = round(lon_hi, 4)
-    lon_lo = round(lon_lo, 4)
-    logger.debug("Rounded coordinates to 4 decimal places: Lat: [{}, {}]; Lon: [{}, {}]".format(
-        lat_lo, lat_hi, lon_lo, lon_hi
-    ))
-    data_format = request.args.get('format')
-    error = []
-    if data_format is None or len(data_format) == 0 or data_format.lower() not in ["csv", "netcdf"]:
-        error.append('format parameter wrong/missing. Allowed values: csv, netcdf')
-    if lat_lo > lat_hi:
-        error.append('lat_lo > lat_hi')
-    if lon_lo > lon_hi:
-        error.append('lon_lo > lon_hi')
-    if date_lo > date_hi:
-        error.append('date_lo > date_hi')
-
-    wave, wind, gfs, phy, unknown_values = parse_requested_var(request.args)
-
-    logger.debug("Requested variables: wind: {}; wave: {}; gfs: {}; physical: {}; unknown: {}".format(
-        wind, wave, gfs, phy, unknown_values
-    ))
-
-    if len(unknown_values) > 0:
-        error = 'Error: unknown variables submitted: {}'.format(unknown_values)
-        logger.error(error)
+    parameters, error = parse_env_data_args(request.args)
+    if error is not None:
         if request.accept_mimetypes['text/html']:
             return render_template('error.html', error=error), 400
         else:
             response = jsonify(error=error)
             response.status_code = 400
             return response
-
-    if len(wave + wind + gfs + phy) == 0:
-        error.append('No variables are selected')
-
-    if len(error) > 0:
-        logger.debug('Error{}: {}'.format('s' if len(error) > 1 else '', error))
-        if request.accept_mimetypes['text/html']:
-            return render_template('error.html', error=error), 400
-        else:
-            response = jsonify(error=error)
-            response.status_code = 400
-            return response
-
-    if int(lat_hi - lat_lo) > max_lat or int(lon_hi - lon_lo) > max_lon or (date_hi - date_lo).days > max_days:
-        error = 'Error occurred: requested bbox ({0}° lat x {1}° lon x {2} days) is too large. Maximal bbox ' + \
-                'dimension ({3}° lat x {4}° lon x {5} days).'.format(
-                    int(lat_hi - lat_lo),
-                    int(lon_hi - lon_lo),
-                    (date_hi - date_lo).days,
-                    max_lat,
-                    max_lon,
-                    max_days)
-        logger.debug(error)
-        if request.accept_mimetypes['text/html']:
-            return render_template('error.html', error=error), 400
-        else:
-            response = jsonify(error=error)
-            response.status_code = 400
-            return response
-
-    error_msg = ''
-
-    lat_interpolation = list(np.arange(lat_lo, lat_hi, spatial_interpolation_rate))
-    lon_interpolation = list(np.arange(lon_lo, lon_hi, spatial_interpolation_rate))
-    temporal_interpolation = [date_lo + timedelta(hours=hours) for hours in
-                              range(0, (date_hi - date_lo).days * 24 + (date_hi - date_lo).seconds // 3600,
-                                    temporal_interpolation_rate)]
-
-    def rescale_dataset(dataset: xr.Dataset) -> xr.Dataset:
-        return dataset.interp(
-            latitude=xr.DataArray(lat_interpolation, coords=[lat_interpolation], dims=["latitude"]),
-            longitude=xr.DataArray(lon_interpolation, coords=[lon_interpolation], dims=["longitude"]),
-            time=xr.DataArray(temporal_interpolation, coords=[temporal_interpolation], dims=["time"]))
-
-    dataset_list = []
-
-    if len(wave) > 0:
-        try:
-            with get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi)[0] as wave_ds:
-                dataset_list.append(rescale_dataset(wave_ds))
-                wave = [var for var in wave if var in list(wave_ds.keys())]
-        except Exception as e:
-            logger.error(traceback.format_exc())
-            wave = []
-            error_msg += 'Error occurred while retrieving Wave data: ' + str(e) + '\n'
-
-    if len(wind) > 0:
-        try:
-            with get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi)[0].rename(
-                    {'lat': 'latitude', 'lon': 'longitude'}) as dataset_wind:
-                dataset_list.append(rescale_dataset(dataset_wind))
-                wind = [var for var in wind if var in list(dataset_wind.keys())]
-        except Exception as e:
-            logger.error(traceback.format_exc())
-            wind = []
-            error_msg += 'Error occurred while retrieving Wind data: ' + str(e) + '\n'
-
-    if len(phy) > 0:
-        try:
-            with get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi)[0].squeeze() as dataset_phy:
-                dataset_list.append(rescale_dataset(dataset_phy))
-                phy = [var for var in phy if var in list(dataset_phy.keys())]
-        except Exception as e:
-            logger.error(traceback.format_exc())
-            phy = []
-            error_msg += 'Error occurred while retrieving Physical data:  ' + str(e) + '\n'
-
-    if len(gfs) > 0:
-        try:
-            dataset_gfs, gfs_type = get_GFS(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi)
-            if gfs_type == 'gfs_50':
-                dataset_gfs = dataset_gfs.rename({'lat': 'latitude', 'lon': 'longitude'})
-            dataset_list.append(rescale_dataset(dataset_gfs))
-            gfs = [var for var in gfs if var in list(dataset_gfs.keys())]
-        except Exception as e:
-            logger.error(traceback.format_exc())
-            gfs = []
-            error_msg += 'Error occurred while retrieving GFS data: ' + str(e) + '\n'
-
-    combined = xr.combine_by_coords(dataset_list, combine_attrs='drop', compat='override')[wave + wind + phy + gfs]
-
-    if len(combined) == 0:
-        error = 'Empty dataset'
-        logger.debug(error_msg + 'Error occurred: {}'.format(error))
-        error = error_msg + '\nError occurred: Empty dataset'
-
-        if len(error_msg) == 0:
-            status_code = 400
-        else:
-            status_code = 500
-
+    date_lo, date_hi = parameters['date_lo'], parameters['date_hi']
+    lat_lo, lat_hi, lon_lo, lon_hi = parameters['lat_lo'], parameters['lat_hi'], parameters['lon_lo'], \
+        parameters['lon_hi']
+    wave, wind, gfs, phy = parameters['wave'], parameters['wind'], parameters['gfs'], parameters['phy']
+    data_format, sampling = parameters['data_format'], parameters['sampling']
+
+    def compute_env_data():
+        wave_vars, wind_vars, gfs_vars, phy_vars = list(wave), list(wind), list(gfs), list(phy)
+        error_msg = ''
+
+        lat_interpolation = list(np.arange(lat_lo, lat_hi, spatial_interpolation_rate))
+        lon_interpolation = list(np.arange(lon_lo, lon_hi, spatial_interpolation_rate))
+        temporal_interpolation = [date_lo + timedelta(hours=hours) for hours in
+                                  range(0, (date_hi - date_lo).days * 24 + (date_hi - date_lo).seconds // 3600,
+                                        temporal_interpolation_rate)]
+
+        def rescale_dataset(dataset: xr.Dataset) -> xr.Dataset:
+            if sampling == 'nearest':
+                return regrid_nearest(dataset, dict(latitude=lat_interpolation, longitude=lon_interpolation,
+                                                    time=temporal_interpolation))
+            return dataset.interp(
+                latitude=xr.DataArray(lat_interpolation, coords=[lat_interpolation], dims=["latitude"]),
+                longitude=xr.DataArray(lon_interpolation, coords=[lon_interpolation], dims=["longitude"]),
+                time=xr.DataArray(temporal_interpolation, coords=[temporal_interpolation], dims=["time"]))
+
+        dataset_list = []
+
+        if len(wave_vars) > 0:
+            try:
+                with get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, wave_vars)[0] as wave_ds:
+                    dataset_list.append(rescale_dataset(wave_ds))
+                    wave_vars = [var for var in wave_vars if var in list(wave_ds.keys())]
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                wave_vars = []
+                error_msg += 'Error occurred while retrieving Wave data: ' + str(e) + '\n'
+
+        if len(wind_vars) > 0:
+            try:
+                with get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, wind_vars)[0].rename(
+                        {'lat': 'latitude', 'lon': 'longitude'}) as dataset_wind:
+                    dataset_list.append(rescale_dataset(dataset_wind))
+                    wind_vars = [var for var in wind_vars if var in list(dataset_wind.keys())]
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                wind_vars = []
+                error_msg += 'Error occurred while retrieving Wind data: ' + str(e) + '\n'
+
+        if len(phy_vars) > 0:
+            try:
+                with get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi,
+                                          phy_vars)[0].squeeze() as dataset_phy:
+                    dataset_list.append(rescale_dataset(dataset_phy))
+                    phy_vars = [var for var in phy_vars if var in list(dataset_phy.keys())]
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                phy_vars = []
+                error_msg += 'Error occurred while retrieving Physical data:  ' + str(e) + '\n'
+
+        if len(gfs_vars) > 0:
+            try:
+                dataset_gfs, gfs_type = get_GFS(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, gfs_vars)
+                if gfs_type == 'gfs_50':
+                    dataset_gfs = dataset_gfs.rename({'lat': 'latitude', 'lon': 'longitude'})
+                dataset_list.append(rescale_dataset(dataset_gfs))
+                gfs_vars = [var for var in gfs_vars if var in list(dataset_gfs.keys())]
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                gfs_vars = []
+                error_msg += 'Error occurred while retrieving GFS data: ' + str(e) + '\n'
+
+        combined = xr.combine_by_coords(dataset_list, combine_attrs='drop', compat='override')[wave_vars + wind_vars + phy_vars + gfs_vars]
+
+        if len(combined) == 0:
+            error = 'Empty dataset'
+            logger.debug(error_msg + 'Error occurred: {}'.format(error))
+            error = error_msg + '\nError occurred: Empty dataset'
+
+            if len(error_msg) == 0:
+                status_code = 400
+            else:
+                status_code = 500
+
+            return dict(error=error, status_code=status_code)
+
+        dir_path = Path(Path(__file__).parent, 'download')
+        dir_path.mkdir(exist_ok=True)
+        metadata_dict = dict(
+            timeRange='Time range: %s to %s' % (str(date_lo), str(date_hi)),
+            lon_extent='Longitude extent: %.2f to %.2f' % (lon_lo, lon_hi),
+            lat_extent='Latitude extent: %.2f to %.2f' % (lat_lo, lat_hi),
+            spatial_res='Spatial Resolution 0.083deg x 0.083deg',
+            temporal_res='Temporal Resolution 3-hours interval',
+            credit_CMEMS='Credit (Wave-Wind-Physical): E.U. Copernicus Marine Service Information (CMEMS)',
+            credit_GFS='Credit (GFS): National Centers for Environmental Prediction/National Weather Service/NOAA',
+            created='Accessed on %s' % datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            errors='Error(s): ' + error_msg.replace(',', ' ').replace('\n', ' ')
+        )
+        if data_format == 'csv':
+            file_path = Path(dir_path, str(uuid.uuid1()) + '.csv')
+            create_csv(combined.to_dataframe(), metadata_dict, file_path)
+        elif data_format == 'netcdf':
+            file_path = Path(dir_path, str(uuid.uuid1()) + '.nc')
+            combined.attrs = metadata_dict
+            write_netcdf(combined, file_path, **get_output_settings())
+        elif data_format == 'zarr':
+            file_path = Path(dir_path, str(uuid.uuid1()) + '.zarr.zip')
+            combined.attrs = metadata_dict
+            write_zarr_zip(combined, file_path, **get_output_settings())
+        created = datetime.now()
+        delete_file_queue[file_path] = created
+        logger.debug('Processing request finished {}'.format(error_msg))
+        return dict(file_path=file_path, created=created, error_msg=error_msg)
+
+    # only computed results are admitted by their cost, cached results are served right away
+    cost = estimate_env_data(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, wave, wind, gfs, phy,
+                             data_format)['cost']
+    client = get_remote_address()
+
+    def compute_admitted():
+        with admission.admit(client, cost):
+            return compute_env_data()
+
+    cache_key = normalize_request(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, wave, wind, gfs, phy, data_format,
+                                  sampling)
+    try:
+        result, cache_hit = result_cache.get_or_compute(cache_key, compute_admitted,
+                                                        file_path_of=lambda result: result['file_path'])
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    if 'error' in result:
         if request.accept_mimetypes['text/html']:
-            return render_template('error.html', error=error), status_code
+            return render_template('error.html', error=result['error']), result['status_code']
         else:
-            response = jsonify(error=error)
-            response.status_code = status_code
+            response = jsonify(error=result['error'])
+            response.status_code = result['status_code']
             return response
-
-    dir_path = Path(Path(__file__).parent, 'download')
-    dir_path.mkdir(exist_ok=True)
-    metadata_dict = dict(
-        timeRange='Time range: %s to %s' % (str(date_lo), str(date_hi)),
-        lon_extent='Longitude extent: %.2f to %.2f' % (lon_lo, lon_hi),
-        lat_extent='Latitude extent: %.2f to %.2f' % (lat_lo, lat_hi),
-        spatial_res='Spatial Resolution 0.083deg x 0.083deg',
-        temporal_res='Temporal Resolution 3-hours interval',
-        credit_CMEMS='Credit (Wave-Wind-Physical): E.U. Copernicus Marine Service Information (CMEMS)',
-        credit_GFS='Credit (GFS): National Centers for Environmental Prediction/National Weather Service/NOAA',
-        created='Accessed on %s' % datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        errors='Error(s): ' + error_msg.replace(',', ' ').replace('\n', ' ')
-    )
-    if data_format == 'csv':
-        file_path = Path(dir_path, str(uuid.uuid1()) + '.csv')
-        create_csv(combined.to_dataframe(), metadata_dict, file_path)
-    elif data_format == 'netcdf':
-        file_path = Path(dir_path, str(uuid.uuid1()) + '.nc')
-        combined.attrs = metadata_dict
-        combined.to_netcdf(file_path)
-    delete_file_queue[file_path] = datetime.now()
-    logger.debug('Processing request finished {}'.format(error_msg))
+    file_path, error_msg = result['file_path'], result['error_msg']
 
     download_link = '{}{}'.format(app.config['BASE_URL'], str(file_path.name))
-    file_end_of_life = (datetime.now(pytz.utc) + timedelta(minutes=FILE_LIFE_SPAN))
+    # a cached file is deleted FILE_LIFE_SPAN minutes after it was created and not after this request
+    remaining_life_span = result['created'] + timedelta(minutes=FILE_LIFE_SPAN) - datetime.now()
+    file_end_of_life = (datetime.now(pytz.utc) + remaining_life_span)
+    remaining_minutes = max(int(remaining_life_span.total_seconds() // 60), 0)
 
     if request.accept_mimetypes['text/html']:
         download_text = 'Download requested {} file '.format(data_format)
-        note = 'The file will be automatically deleted in {} Minutes: {}.'.format(FILE_LIFE_SPAN, file_end_of_life.strftime("%I:%M %p %Z"))
-        return render_template('result.html',
-                               download_link=download_link,
-                               download_text=download_text,
-                               note=note,
-                               errorFlag=len(error_msg) > 0,
-                               error=error_msg)
+        note = 'The file will be automatically deleted in {} Minutes: {}.'.format(remaining_minutes, file_end_of_life.strftime("%I:%M %p %Z"))
+        response = make_response(render_template('result.html',
+                                                 download_link=download_link,
+                                                 download_text=download_text,
+                                                 note=note,
+                                                 errorFlag=len(error_msg) > 0,
+                                                 error=error_msg))
     else:
         json_response = {
             'link': download_link,
@@ -528,11 +737,108 @@ def request_env_data():
             json_response.update({
                 'error': error_msg
             })
-        return jsonify(json_response)
+        response = jsonify(json_response)
+    response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+    return response
+
+
+@app.route('/estimate', methods=['GET'])
+@limiter.limit("1/second")
+def estimate():
+    """
+        Pre-flight estimate of a `/request_env_data` query with the same parameters: grid cells, subset requests and
+        transferred bytes per product, the size of the generated file, its cost and the current load.
+    """
+    parameters, error = parse_env_data_args(request.args)
+    if error is not None:
+        response = jsonify(error=error)
+        response.status_code = 400
+        return response
+    parameters.pop('sampling')
+    result = estimate_env_data(**parameters)
+    result['admissible'] = result['cost'] <= result['max_cost']
+    result['load'] = admission.status()
+    return jsonify(result)
+
+
+@app.route('/query_merged', methods=['GET'])
+def query_merged():
+    """
+        Rows of the harvested merged data within an optional space-time box as csv, only the partitions and row groups
+        overlapping the box are read.
+    """
+    def error_response(error, status_code=400):
+        logger.debug(error)
+        if request.accept_mimetypes['text/html']:
+            return render_template('error.html', error=error), status_code
+        response = jsonify(error=error)
+        response.status_code = status_code
+        return response
+
+    if app.config['MERGED_STORE_DIR'] is None:
+        return error_response('No merged data store is configured', 404)
+    box = dict()
+    try:
+        for key in ['date_lo', 'date_hi']:
+            if key in request.args:
+                box[key] = str_to_date_min(request.args.get(key))
+        for key in ['lat_lo', 'lat_hi', 'lon_lo', 'lon_hi']:
+            if key in request.args:
+                box[key] = float(request.args.get(key))
+    except ValueError as e:
+        return error_response('Parameter could not be parsed: {}'.format(e))
+    variables = request.args.get('vars').split(',') if request.args.get('vars') else None
+    max_rows = app.config['QUERY_MAX_ROWS']
+    batches = merged_store.iter_query(Path(app.config['MERGED_STORE_DIR']), variables=variables, **box)
+    try:
+        # the first batch is read before the response is started to report unknown columns
+        first = next(batches, None)
+    except ValueError as e:
+        return error_response(str(e))
+
+    def generate_csv():
+        rows = 0
+        try:
+            for batch in itertools.chain([first] if first is not None else [], batches):
+                batch = batch.iloc[:max_rows - rows]
+                yield batch.to_csv(header=rows == 0, index=False)
+                rows += len(batch)
+                if rows >= max_rows:
+                    logger.debug('Query result truncated to %d rows' % max_rows)
+                    return
+        except Exception:
+            # the response has already been started, hence the client only receives a truncated file
+            logger.error(traceback.format_exc())
+
+    return Response(stream_with_context(generate_csv()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=query.csv'})
+
+
+def is_expired(file_path: Path) -> bool:
+    """
+        Whether a generated file is older than FILE_LIFE_SPAN, files unknown to the deletion queue (e.g. after a
+        restart) by their modification time.
+    """
+    created = delete_file_queue.get(file_path, delete_file_queue.get(str(file_path)))
+    if created is None:
+        created = datetime.fromtimestamp(file_path.stat().st_mtime)
+    return datetime.now() - created > timedelta(minutes=FILE_LIFE_SPAN)
 
 
 @app.route('/<path:filename>')
 def send_file(filename):
+    dir_path = Path(Path(__file__).parent, 'download')
+    file_path = Path(dir_path, filename)
+    # the generated files are stored flat in the download directory
+    if file_path.resolve().parent != dir_path.resolve() or not file_path.is_file() or is_expired(file_path):
+        abort(404)
+    if app.config['ACCEL_REDIRECT_LOCATION']:
+        # nginx transfers the file from its internal location with sendfile and range support, the worker is free
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = app.config['ACCEL_REDIRECT_LOCATION'] + quote(file_path.name)
+        response.headers['Content-Type'] = mimetypes.guess_type(file_path.name)[0] or 'application/octet-stream'
+        response.headers['Content-Disposition'] = 'attachment; filename={}'.format(file_path.name)
+        return response
     return send_from_directory(directory='download', filename=filename)
 
 
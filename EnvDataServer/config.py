@@ -26,6 +26,8 @@
 #
 import os
 
+from utilities.helper_functions import parse_mem_size
+
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8080/")
 
 # https://docs.pylonsproject.org/projects/waitress/en/stable/arguments.html#arguments
@@ -35,3 +37,42 @@ URL_PREFIX = os.getenv("URL_PREFIX", "")
 
 # 50 Mb limit
 MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+
+# encoding of the netcdf and zarr outputs of /request_env_data, bandwidth is more expensive than compression
+# compression: zlib, zstd or none
+OUTPUT_COMPRESSION = os.getenv("OUTPUT_COMPRESSION", "zlib")
+OUTPUT_COMPLEVEL = int(os.getenv("OUTPUT_COMPLEVEL", 4))
+# floating point type of the variables, e.g. float32 or float64
+OUTPUT_DTYPE = os.getenv("OUTPUT_DTYPE", "float32")
+# comma separated variables stored as int16 with scale factor and offset, e.g. "VHM0,thetao"
+OUTPUT_PACKED_VARIABLES = [var for var in os.getenv("OUTPUT_PACKED_VARIABLES", "").split(',') if var != '']
+# grid points per chunk along latitude and longitude, a chunk holds the whole time axis
+OUTPUT_SPATIAL_CHUNK = int(os.getenv("OUTPUT_SPATIAL_CHUNK", 16))
+
+# profile requests with the header `X-Profile: 1` or the query parameter `profile=1` if enabled, the profiles are
+# written to PROFILE_DIR
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ["1", "true", "yes"]
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), 'profiles'))
+
+# internal nginx location serving the download directory, e.g. "/internal-download/". If set, downloads are answered
+# with an X-Accel-Redirect to it after the expiry is checked, otherwise the files are sent by the app
+ACCEL_REDIRECT_LOCATION = os.getenv("ACCEL_REDIRECT_LOCATION", "")
+
+# cost based admission control of /request_env_data and /merge_data, see EnvDataServer.admission. The costs are the
+# estimated bytes of the transferred subsets, their requests and the generated file, e.g. "512M" or "8G".
+# maximal cost processed at once
+ADMISSION_CAPACITY = parse_mem_size(os.getenv("ADMISSION_CAPACITY", "8G"))
+# requests with a higher cost are rejected
+ADMISSION_MAX_COST = parse_mem_size(os.getenv("ADMISSION_MAX_COST", "4G"))
+# a waiting request blocks one of the worker threads of waitress (default: 4), hence only a few requests wait for a
+# short time. Further requests are rejected with 429 right away.
+# maximal number of waiting requests
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", 2))
+# seconds a request waits for its admission
+ADMISSION_TIMEOUT = int(os.getenv("ADMISSION_TIMEOUT", 20))
+
+# root of the partitioned dataset of merged files written by the harvester with `--partitioned`, queried by
+# /query_merged
+MERGED_STORE_DIR = os.getenv("MERGED_STORE_DIR")
+# maximal number of rows returned by /query_merged
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", 1000000))
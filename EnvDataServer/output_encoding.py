@@ -0,0 +1,125 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+import logging
+
+import numpy as np
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+# packed values are stored as int16 and the lowest value marks missing values
+PACKED_DTYPE = 'int16'
+PACKED_FILL_VALUE = np.iinfo(PACKED_DTYPE).min
+# spatial dimension names of the combined datasets of the API
+SPATIAL_DIMS = ['latitude', 'longitude']
+
+
+def get_packing(values: np.ndarray) -> dict:
+    """
+        Scale factor and offset to store `values` as int16, the range of the valid values is mapped onto the int16
+        range without the fill value.
+    """
+    valid = values[np.isfinite(values)]
+    if len(valid) == 0:
+        return dict(dtype=PACKED_DTYPE, scale_factor=1.0, add_offset=0.0, _FillValue=PACKED_FILL_VALUE)
+    lo, hi = float(valid.min()), float(valid.max())
+    # 2 ** 16 - 2 steps between the lowest and the highest value
+    scale_factor = (hi - lo) / (2 ** 16 - 2) if hi > lo else 1.0
+    return dict(dtype=PACKED_DTYPE, scale_factor=scale_factor, add_offset=(hi + lo) / 2,
+                _FillValue=PACKED_FILL_VALUE)
+
+
+def get_chunks(variable: xr.DataArray, spatial_chunk: int) -> tuple:
+    """
+        Chunk shape for time series access: the whole time axis of `spatial_chunk` x `spatial_chunk` grid points.
+    """
+    return tuple(min(spatial_chunk, size) if dim in SPATIAL_DIMS else size
+                 for dim, size in zip(variable.dims, variable.shape))
+
+
+def get_encoding(ds: xr.Dataset, compression: str = 'zlib', complevel: int = 4, dtype: str = 'float32',
+                 packed_variables=(), spatial_chunk: int = 16, output_format: str = 'netcdf') -> dict:
+    """
+        Encoding of the data variables of `ds` for `output_format` 'netcdf' or 'zarr'.
+
+        :param compression: 'zlib', 'zstd' or 'none', netcdf files are compressed with zlib in case of 'zstd' as the
+            netCDF4 backend of xarray supports zlib only
+        :param dtype: floating point type of the variables that are not packed, e.g. 'float32'
+        :param packed_variables: variables stored as int16 with scale factor and offset
+    """
+    if compression not in ['zlib', 'zstd', 'none']:
+        raise ValueError('Unknown compression %s' % compression)
+    encoding = dict()
+    for name, variable in ds.data_vars.items():
+        if name in packed_variables:
+            var_encoding = get_packing(variable.values)
+        else:
+            var_encoding = dict(dtype=dtype)
+        if variable.ndim > 0:
+            var_encoding['chunks' if output_format == 'zarr' else 'chunksizes'] = get_chunks(variable, spatial_chunk)
+        if output_format == 'zarr':
+            var_encoding['compressor'] = get_zarr_compressor(compression, complevel)
+        elif compression != 'none':
+            var_encoding.update(zlib=True, complevel=min(complevel, 9), shuffle=True)
+        encoding[name] = var_encoding
+    return encoding
+
+
+def get_zarr_compressor(compression: str, complevel: int):
+    import numcodecs
+    if compression == 'zstd':
+        return numcodecs.Zstd(level=complevel)
+    if compression == 'zlib':
+        return numcodecs.Zlib(level=min(complevel, 9))
+    return None
+
+
+def drop_source_encoding(ds: xr.Dataset) -> xr.Dataset:
+    """
+        Copy of `ds` without the encoding of the source files, e.g. their chunk sizes or packing.
+    """
+    ds = ds.copy()
+    for variable in ds.variables.values():
+        variable.encoding = dict()
+    return ds
+
+
+def write_netcdf(ds: xr.Dataset, file_path: Path, **settings) -> None:
+    ds = drop_source_encoding(ds)
+    ds.to_netcdf(file_path, encoding=get_encoding(ds, output_format='netcdf', **settings))
+
+
+def write_zarr_zip(ds: xr.Dataset, file_path: Path, **settings) -> None:
+    """
+        Write `ds` as a Zarr store within a single zip file, which can be opened with
+        `xr.open_zarr(zarr.ZipStore(file_path, mode='r'))`.
+    """
+    import zarr
+    ds = drop_source_encoding(ds)
+    with zarr.ZipStore(str(file_path), mode='w') as store:
+        ds.to_zarr(store, encoding=get_encoding(ds, output_format='zarr', **settings), consolidated=True)
@@ -0,0 +1,121 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from datetime import datetime, timedelta
+from pathlib import Path
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_request(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, wave, wind, gfs, phy, data_format,
+                      sampling='linear') -> tuple:
+    """
+        Build the cache key of a `/request_env_data` query: rounded bbox, time range, sorted variable sets, format and
+        sampling.
+    """
+    return (date_lo.strftime('%Y-%m-%dT%H:%M'), date_hi.strftime('%Y-%m-%dT%H:%M'),
+            round(lat_lo, 4), round(lat_hi, 4), round(lon_lo, 4), round(lon_hi, 4),
+            tuple(sorted(set(wave))), tuple(sorted(set(wind))), tuple(sorted(set(gfs))), tuple(sorted(set(phy))),
+            data_format.lower(), sampling)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class RequestCache:
+    """
+        Result cache with request coalescing (single-flight) for generated output files.
+
+        Concurrent calls of `get_or_compute` with the same key are served by one computation. A result is cached
+        only if `is_cacheable(result)` holds and is reused as long as it is younger than `ttl`, its file exists and
+        `is_valid(result)` holds, e.g. its file has not expired yet.
+    """
+
+    def __init__(self, ttl: timedelta, is_cacheable=lambda result: True, is_valid=lambda result: True):
+        self.ttl = ttl
+        self.is_cacheable = is_cacheable
+        self.is_valid = is_valid
+        self._entries = dict()
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        result, file_path, created = entry
+        if datetime.now() - created > self.ttl or not Path(file_path).exists() or not self.is_valid(result):
+            del self._entries[key]
+            return None
+        return result
+
+    def get_or_compute(self, key, compute, file_path_of):
+        """
+            Return `(result, hit)`. `compute()` runs at most once per key at a time, all other callers wait for it.
+            `file_path_of(result)` returns the path of the generated file that has to exist for a cache hit.
+        """
+        with self._lock:
+            result = self._lookup(key)
+            if result is not None:
+                logger.debug('Result cache hit for %s' % str(key))
+                return result, True
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._in_flight[key] = flight
+
+        if not leader:
+            logger.debug('Waiting for in-flight computation of %s' % str(key))
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result, True
+
+        try:
+            flight.result = compute()
+            if self.is_cacheable(flight.result):
+                with self._lock:
+                    self._entries[key] = (flight.result, file_path_of(flight.result), datetime.now())
+            return flight.result, False
+        except Exception as e:
+            flight.exception = e
+            raise e
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+    def evict(self, file_path) -> None:
+        with self._lock:
+            for key in [k for k, (_, f_path, _) in self._entries.items() if str(f_path) == str(file_path)]:
+                del self._entries[key]
@@ -0,0 +1,155 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+import threading
+import time
+
+import pytest
+
+from EnvDataServer.admission import AdmissionController, AdmissionRejected, get_cost, get_output_bytes, \
+    RETRY_AFTER_MAX
+from EnvironmentalData import fetch_planner
+
+
+def start(target, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def test_get_cost():
+    products = dict(wave=dict(transfer_bytes=1000, remote_requests=1),
+                    gfs=dict(transfer_bytes=2000, remote_requests=3))
+    assert get_cost(products, 500) == 3500 + 4 * fetch_planner.REQUEST_OVERHEAD_BYTES
+    assert get_output_bytes(10, 'CSV') == 120
+    assert get_output_bytes(10, 'netcdf') == 10 * fetch_planner.BYTES_PER_VALUE
+
+
+def test_max_cost():
+    admission = AdmissionController(capacity=100, max_cost=50, timeout=1)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire('a', 51)
+    assert e.value.status_code == 400 and e.value.retry_after is None
+    assert admission.status()['in_flight'] == 0
+
+
+def test_capacity():
+    admission = AdmissionController(capacity=100, max_cost=100, timeout=5)
+    admitted = admission.acquire('a', 60)
+    thread = start(admission.acquire, 'b', 60)
+    wait_for(lambda: admission.status()['waiting'] == 1)
+    assert admission.status()['in_flight'] == 60
+    admission.release(60, admitted)
+    thread.join()
+    assert admission.status() == dict(in_flight=60, waiting=0, capacity=100, max_waiting=None)
+
+
+def test_costlier_than_capacity_runs_alone():
+    admission = AdmissionController(capacity=100, max_cost=200, timeout=1)
+    with admission.admit('a', 150):
+        assert admission.status()['in_flight'] == 150
+    assert admission.status()['in_flight'] == 0
+
+
+def test_timeout():
+    admission = AdmissionController(capacity=100, max_cost=100, timeout=0.1)
+    admission.acquire('a', 100)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire('b', 10)
+    assert e.value.status_code == 503 and e.value.retry_after >= 1
+    assert admission.status()['waiting'] == 0
+
+
+def test_max_waiting():
+    admission = AdmissionController(capacity=100, max_cost=100, timeout=5, max_waiting=1)
+    admitted = admission.acquire('a', 100)
+    thread = start(admission.acquire, 'b', 50)
+    wait_for(lambda: admission.status()['waiting'] == 1)
+    # further requests do not block a thread while the queue is full
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire('c', 50)
+    assert time.monotonic() - started < 1
+    assert e.value.status_code == 429 and e.value.retry_after >= 1
+    admission.release(100, admitted)
+    thread.join()
+
+
+def test_no_waiting_requests_are_admitted_right_away():
+    admission = AdmissionController(capacity=100, max_cost=100, timeout=5, max_waiting=0)
+    with admission.admit('a', 50):
+        with admission.admit('b', 50):
+            assert admission.status()['in_flight'] == 100
+        with pytest.raises(AdmissionRejected):
+            admission.acquire('c', 60)
+
+
+def test_retry_after_from_processing_time():
+    admission = AdmissionController(capacity=100, max_cost=100, timeout=60, max_waiting=0)
+    admitted = admission.acquire('a', 100)
+    time.sleep(0.1)
+    admission.release(100, admitted)
+    # about 1 ms per cost unit
+    assert 0.0008 < admission.seconds_per_cost < 0.01
+    admission.acquire('a', 100)
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire('b', 100)
+    # 100 units ahead of the request instead of the timeout of 60 seconds
+    assert e.value.retry_after == 1
+    admission.seconds_per_cost = 1000
+    with pytest.raises(AdmissionRejected) as e:
+        admission.acquire('b', 100)
+    assert e.value.retry_after == RETRY_AFTER_MAX
+
+
+def test_fair_queueing():
+    admission = AdmissionController(capacity=100, max_cost=100, timeout=5)
+    admitted = admission.acquire('x', 100)
+    order = []
+
+    def request(client, cost):
+        with admission.admit(client, cost):
+            order.append(client)
+            time.sleep(0.01)
+
+    # client a queues expensive requests before client b sends a cheap one
+    threads = []
+    for client, cost in [('a', 100), ('a', 100), ('a', 100), ('b', 10)]:
+        threads.append(start(request, client, cost))
+        wait_for(lambda: admission.status()['waiting'] == len(threads))
+    admission.release(100, admitted)
+    for thread in threads:
+        thread.join()
+    # the cheap request of b is not starved by the requests of a queued before it
+    assert order.index('b') < 2
+    assert admission.status()['in_flight'] == 0
@@ -0,0 +1,154 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from datetime import datetime, timedelta
+from pathlib import Path
+import threading
+import time
+
+import pytest
+
+from EnvDataServer.request_cache import RequestCache, normalize_request
+
+
+@pytest.fixture
+def file_path(tmp_path) -> Path:
+    path = Path(tmp_path, 'result.csv')
+    path.write_text('x')
+    return path
+
+
+class Compute:
+    def __init__(self, result, delay: float = 0):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def get(cache: RequestCache, key, compute):
+    return cache.get_or_compute(key, compute, file_path_of=lambda result: result['file_path'])
+
+
+def test_hit(file_path):
+    cache = RequestCache(timedelta(minutes=1))
+    compute = Compute(dict(file_path=file_path))
+    assert get(cache, 'k', compute) == (compute.result, False)
+    assert get(cache, 'k', compute) == (compute.result, True)
+    assert get(cache, 'other', compute) == (compute.result, False)
+    assert compute.calls == 2
+
+
+def test_expired_entry(file_path):
+    cache = RequestCache(timedelta(seconds=0.1))
+    compute = Compute(dict(file_path=file_path))
+    get(cache, 'k', compute)
+    time.sleep(0.2)
+    assert get(cache, 'k', compute)[1] is False
+
+
+def test_deleted_file(file_path):
+    cache = RequestCache(timedelta(minutes=1))
+    compute = Compute(dict(file_path=file_path))
+    get(cache, 'k', compute)
+    file_path.unlink()
+    assert get(cache, 'k', compute)[1] is False
+
+
+def test_invalid_entry(file_path):
+    valid = dict(value=True)
+    cache = RequestCache(timedelta(minutes=1), is_valid=lambda result: valid['value'])
+    compute = Compute(dict(file_path=file_path))
+    get(cache, 'k', compute)
+    valid['value'] = False
+    assert get(cache, 'k', compute)[1] is False
+
+
+def test_not_cacheable(file_path):
+    cache = RequestCache(timedelta(minutes=1), is_cacheable=lambda result: 'error' not in result)
+    compute = Compute(dict(file_path=file_path, error='failed'))
+    get(cache, 'k', compute)
+    assert get(cache, 'k', compute)[1] is False
+
+
+def test_evict(file_path):
+    cache = RequestCache(timedelta(minutes=1))
+    compute = Compute(dict(file_path=file_path))
+    get(cache, 'k', compute)
+    cache.evict(str(file_path))
+    assert get(cache, 'k', compute)[1] is False
+
+
+def test_coalescing(file_path):
+    cache = RequestCache(timedelta(minutes=1))
+    compute = Compute(dict(file_path=file_path), delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get(cache, 'k', compute))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # one computation serves all concurrent callers
+    assert compute.calls == 1
+    assert sorted(hit for _, hit in results) == [False, True, True, True, True]
+
+
+def test_coalesced_exception():
+    cache = RequestCache(timedelta(minutes=1))
+    compute = Compute(RuntimeError('failed'), delay=0.2)
+    errors = []
+
+    def call():
+        try:
+            get(cache, 'k', compute)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert compute.calls == 1
+    assert len(errors) == 3
+    # a failed computation is not cached
+    with pytest.raises(RuntimeError):
+        get(cache, 'k', compute)
+    assert compute.calls == 2
+
+
+def test_normalize_request():
+    date_lo, date_hi = datetime(2021, 1, 1, 0, 0, 30), datetime(2021, 1, 2)
+    assert normalize_request(date_lo, date_hi, 1.00001, 2, 3, 4, ['b', 'a', 'a'], [], [], [], 'CSV') == \
+        normalize_request(date_lo.replace(second=0), date_hi, 1.0, 2, 3, 4, ['a', 'b'], [], [], [], 'csv', 'linear')
+    assert normalize_request(date_lo, date_hi, 1, 2, 3, 4, ['a'], [], [], [], 'csv', 'nearest') != \
+        normalize_request(date_lo, date_hi, 1, 2, 3, 4, ['a'], [], [], [], 'csv', 'linear')
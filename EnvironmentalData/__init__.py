@@ -27,6 +27,7 @@
 import logging
 import os
 import sys
+from collections.abc import Mapping
 from pathlib import Path
 
 from dotenv import dotenv_values
@@ -34,14 +35,40 @@ from dotenv import dotenv_values
 secrets_file = Path(Path(__file__).parent, '.env.secret')
 
 logger = logging.getLogger(__name__)
-if not os.path.exists(secrets_file) or not os.access(secrets_file, os.R_OK):
-    logger.error('Could not find or read secrets file "%s" with service credentials -> exiting.', secrets_file)
-    sys.exit(16)
+
+
+class Secrets(Mapping):
+    """
+        Service credentials of the secrets file, read on first access, so the modules can be imported without it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.values = None
+
+    def load(self) -> dict:
+        if self.values is None:
+            if not os.path.exists(self.path) or not os.access(self.path, os.R_OK):
+                logger.error('Could not find or read secrets file "%s" with service credentials -> exiting.',
+                             self.path)
+                sys.exit(16)
+            self.values = {
+                # load sensitive variables
+                **dotenv_values(self.path),
+                # override loaded values with environment variables
+                # **os.environ,
+            }
+        return self.values
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
 
 global config
-config = {
-    # load sensitive variables
-    **dotenv_values(secrets_file),
-    # override loaded values with environment variables
-    # **os.environ,
-}
+config = Secrets(secrets_file)
@@ -0,0 +1,123 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+import logging
+import typing
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+# tolerance of the spatial coordinates of a fragment to match the grid of the first fragment
+COORD_TOLERANCE = 1e-6
+
+
+def get_fill_value(dtype: np.dtype) -> typing.Tuple[np.dtype, typing.Any]:
+    """
+        Dtype of a preallocated array holding values of `dtype` and the value marking its missing time steps.
+    """
+    if np.issubdtype(dtype, np.datetime64):
+        return dtype, np.datetime64('NaT')
+    return np.promote_types(dtype, np.float32), np.nan
+
+
+class TimeAssembler:
+    """
+        Assembles the fragments of a product into arrays preallocated along the expected time axis. The fragments may
+        be added in any order, time steps no fragment provides stay masked with NaN (NaT).
+    """
+
+    def __init__(self, times: pd.DatetimeIndex, time_name: str = 'time'):
+        self.times = pd.DatetimeIndex(times)
+        self.time_name = time_name
+        self.filled = np.zeros(len(self.times), dtype=bool)
+        # first fragment defining the grid, the attributes and the variables without time dimension
+        self.template = None
+        # preallocated arrays with the time as first dimension by name of the variables and coordinates along the time
+        self.arrays = dict()
+        self.variables = dict()
+
+    def _allocate(self, fragment: xr.Dataset) -> None:
+        self.template = fragment.drop_vars([name for name, var in fragment.variables.items()
+                                            if self.time_name in var.dims])
+        for name, var in fragment.variables.items():
+            if self.time_name not in var.dims or name == self.time_name:
+                continue
+            var = var.transpose(self.time_name, ...)
+            dtype, fill_value = get_fill_value(var.dtype)
+            self.arrays[name] = np.full((len(self.times),) + var.shape[1:], fill_value, dtype=dtype)
+            # dimensions and attributes of the assembled variable
+            self.variables[name] = (var.dims, var.attrs, name in fragment.coords)
+
+    def _align(self, fragment: xr.Dataset) -> xr.Dataset:
+        """
+            Reindex `fragment` to the grid of the first fragment if the subsets differ at the edges.
+        """
+        indexers = {dim: self.template.indexes[dim] for dim in fragment.dims
+                    if dim != self.time_name and dim in self.template.indexes and dim in fragment.indexes
+                    and not fragment.indexes[dim].equals(self.template.indexes[dim])}
+        if len(indexers) == 0:
+            return fragment
+        return fragment.reindex(indexers, method='nearest', tolerance=COORD_TOLERANCE)
+
+    def add(self, fragment: xr.Dataset) -> None:
+        """
+            Write the time steps of `fragment` into their slots, time steps outside of the expected axis are ignored.
+        """
+        if self.template is None:
+            self._allocate(fragment)
+        fragment = self._align(fragment)
+        positions = self.times.get_indexer(fragment.indexes[self.time_name])
+        found = positions >= 0
+        if not found.all():
+            logger.debug('Ignoring %d time steps outside of the expected time axis' % (~found).sum())
+        if not found.any():
+            return
+        for name, array in self.arrays.items():
+            if name in fragment.variables and self.time_name in fragment.variables[name].dims:
+                array[positions[found]] = fragment.variables[name].transpose(*self.variables[name][0]).values[found]
+        self.filled[positions[found]] = True
+
+    @property
+    def missing(self) -> pd.DatetimeIndex:
+        return self.times[~self.filled]
+
+    def to_dataset(self) -> typing.Optional[xr.Dataset]:
+        """
+            The assembled dataset with dimensions of size one other than the time squeezed, `None` without fragments.
+        """
+        if self.template is None:
+            return None
+        ds = self.template.assign_coords({self.time_name: self.times})
+        for name, array in self.arrays.items():
+            dims, attrs, is_coord = self.variables[name]
+            if is_coord:
+                ds = ds.assign_coords({name: xr.Variable(dims, array, attrs=attrs)})
+            else:
+                ds[name] = xr.Variable(dims, array, attrs=attrs)
+        return ds.squeeze([dim for dim, size in ds.dims.items() if size == 1 and dim != self.time_name])
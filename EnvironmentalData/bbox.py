@@ -0,0 +1,96 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+import logging
+import typing
+
+import numpy as np
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+# western bound of the native longitude range of the products, the GFS grids span 0..360 and CMEMS -180..180
+LON_FRAME = {
+    'gfs': 0,
+    'gfs_50': 0,
+    'phy': -180,
+    'wind': -180,
+    'wave': -180,
+}
+
+
+def get_lon_ranges(lon_lo: float, lon_hi: float, frame_lo: float) -> typing.List[typing.Tuple[float, float]]:
+    """
+        Contiguous ranges of the native longitude range starting at `frame_lo` covering [lon_lo, lon_hi], from west to
+        east. A box crossing the seam of the native range, e.g. the prime meridian for GFS or the antimeridian for CMEMS,
+        results in two ranges.
+    """
+    frame_hi = frame_lo + 360
+    if lon_hi - lon_lo >= 360:
+        return [(frame_lo, frame_hi)]
+    west = (lon_lo - frame_lo) % 360 + frame_lo
+    east = west + lon_hi - lon_lo
+    if east <= frame_hi:
+        return [(west, east)]
+    logger.debug('splitting LON [%s, %s] at the seam of the native range into LON [%s, %s] and LON [%s, %s]' % (
+        lon_lo, lon_hi, west, frame_hi, frame_lo, east - 360))
+    return [(west, frame_hi), (frame_lo, east - 360)]
+
+
+def to_request_frame(ds: xr.Dataset, lon_name: str, lon_lo: float) -> xr.Dataset:
+    """
+        Shift the native longitudes of `ds` by whole turns into [lon_lo, lon_lo + 360).
+    """
+    lons = ds[lon_name].values
+    shifted = np.where(lons >= lon_lo + 360, lons - 360, np.where(lons < lon_lo, lons + 360, lons))
+    return ds.assign_coords({lon_name: ds[lon_name].copy(data=shifted)})
+
+
+def stitch(pieces: typing.List[xr.Dataset], lon_name: str, lon_lo: float) -> xr.Dataset:
+    """
+        Concatenate the subsets of the ranges of `get_lon_ranges` along the longitude in the request frame starting at
+        `lon_lo`. The ranges are ordered from west to east, so the pieces are joined without sorting.
+    """
+    # a narrow range next to the seam may contain no grid column
+    pieces = [to_request_frame(piece, lon_name, lon_lo) for piece in pieces
+              if piece.sizes[lon_name] > 0] or pieces[:1]
+    if len(pieces) == 1:
+        return pieces[0]
+    stitched = [pieces[0]]
+    for piece in pieces[1:]:
+        # a grid column on the seam may be contained in both subsets
+        stitched.append(piece.isel({lon_name: piece[lon_name].values > stitched[-1][lon_name].values[-1]}))
+    return xr.concat(stitched, dim=lon_name, data_vars='minimal', coords='minimal', compat='override',
+                     combine_attrs='override')
+
+
+def get_stitched(fetch: typing.Callable[[float, float], xr.Dataset], lon_lo: float, lon_hi: float, frame_lo: float,
+                 lon_name: str) -> xr.Dataset:
+    """
+        Retrieve [lon_lo, lon_hi] with `fetch(west, east)` once per range of `get_lon_ranges` in the native longitude
+        range starting at `frame_lo` and stitch the subsets in the request frame starting at `lon_lo`.
+    """
+    return stitch([fetch(west, east) for west, east in get_lon_ranges(lon_lo, lon_hi, frame_lo)], lon_name, lon_lo)
@@ -0,0 +1,137 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+from utilities import resilience
+
+logger = logging.getLogger(__name__)
+
+# datasets of the THREDDS catalogs by catalog url: {'expires': timestamp or None, 'datasets': {name: access urls}}
+_catalogs = dict()
+_lock = threading.Lock()
+# directory to persist the catalogs between runs, see `set_cache_dir`. The catalogs are kept in memory only if it is
+# not set.
+CATALOG_CACHE_DIR = os.environ.get('CATALOG_CACHE_DIR')
+# catalogs of days older than IMMUTABLE_DAYS are complete and do not change anymore
+IMMUTABLE_DAYS = 7
+# seconds a catalog of a recent day is reused, files may still be added to it
+RECENT_TTL = 3600
+# seconds a catalog without a day, e.g. of the "Best" forecast dataset, is reused
+BEST_TTL = 600
+# names of the NetCDF Subset Service in the access urls of a dataset, see `siphon.catalog.Dataset`
+NCSS_SERVICE_NAMES = ['netcdfsubset', 'netcdfserver']
+
+
+def set_cache_dir(cache_dir: typing.Optional[Path]) -> None:
+    global CATALOG_CACHE_DIR
+    CATALOG_CACHE_DIR = cache_dir
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+
+def get_ttl(day: typing.Optional[datetime]) -> typing.Optional[int]:
+    """
+        Seconds the catalog of `day` is reused, `None` if it does not expire.
+    """
+    if day is None:
+        return BEST_TTL
+    if day.date() + timedelta(days=IMMUTABLE_DAYS) < date.today():
+        return None
+    return RECENT_TTL
+
+
+def _cache_path(catalog_url: str) -> typing.Optional[Path]:
+    if CATALOG_CACHE_DIR is None:
+        return None
+    return Path(CATALOG_CACHE_DIR, 'catalog_%s.json' % hashlib.sha1(catalog_url.encode()).hexdigest())
+
+
+def _is_valid(entry: typing.Optional[dict]) -> bool:
+    return entry is not None and (entry['expires'] is None or entry['expires'] > time.time())
+
+
+def _load(catalog_url: str) -> typing.Optional[dict]:
+    path = _cache_path(catalog_url)
+    if path is None or not path.exists():
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning('Ignoring the cached catalog %s: %s' % (path, e))
+        return None
+
+
+def _save(catalog_url: str, entry: dict) -> None:
+    path = _cache_path(catalog_url)
+    if path is None:
+        return
+    tmp_path = Path(path.parent, '.%s.%d.tmp' % (path.name, threading.get_ident()))
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(entry, url=catalog_url), f)
+    os.replace(tmp_path, path)
+
+
+def get_datasets(endpoint: str, catalog_url: str, day: datetime = None) -> typing.Dict[str, dict]:
+    """
+        Access urls of the datasets of the THREDDS catalog `catalog_url` by dataset name, in the order of the catalog.
+        The catalog is only requested from `endpoint` again once its entry expired, see `get_ttl`.
+    """
+    with _lock:
+        entry = _catalogs.get(catalog_url)
+    if not _is_valid(entry):
+        entry = _load(catalog_url)
+        if not _is_valid(entry):
+            from siphon.catalog import TDSCatalog
+            catalog = resilience.call(endpoint, TDSCatalog, catalog_url)
+            ttl = get_ttl(day)
+            entry = dict(expires=None if ttl is None else time.time() + ttl,
+                         datasets={name: {str(service): url for service, url in dataset.access_urls.items()}
+                                   for name, dataset in catalog.datasets.items()})
+            _save(catalog_url, entry)
+            logger.debug('Cached catalog %s with %d datasets' % (catalog_url, len(entry['datasets'])))
+        with _lock:
+            _catalogs[catalog_url] = entry
+    return entry['datasets']
+
+
+def get_ncss_url(access_urls: dict) -> str:
+    """
+        NetCDF Subset Service url of a dataset given by its access urls.
+    """
+    for service, url in access_urls.items():
+        if service.lower() in NCSS_SERVICE_NAMES:
+            return url
+    raise RuntimeError('Subset access is not available for dataset %s' % ', '.join(access_urls.values()))
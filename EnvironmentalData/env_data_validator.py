@@ -24,20 +24,25 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
 # Public License for more details.
 #
+import argparse
 import logging
 import random
-import sys
 
+import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+import xarray as xr
 
-from EnvironmentalData.weather import get_GFS, get_global_wave, get_global_phy_daily, get_global_wind, select_grid_point
+from EnvironmentalData import fetch_planner
+from EnvironmentalData.weather import get_GFS, get_global_wave, get_global_phy_daily, get_global_wind, \
+    select_grid_point, select_grid_points, fetch_products, close_products, GFS_25_VAR_LIST, DAILY_PHY_VAR_LIST, \
+    WIND_VAR_LIST, WAVE_VAR_LIST
 from utilities import helper_functions
 
 logger = logging.getLogger(__name__)
 
 
 def validate_random_rows(df: pd.DataFrame, num_of_rows=10):
+    from sklearn.metrics.pairwise import cosine_similarity
     df = df.dropna(how='all').fillna(value=0)
     gfs, wave, phy, wind = [], [], [], []
     for i in range(num_of_rows):
@@ -63,6 +68,74 @@ def validate_random_rows(df: pd.DataFrame, num_of_rows=10):
     logger.debug('Avg. Similarity phy %.2f' % sum(phy) / len(phy))
 
 
+def compare_values(product: str, expected: pd.DataFrame, actual: pd.DataFrame) -> list:
+    """
+        Statistics of the differences between the merged values and the nearest grid values per variable.
+    """
+    stats = []
+    for var in actual.columns:
+        valid = expected[var].notna().values & actual[var].notna().values
+        e, a = expected[var].values[valid].astype('float64'), actual[var].values[valid].astype('float64')
+        diff = e - a
+        stats.append(dict(product=product, variable=var, rows=int(valid.sum()),
+                          bias=diff.mean() if len(diff) > 0 else np.nan,
+                          mae=np.abs(diff).mean() if len(diff) > 0 else np.nan,
+                          rmse=np.sqrt((diff ** 2).mean()) if len(diff) > 0 else np.nan,
+                          corr=np.corrcoef(e, a)[0, 1] if len(diff) > 1 and e.std() > 0 and a.std() > 0 else np.nan))
+    return stats
+
+
+def validate_batch(df: pd.DataFrame, num_of_rows=1000, col_dict: dict = None, max_bytes: int = None,
+                   seed: int = None) -> pd.DataFrame:
+    """
+        Compare the merged values of `num_of_rows` random rows with the nearest grid values of the products. The rows
+        are grouped into shared space-time subsets by the fetch planner, each subset is fetched once and the nearest
+        grid points of all its rows are selected at once.
+
+        :returns: statistics per product and variable
+    """
+    if col_dict is None:
+        col_dict = {'time': 'BaseDateTime', 'lat': 'LAT', 'lon': 'LON'}
+    variables = dict(gfs=[v for v in GFS_25_VAR_LIST if v in df.columns],
+                     phy=[v for v in DAILY_PHY_VAR_LIST if v in df.columns],
+                     wind=[v for v in WIND_VAR_LIST if v in df.columns],
+                     wave=[v for v in WAVE_VAR_LIST if v in df.columns])
+    sample = df.dropna(subset=[col_dict['time'], col_dict['lat'], col_dict['lon']])
+    sample = sample.sample(n=min(num_of_rows, len(sample)), random_state=seed).reset_index(drop=True)
+    plan = fetch_planner.plan_track(sample, col_dict, variables, max_bytes=max_bytes)
+    logger.debug('Validating %d rows with fetch plan %s' % (len(sample), str(plan)))
+    expected, actual = dict(), dict()
+    for window in plan.windows:
+        rows = sample.iloc[window.rows]
+        time_points = xr.DataArray(rows[col_dict['time']].values, dims='points')
+        lat_points = xr.DataArray(rows[col_dict['lat']].values, dims='points')
+        lon_points = xr.DataArray(rows[col_dict['lon']].values, dims='points')
+        products = fetch_products(**window.envelope, **variables)
+        try:
+            for ds, ds_name, var_list in products:
+                values = select_grid_points(ds, ds_name, time_points, lat_points, lon_points, var_list)
+                expected.setdefault(ds_name, []).append(rows[values.columns].reset_index(drop=True))
+                actual.setdefault(ds_name, []).append(values)
+        finally:
+            close_products(products)
+    stats = []
+    for ds_name in actual:
+        stats.extend(compare_values(ds_name, pd.concat(expected[ds_name], ignore_index=True),
+                                    pd.concat(actual[ds_name], ignore_index=True)))
+    stats = pd.DataFrame(stats, columns=['product', 'variable', 'rows', 'bias', 'mae', 'rmse', 'corr'])
+    logger.info('Validation of %d rows:\n%s' % (len(sample), stats.to_string(index=False)))
+    return stats
+
+
 if __name__ == '__main__':
-    validate_random_rows(
-        pd.read_csv(sys.argv[1], parse_dates=['BaseDateTime'], date_parser=helper_functions.str_to_date))
+    parser = argparse.ArgumentParser(description='Validate the environmental data merged into a csv file.')
+    parser.add_argument('file', help='The merged csv file.')
+    parser.add_argument('-n', '--rows', help='Number of random rows to validate.', type=int, default=1000)
+    parser.add_argument('--single', help='Validate the rows one by one instead of in shared subsets.',
+                        action='store_true')
+    args = parser.parse_args()
+    df = pd.read_csv(args.file, parse_dates=['BaseDateTime'], date_parser=helper_functions.str_to_date)
+    if args.single:
+        validate_random_rows(df, num_of_rows=args.rows)
+    else:
+        validate_batch(df, num_of_rows=args.rows)
@@ -0,0 +1,165 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+from urllib.parse import urlparse
+import asyncio
+import logging
+import shutil
+import tempfile
+import typing
+
+import aiohttp
+import xarray as xr
+
+from utilities import resilience
+
+logger = logging.getLogger(__name__)
+
+# concurrent requests per remote service, services not listed use DEFAULT_HOST_LIMIT
+HOST_LIMITS = {'cmems': 4, 'rda': 16, 'ucar': 8, 'ncei': 8}
+DEFAULT_HOST_LIMIT = 8
+# open connections of an engine over all hosts
+TOTAL_LIMIT = 256
+# seconds without receiving data after which a request is aborted
+READ_TIMEOUT = 300
+BLOCK_SIZE = 2 ** 16
+
+resilience.TRANSIENT_EXCEPTIONS.extend([aiohttp.ClientConnectionError, aiohttp.ClientPayloadError])
+
+
+class FetchRequest:
+    """
+        Subset request whose response is streamed to `file_path`.
+    """
+
+    def __init__(self, url: str, file_path: Path = None, auth: typing.Tuple[str, str] = None,
+                 prepare: typing.Callable[[str], str] = None):
+        self.url = url
+        self.file_path = file_path
+        self.auth = aiohttp.BasicAuth(*auth) if auth else None
+        # blocking transformation of the url before each attempt, e.g. to add a CAS ticket
+        self.prepare = prepare
+        self.endpoint = resilience.endpoint_of(url)
+
+
+def ncss_request(ncss_url: str, query, file_path: Path = None, auth: typing.Tuple[str, str] = None) -> FetchRequest:
+    """
+        Request of a NetCDF Subset Service `query` built with siphon, e.g. `NCSSQuery().lonlat_box(..)`, see
+        `catalog_cache.get_ncss_url`.
+    """
+    return FetchRequest('%s?%s' % (ncss_url, str(query)), file_path, auth=auth)
+
+
+def motu_request(url: str, username: str, password: str, file_path: Path = None) -> FetchRequest:
+    """
+        Request of a Motu `productdownload` url, authenticated at the CMEMS CAS before each attempt.
+    """
+    from motu_utils.utils_cas import authenticate_CAS_for_URL
+    return FetchRequest(url, file_path, prepare=lambda u: authenticate_CAS_for_URL(u, username, password))
+
+
+class FetchEngine:
+    """
+        Issue many subset requests concurrently on one event loop, limited per remote service.
+    """
+
+    def __init__(self, host_limits: dict = None, total_limit: int = TOTAL_LIMIT, read_timeout: int = READ_TIMEOUT):
+        self.host_limits = {**HOST_LIMITS, **(host_limits or dict())}
+        self.total_limit = total_limit
+        self.read_timeout = read_timeout
+
+    async def _download(self, session: aiohttp.ClientSession, request: FetchRequest) -> Path:
+        url = request.url
+        if request.prepare is not None:
+            url = await asyncio.get_running_loop().run_in_executor(None, request.prepare, url)
+        part_path = Path(str(request.file_path) + '.part')
+        async with session.get(url, auth=request.auth) as response:
+            if response.status >= 400:
+                raise resilience.HTTPStatusError(request.url, response.status)
+            with open(part_path, 'wb') as f:
+                async for block in response.content.iter_chunked(BLOCK_SIZE):
+                    f.write(block)
+        part_path.replace(request.file_path)
+        return request.file_path
+
+    async def fetch(self, session: aiohttp.ClientSession, semaphores: dict, request: FetchRequest) -> Path:
+        async with semaphores[request.endpoint]:
+            try:
+                return await resilience.get_endpoint(request.endpoint).call_async(self._download, session, request)
+            except Exception as e:
+                Path(str(request.file_path) + '.part').unlink(missing_ok=True)
+                raise e
+
+    async def fetch_all(self, requests: typing.List[FetchRequest]) -> typing.List[typing.Union[Path, Exception]]:
+        """
+            Fetch all `requests` and return the file paths, or the exceptions of failed requests, in the same order.
+        """
+        semaphores = {request.endpoint: asyncio.Semaphore(self.host_limits.get(request.endpoint, DEFAULT_HOST_LIMIT))
+                      for request in requests}
+        connector = aiohttp.TCPConnector(limit=self.total_limit)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=self.read_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(*[self.fetch(session, semaphores, request) for request in requests],
+                                        return_exceptions=True)
+
+    def run(self, requests: typing.List[FetchRequest]) -> typing.List[typing.Union[Path, Exception]]:
+        """
+            Blocking `fetch_all` for synchronous callers, e.g. the harvester and the request handlers of the web app.
+        """
+        if len(requests) == 0:
+            return []
+        logger.debug('Fetching %d subsets from %s' % (
+            len(requests), ', '.join(sorted(set(urlparse(r.url).hostname or '' for r in requests)))))
+        return asyncio.run(self.fetch_all(requests))
+
+
+_engine = FetchEngine()
+
+
+def fetch_datasets(requests: typing.List[FetchRequest], engine: FetchEngine = None) \
+        -> typing.List[typing.Union[xr.Dataset, Exception]]:
+    """
+        Fetch `requests` into a temporary directory and load the responses as datasets.
+    """
+    download_dir = Path(tempfile.mkdtemp(prefix='fetch_'))
+    try:
+        for i, request in enumerate(requests):
+            if request.file_path is None:
+                request.file_path = Path(download_dir, '%d.nc' % i)
+        results = []
+        for result in (engine or _engine).run(requests):
+            if isinstance(result, Exception):
+                results.append(result)
+                continue
+            try:
+                with xr.open_dataset(result) as ds:
+                    results.append(ds.load())
+            except Exception as e:
+                results.append(e)
+        return results
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
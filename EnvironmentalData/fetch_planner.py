@@ -0,0 +1,273 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from collections import Counter
+from datetime import timedelta
+import logging
+
+import numpy as np
+import pandas as pd
+
+from EnvironmentalData import bbox
+
+logger = logging.getLogger(__name__)
+
+# native grid of each product: (spatial resolution in degrees, temporal resolution in hours, bbox offset in degrees
+# added by the product function)
+PRODUCT_GRID = {
+    'gfs': (0.25, 3, 0.25),
+    'phy': (0.083, 24, 0.1),
+    'wind': (0.125, 1, 0.25),
+    'wave': (0.083, 3, 0.1),
+}
+# size of a value in the retrieved subsets
+BYTES_PER_VALUE = 4
+# fixed cost of an additional subset request (catalog lookups, authentication, latency) expressed in bytes
+REQUEST_OVERHEAD_BYTES = 512 * 1024
+# archive files of GFS per day (4 cycles with 2 forecast hours each), requested as one subset each
+GFS_FILES_PER_DAY = 8
+# length of the initial time windows a track is split into before they are merged
+WINDOW_HOURS = 24
+# size of the space-time tiles shared by the files of a year in step 3
+TILE_DEGREES = 5
+TILE_HOURS = 24
+
+
+def grid_cells(product: str, date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi) -> int:
+    """
+        Number of grid cells of `product` covering the space-time box, including the offsets of the product functions.
+    """
+    resolution, hours, offset = PRODUCT_GRID[product]
+    n_lat = int((lat_hi - lat_lo + 2 * offset) / resolution) + 1
+    n_lon = int((lon_hi - lon_lo + 2 * offset) / resolution) + 1
+    # the time range is extended to the enclosing time steps
+    n_time = int((date_hi - date_lo) / timedelta(hours=hours)) + 2
+    return n_lat * n_lon * n_time
+
+
+def expected_bytes(envelope: dict, variables: dict) -> int:
+    """
+        Expected size of the subsets for `envelope` and the requested `variables` given as {product: [variables]}.
+    """
+    return sum(grid_cells(product, **envelope) * len(var_list) * BYTES_PER_VALUE
+               for product, var_list in variables.items() if len(var_list) > 0)
+
+
+def remote_requests(product: str, date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi) -> int:
+    """
+        Number of subset requests the product function issues for the space-time box.
+    """
+    offset = PRODUCT_GRID[product][2]
+    # one subset per contiguous range of the grid
+    lon_ranges = len(bbox.get_lon_ranges(lon_lo - offset, lon_hi + offset, bbox.LON_FRAME[product]))
+    if product != 'gfs':
+        # one Motu download of the whole box
+        return lon_ranges
+    days = (date_hi.date() - date_lo.date()).days + 1
+    # one subset per archive file, including the last file of the previous day
+    return (GFS_FILES_PER_DAY * days + 1) * lon_ranges
+
+
+def estimate(envelope: dict, variables: dict) -> dict:
+    """
+        Expected grid cells, subset requests and transferred bytes of each product with requested `variables` given as
+        {product: [variables]} for the space-time box `envelope`.
+    """
+    products = dict()
+    for product, var_list in variables.items():
+        if len(var_list) == 0:
+            continue
+        cells = grid_cells(product, **envelope)
+        products[product] = dict(grid_cells=cells, remote_requests=remote_requests(product, **envelope),
+                                 transfer_bytes=cells * len(var_list) * BYTES_PER_VALUE)
+    return products
+
+
+def get_envelope(rows: np.ndarray, times: np.ndarray, lats: np.ndarray, lons: np.ndarray) -> dict:
+    return dict(date_lo=pd.Timestamp(times[rows].min()), date_hi=pd.Timestamp(times[rows].max()),
+                lat_lo=float(lats[rows].min()), lat_hi=float(lats[rows].max()),
+                lon_lo=float(lons[rows].min()), lon_hi=float(lons[rows].max()))
+
+
+def union(a: dict, b: dict) -> dict:
+    return {key: min(value, b[key]) if key.endswith('_lo') else max(value, b[key]) for key, value in a.items()}
+
+
+class FetchWindow:
+    """
+        Rows of a track that are enriched with the same subset requests, the `rows` are positions in the chunk.
+    """
+
+    def __init__(self, rows: np.ndarray, times: np.ndarray, lats: np.ndarray, lons: np.ndarray, variables: dict):
+        self.rows = rows
+        self.variables = variables
+        self.envelope = get_envelope(rows, times, lats, lons)
+        self.expected_bytes = expected_bytes(self.envelope, variables)
+
+    @property
+    def cost(self) -> int:
+        return self.expected_bytes + REQUEST_OVERHEAD_BYTES
+
+
+class FetchPlan:
+    def __init__(self, windows: list, single_box_bytes: int):
+        self.windows = windows
+        self.single_box_bytes = single_box_bytes
+
+    @property
+    def expected_bytes(self) -> int:
+        return sum(window.expected_bytes for window in self.windows)
+
+    def __str__(self):
+        return '%d subset request window(s), expected %.1f MB (single box: %.1f MB)' % (
+            len(self.windows), self.expected_bytes / 2 ** 20, self.single_box_bytes / 2 ** 20)
+
+
+def plan_track(df: pd.DataFrame, col_dict: dict, variables: dict, max_bytes: int = None) -> FetchPlan:
+    """
+        Split the rows of `df` into time windows, each with its own bbox around the local track segment.
+
+        The rows are split into windows of `WINDOW_HOURS` first. Afterwards, the windows are merged in a single pass
+        in time order: a window joins the running window as long as this reduces the expected download including the
+        request overhead and the joint window stays within `max_bytes`. Windows expected to exceed `max_bytes` are
+        split further in time as long as possible.
+    """
+    times = df[col_dict['time']].values
+    lats = df[col_dict['lat']].values
+    lons = df[col_dict['lon']].values
+    order = np.argsort(times, kind='stable')
+
+    def window(rows):
+        return FetchWindow(rows, times, lats, lons, variables)
+
+    buckets = (times[order] - times[order][0]) // np.timedelta64(WINDOW_HOURS, 'h')
+    boundaries = np.flatnonzero(np.diff(buckets)) + 1
+
+    windows = []
+    # rows, envelope and expected bytes of the running window
+    group, envelope, group_bytes = [], None, 0
+    for rows in np.split(order, boundaries):
+        rows_envelope = get_envelope(rows, times, lats, lons)
+        rows_bytes = expected_bytes(rows_envelope, variables)
+        if envelope is not None:
+            merged = union(envelope, rows_envelope)
+            merged_bytes = expected_bytes(merged, variables)
+            if (max_bytes is None or merged_bytes <= max_bytes) and \
+                    group_bytes + rows_bytes + REQUEST_OVERHEAD_BYTES > merged_bytes:
+                group.append(rows)
+                envelope, group_bytes = merged, merged_bytes
+                continue
+            windows.append(window(np.concatenate(group)))
+        group, envelope, group_bytes = [rows], rows_envelope, rows_bytes
+    windows.append(window(np.concatenate(group)))
+
+    if max_bytes is not None:
+        windows = _split_windows(windows, window, times, max_bytes)
+
+    return FetchPlan(windows, expected_bytes(window(order).envelope, variables))
+
+
+def _split_windows(windows: list, window, times: np.ndarray, max_bytes: int) -> list:
+    result = []
+    while len(windows) > 0:
+        w = windows.pop(0)
+        # rows are sorted by time, a window with a single timestamp cannot be split in time
+        if w.expected_bytes <= max_bytes or times[w.rows[0]] == times[w.rows[-1]]:
+            result.append(w)
+        else:
+            half = len(w.rows) // 2
+            windows[0:0] = [window(w.rows[:half]), window(w.rows[half:])]
+    return result
+
+
+def get_tiles(df: pd.DataFrame, col_dict: dict) -> dict:
+    """
+        Positions of the rows of `df` by the key `(time, lat, lon)` of the tile they fall into.
+    """
+    hours = df[col_dict['time']].values.astype('datetime64[h]').astype(np.int64)
+    keys = pd.DataFrame({'time': hours // TILE_HOURS,
+                         'lat': np.floor(df[col_dict['lat']].values / TILE_DEGREES).astype(np.int64),
+                         'lon': np.floor(df[col_dict['lon']].values / TILE_DEGREES).astype(np.int64)})
+    return keys.groupby(['time', 'lat', 'lon']).indices
+
+
+class TilePlan:
+    """
+        Space-time tiles of the chunks of several files. Every tile is retrieved once for the envelope of the rows of
+        all files falling into it and kept as long as chunks referencing it are left.
+    """
+
+    def __init__(self, variables: dict):
+        self.variables = variables
+        self.envelopes = dict()
+        self.chunks = dict()
+        self.references = Counter()
+        self.first_times = dict()
+
+    def add(self, name: str, index: int, df: pd.DataFrame, col_dict: dict) -> None:
+        """
+            Register the rows of chunk `index` of the file `name`.
+        """
+        times = df[col_dict['time']].values
+        lats = df[col_dict['lat']].values
+        lons = df[col_dict['lon']].values
+        tiles = get_tiles(df, col_dict)
+        for tile, rows in tiles.items():
+            envelope = get_envelope(rows, times, lats, lons)
+            self.envelopes[tile] = union(envelope, self.envelopes[tile]) if tile in self.envelopes else envelope
+        self.chunks[(name, index)] = set(tiles)
+        self.references.update(tiles.keys())
+        self.first_times[name] = min(self.first_times.get(name, times.min()), times.min())
+
+    def release(self, name: str, index: int = None) -> list:
+        """
+            Drop the references of chunk `index` or all chunks of the file `name`.
+
+            :returns: tiles that are not referenced anymore
+        """
+        keys = [(name, index)] if index is not None else [key for key in self.chunks if key[0] == name]
+        released = []
+        for key in keys:
+            for tile in self.chunks.pop(key, set()):
+                self.references[tile] -= 1
+                if self.references[tile] <= 0:
+                    del self.references[tile]
+                    released.append(tile)
+        return released
+
+    def files(self) -> list:
+        """
+            Names of the files ordered by their first timestamp, so files sharing days are enriched one after another.
+        """
+        return sorted(self.first_times, key=lambda name: (self.first_times[name], name))
+
+    @property
+    def expected_bytes(self) -> int:
+        return sum(expected_bytes(envelope, self.variables) for envelope in self.envelopes.values())
+
+    def __str__(self):
+        return '%d tile(s) for %d file(s) with %d chunk(s), expected %.1f MB' % (
+            len(self.envelopes), len(self.first_times), len(self.chunks), self.expected_bytes / 2 ** 20)
@@ -0,0 +1,204 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+import glob
+import logging
+import math
+import os
+import re
+import typing
+
+import numpy as np
+import pandas as pd
+
+from utilities import helper_functions
+
+logger = logging.getLogger(__name__)
+
+# Hive-style partitioned Parquet dataset of merged files, e.g.
+# `<root>/year=2020/month=3/lat_cell=30/lon_cell=-90/AIS_2020_03_01-0.parquet`. The cells are keyed by their lower
+# left corner.
+CELL_DEGREES = 10
+PARTITION_KEYS = ['year', 'month', 'lat_cell', 'lon_cell']
+# rows of the row groups of a file, every row group has min/max statistics used to skip it in queries
+ROW_GROUP_SIZE = 50000
+# schema of the first written file, the columns of all later files are cast to it
+SCHEMA_FILE = '_common_metadata'
+# default columns of MarineCadastre files
+COL_DICT = {'time': 'BaseDateTime', 'lat': 'LAT', 'lon': 'LON'}
+
+
+def get_cell(value: float) -> int:
+    return int(math.floor(value / CELL_DEGREES) * CELL_DEGREES)
+
+
+def get_schema(root: Path):
+    import pyarrow.parquet as pq
+    path = Path(root, SCHEMA_FILE)
+    return pq.read_schema(str(path)) if path.exists() else None
+
+
+def get_table(df: pd.DataFrame, schema) -> tuple:
+    """
+        Table of `df` in the columns and types of `schema` and the schema extended by the types of columns that had
+        no values in the previous files.
+    """
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata()
+    # columns without values are typed as null, their type is taken from the first file with values
+    table = pa.table({name: pa.nulls(len(table)) if column.null_count == len(table) else column
+                      for name, column in zip(table.column_names, table.columns)})
+    if schema is None:
+        return table, table.schema
+    schema = pa.schema([table.schema.field(field.name) if pa.types.is_null(field.type) and
+                        field.name in table.column_names else field for field in schema])
+    return table.select(schema.names).cast(schema, safe=False), schema
+
+
+def get_partition_files(root: Path, stem: str) -> list:
+    """
+        Partition files of the source file `stem` in all partitions of the dataset `root`.
+    """
+    pattern = re.compile(re.escape(stem) + r'-\d+\.parquet')
+    return [path for path in root.glob('/'.join(['%s=*' % name for name in PARTITION_KEYS] +
+                                                 [glob.escape(stem) + '-*.parquet']))
+            if pattern.fullmatch(path.name)]
+
+
+def add_file(csv_path: Path, root: Path, col_dict: dict = None) -> int:
+    """
+        Write the rows of the merged csv `csv_path` into the partitions of the dataset `root`. The rows of every
+        partition are sorted by time, so the statistics of the row groups cover short time ranges. Adding a file
+        again replaces all its previous partition files.
+
+        :returns: number of written partition files
+    """
+    import pyarrow.parquet as pq
+    col_dict = col_dict or COL_DICT
+    schema = get_schema(root)
+    written = 0
+    try:
+        # a previous run may have written other chunks or partitions, which would otherwise be queried as duplicates
+        for path in get_partition_files(root, csv_path.stem):
+            path.unlink()
+        for index, df_chunk in enumerate(pd.read_csv(csv_path, parse_dates=[col_dict['time']],
+                                                     date_parser=helper_functions.str_to_date,
+                                                     chunksize=helper_functions.CHUNK_SIZE)):
+            df_chunk.drop(['Unnamed: 0'], axis=1, errors='ignore', inplace=True)
+            times = df_chunk[col_dict['time']].dt
+            keys = pd.DataFrame({'year': times.year, 'month': times.month,
+                                 'lat_cell': np.floor(df_chunk[col_dict['lat']] / CELL_DEGREES) * CELL_DEGREES,
+                                 'lon_cell': np.floor(df_chunk[col_dict['lon']] / CELL_DEGREES) * CELL_DEGREES})
+            for key, rows in keys.groupby(PARTITION_KEYS).indices.items():
+                table, table_schema = get_table(df_chunk.iloc[rows].sort_values(col_dict['time']), schema)
+                if table_schema != schema:
+                    root.mkdir(parents=True, exist_ok=True)
+                    pq.write_metadata(table_schema, str(Path(root, SCHEMA_FILE)))
+                    schema = table_schema
+                partition = Path(root, *['%s=%d' % (name, value) for name, value in zip(PARTITION_KEYS, key)])
+                partition.mkdir(parents=True, exist_ok=True)
+                file_path = Path(partition, '%s-%d.parquet' % (csv_path.stem, index))
+                # hidden until it is complete, files starting with '.' or '_' are ignored by queries
+                tmp_path = Path(partition, '.%s.tmp' % file_path.name)
+                pq.write_table(table, str(tmp_path), row_group_size=ROW_GROUP_SIZE, compression='zstd')
+                os.replace(tmp_path, file_path)
+                written += 1
+    except Exception as e:
+        raise helper_functions.FileFailedException(csv_path.name, e)
+    logger.debug('Added %s to %s in %d partition files' % (csv_path.name, root, written))
+    return written
+
+
+def get_filter(col_dict: dict, date_lo=None, date_hi=None, lat_lo=None, lat_hi=None, lon_lo=None, lon_hi=None):
+    """
+        Filter expression of the space-time box on the partition keys and the columns, unbounded sides are `None`.
+        The partition keys prune directories and the column statistics prune files and row groups.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    expression = ds.scalar(True)
+    if date_lo is not None:
+        date_lo = pd.Timestamp(date_lo)
+        expression &= (ds.field('year') > date_lo.year) | ((ds.field('year') == date_lo.year) &
+                                                          (ds.field('month') >= date_lo.month))
+        expression &= ds.field(col_dict['time']) >= pa.scalar(date_lo.to_datetime64(), pa.timestamp('ns'))
+    if date_hi is not None:
+        date_hi = pd.Timestamp(date_hi)
+        expression &= (ds.field('year') < date_hi.year) | ((ds.field('year') == date_hi.year) &
+                                                          (ds.field('month') <= date_hi.month))
+        expression &= ds.field(col_dict['time']) <= pa.scalar(date_hi.to_datetime64(), pa.timestamp('ns'))
+    for key, column, lo, hi in [('lat_cell', col_dict['lat'], lat_lo, lat_hi),
+                                ('lon_cell', col_dict['lon'], lon_lo, lon_hi)]:
+        if lo is not None:
+            expression &= (ds.field(key) >= get_cell(lo)) & (ds.field(column) >= lo)
+        if hi is not None:
+            expression &= (ds.field(key) <= get_cell(hi)) & (ds.field(column) <= hi)
+    return expression
+
+
+def get_dataset(root: Path):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    partitioning = ds.partitioning(pa.schema([(name, pa.int32()) for name in PARTITION_KEYS]), flavor='hive')
+    schema = get_schema(root)
+    if schema is not None:
+        schema = pa.schema(list(schema) + [pa.field(name, pa.int32()) for name in PARTITION_KEYS])
+    return ds.dataset(str(root), format='parquet', partitioning=partitioning, schema=schema)
+
+
+def iter_query(root: Path, date_lo=None, date_hi=None, lat_lo=None, lat_hi=None, lon_lo=None, lon_hi=None,
+               variables: list = None, col_dict: dict = None, batch_size: int = None) -> typing.Iterator[pd.DataFrame]:
+    """
+        Yield the rows of the dataset `root` within the space-time box batch by batch. Only the time, position and
+        requested `variables` columns are read, all columns if `variables` is `None`.
+    """
+    col_dict = col_dict or COL_DICT
+    if not Path(root, SCHEMA_FILE).exists():
+        return
+    dataset = get_dataset(root)
+    columns = None
+    if variables is not None:
+        columns = [col_dict['time'], col_dict['lat'], col_dict['lon']] + \
+                  [var for var in variables if var not in col_dict.values()]
+        unknown = [column for column in columns if column not in dataset.schema.names]
+        if len(unknown) > 0:
+            raise ValueError('Unknown columns: %s' % ', '.join(unknown))
+    scanner = dataset.scanner(columns=columns, filter=get_filter(col_dict, date_lo, date_hi, lat_lo, lat_hi, lon_lo,
+                                                                 lon_hi),
+                              **(dict(batch_size=batch_size) if batch_size else dict()))
+    for batch in scanner.to_batches():
+        if batch.num_rows > 0:
+            df = batch.to_pandas()
+            # the partition keys are not part of the merged data
+            yield df.drop(columns=[name for name in PARTITION_KEYS if name in df.columns])
+
+
+def query(root: Path, **kwargs) -> pd.DataFrame:
+    """
+        Rows of the dataset `root` within the space-time box, see `iter_query`.
+    """
+    return pd.concat(list(iter_query(root, **kwargs)) or [pd.DataFrame()], ignore_index=True)
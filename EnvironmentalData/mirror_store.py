@@ -0,0 +1,144 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from datetime import datetime, timedelta
+from pathlib import Path
+import logging
+import os
+import typing
+
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+# root directory of the mirrored regions, each region is a directory with one Zarr store per dataset,
+# e.g. `<MIRROR_DIR>/us-eez/wave.zarr`. The mirror is not used if it is not set.
+MIRROR_DIR = os.environ.get('MIRROR_DIR')
+# names of the latitude and longitude coordinates of the datasets, 'latitude' and 'longitude' otherwise
+COORD_NAMES = {'wind': ('lat', 'lon'), 'gfs_50': ('lat', 'lon')}
+# time steps per day of the datasets, used as the chunk length along the time axis
+STEPS_PER_DAY = {'gfs': 8, 'gfs_50': 8, 'phy': 1, 'wind': 24, 'wave': 8}
+SPATIAL_CHUNK = 64
+# Blosc compressor of the mirrored variables
+COMPRESSOR = dict(cname='zstd', clevel=3)
+
+
+def set_mirror_dir(mirror_dir: typing.Optional[Path]) -> None:
+    global MIRROR_DIR
+    MIRROR_DIR = mirror_dir
+
+
+def get_store_path(mirror_dir: Path, region: str, ds_name: str) -> Path:
+    return Path(mirror_dir, region, '%s.zarr' % ds_name)
+
+
+def get_coverage(store_path: Path) -> typing.Optional[dict]:
+    """
+        Mirrored extent of a store: bounding box, synced days and variables.
+    """
+    if not store_path.exists():
+        return None
+    import zarr
+    return zarr.open_group(str(store_path), mode='r').attrs.get('mirror')
+
+
+def covers(coverage: dict, t_lo: datetime, t_hi: datetime, y_lo: float, y_hi: float, x_lo: float, x_hi: float,
+           variables: list = None) -> bool:
+    if variables is None and not coverage['complete']:
+        return False
+    if variables is not None and not set(variables).issubset(coverage['variables']):
+        return False
+    if not (coverage['lat_lo'] <= min(y_lo, y_hi) and max(y_lo, y_hi) <= coverage['lat_hi'] and
+            coverage['lon_lo'] <= min(x_lo, x_hi) and max(x_lo, x_hi) <= coverage['lon_hi']):
+        return False
+    days = set(coverage['days'])
+    return all(str((t_lo + timedelta(days=day)).date()) in days for day in range((t_hi.date() - t_lo.date()).days + 1))
+
+
+def select(ds_name: str, t_lo: datetime, t_hi: datetime, y_lo: float, y_hi: float, x_lo: float, x_hi: float,
+           variables: list = None) -> typing.Optional[xr.Dataset]:
+    """
+        Subset of the first mirrored region covering the request, `None` if no region covers it.
+    """
+    if MIRROR_DIR is None or not Path(MIRROR_DIR).exists():
+        return None
+    for region in sorted(os.listdir(MIRROR_DIR)):
+        store_path = get_store_path(MIRROR_DIR, region, ds_name)
+        coverage = get_coverage(store_path)
+        if coverage is None or not covers(coverage, t_lo, t_hi, y_lo, y_hi, x_lo, x_hi, variables):
+            continue
+        logger.debug('Accessing mirrored data %s' % store_path)
+        ds = xr.open_zarr(str(store_path))
+        if not ds.indexes['time'].is_monotonic_increasing:
+            # days synced after a gap are appended at the end
+            ds = ds.sortby('time')
+        lat_name, lon_name = COORD_NAMES.get(ds_name, ('latitude', 'longitude'))
+        lat_slice = slice(min(y_lo, y_hi), max(y_lo, y_hi))
+        if ds.indexes[lat_name].is_monotonic_decreasing:
+            lat_slice = slice(max(y_lo, y_hi), min(y_lo, y_hi))
+        ds = ds.sel({lat_name: lat_slice, lon_name: slice(min(x_lo, x_hi), max(x_lo, x_hi)),
+                     'time': slice(t_lo, t_hi)})
+        return (ds[variables] if variables is not None else ds).compute()
+    return None
+
+
+def append_day(store_path: Path, ds: xr.Dataset, ds_name: str, day: datetime, variables: list = None) -> None:
+    """
+        Append the time steps of `day` to the store, the first day defines the mirrored bounding box.
+    """
+    from numcodecs import Blosc
+    import zarr
+    ds = ds.sel(time=slice(day, day + timedelta(days=1) - timedelta(seconds=1)))
+    if variables is not None:
+        ds = ds[[var for var in variables if var in ds.data_vars]]
+    # scalar coordinates like the reference time of the first file can not be appended
+    ds = ds.drop_vars([name for name in ds.coords if name not in ds.dims and 'time' not in ds[name].dims])
+    lat_name, lon_name = COORD_NAMES.get(ds_name, ('latitude', 'longitude'))
+    coverage = get_coverage(store_path)
+    if coverage is None:
+        encoding = dict()
+        for var in ds.data_vars:
+            chunks = tuple(STEPS_PER_DAY.get(ds_name, 24) if dim == 'time' else
+                           SPATIAL_CHUNK if dim in [lat_name, lon_name] else 1 for dim in ds[var].dims)
+            encoding[var] = dict(compressor=Blosc(shuffle=Blosc.BITSHUFFLE, **COMPRESSOR), chunks=chunks, dtype='float32')
+        ds.to_zarr(str(store_path), mode='w', encoding=encoding, consolidated=True)
+        coverage = dict(lat_lo=float(ds[lat_name].min()), lat_hi=float(ds[lat_name].max()),
+                        lon_lo=float(ds[lon_name].min()), lon_hi=float(ds[lon_name].max()),
+                        variables=list(ds.data_vars), complete=variables is None, days=[])
+    else:
+        # keep the grid of the first day if the remote subsets differ at the edges
+        with xr.open_zarr(str(store_path)) as existing:
+            ds = ds.reindex({lat_name: existing[lat_name].values, lon_name: existing[lon_name].values},
+                            method='nearest', tolerance=1e-6)
+        ds.to_zarr(str(store_path), append_dim='time', consolidated=True)
+    coverage['days'] = sorted(set(coverage['days']) | {str(day.date())})
+    zarr.open_group(str(store_path), mode='r+').attrs['mirror'] = coverage
+    zarr.consolidate_metadata(str(store_path))
+
+
+def synced_days(store_path: Path) -> typing.Set[str]:
+    coverage = get_coverage(store_path)
+    return set(coverage['days']) if coverage is not None else set()
@@ -0,0 +1,107 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from EnvironmentalData.assembler import TimeAssembler, get_fill_value
+
+TIMES = pd.date_range('2021-01-01', periods=8, freq='3h')
+LATS = [10., 10.25, 10.5]
+LONS = [20., 20.25]
+
+
+def get_fragment(times, lats=LATS, lons=LONS) -> xr.Dataset:
+    times = pd.DatetimeIndex(times)
+    # the values encode the hour of their time step
+    values = np.broadcast_to(times.hour.values[:, None, None], (len(times), len(lats), len(lons))).astype('float32')
+    return xr.Dataset({'t': (('time', 'latitude', 'longitude'), values, {'units': 'K'}),
+                       'height': ((), 2.)},
+                      coords=dict(time=times, latitude=lats, longitude=lons), attrs={'source': 'test'})
+
+
+def test_fragments_in_any_order():
+    assembler = TimeAssembler(TIMES)
+    for times in [TIMES[4:], TIMES[:2], TIMES[2:4]]:
+        assembler.add(get_fragment(times))
+    ds = assembler.to_dataset()
+    assert len(assembler.missing) == 0
+    pd.testing.assert_index_equal(ds.indexes['time'], TIMES, check_names=False)
+    np.testing.assert_array_equal(ds.t.values[:, 0, 0], TIMES.hour.values)
+    assert ds.t.attrs == {'units': 'K'}
+    assert ds.attrs == {'source': 'test'}
+    assert float(ds.height) == 2.
+
+
+def test_missing_time_steps_are_masked():
+    assembler = TimeAssembler(TIMES)
+    assembler.add(get_fragment(TIMES[[0, 1, 5]]))
+    pd.testing.assert_index_equal(assembler.missing, TIMES[[2, 3, 4, 6, 7]])
+    ds = assembler.to_dataset()
+    assert ds.t.dtype == np.float32
+    assert np.isnan(ds.t.values[[2, 3, 4, 6, 7]]).all()
+    assert not np.isnan(ds.t.values[[0, 1, 5]]).any()
+
+
+def test_time_steps_outside_of_the_axis_are_ignored():
+    assembler = TimeAssembler(TIMES)
+    assembler.add(get_fragment(pd.DatetimeIndex(['2020-12-31 21:00', '2021-01-01 01:00'])))
+    assert assembler.filled.sum() == 0
+    assembler.add(get_fragment([TIMES[0], pd.Timestamp('2021-01-01 01:00')]))
+    pd.testing.assert_index_equal(assembler.missing, TIMES[1:])
+
+
+def test_grid_of_the_first_fragment():
+    assembler = TimeAssembler(TIMES[:2])
+    assembler.add(get_fragment(TIMES[:1]))
+    # a later subset differing at the edges and by rounding is aligned to the first grid
+    assembler.add(get_fragment(TIMES[1:2], lats=[10.0000001, 10.25, 10.5, 10.75]))
+    ds = assembler.to_dataset()
+    assert ds.t.shape == (2, 3, 2)
+    np.testing.assert_array_equal(ds.t.values[1], 3)
+
+
+def test_single_size_dimensions_are_squeezed():
+    assembler = TimeAssembler(TIMES[:2])
+    fragment = get_fragment(TIMES[:2]).expand_dims(height_above_ground=[10.])
+    assembler.add(fragment)
+    ds = assembler.to_dataset()
+    assert 'height_above_ground' not in ds.t.dims
+    assert ds.t.dims == ('time', 'latitude', 'longitude')
+
+
+def test_without_fragments():
+    assembler = TimeAssembler(TIMES)
+    assert assembler.to_dataset() is None
+    pd.testing.assert_index_equal(assembler.missing, TIMES)
+
+
+def test_get_fill_value():
+    dtype, fill_value = get_fill_value(np.dtype('int16'))
+    assert dtype == np.float32 and np.isnan(fill_value)
+    assert get_fill_value(np.dtype('float64'))[0] == np.float64
+    assert np.isnat(get_fill_value(np.dtype('datetime64[ns]'))[1])
@@ -0,0 +1,142 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from EnvironmentalData import weather
+from EnvironmentalData.bbox import get_lon_ranges, get_stitched, stitch, to_request_frame, LON_FRAME
+
+
+@pytest.mark.parametrize('lon_lo, lon_hi, frame_lo, expected', [
+    # inside the native range
+    (10, 20, LON_FRAME['gfs'], [(10, 20)]),
+    (-20, -10, LON_FRAME['gfs'], [(340, 350)]),
+    (-20, -10, LON_FRAME['wave'], [(-20, -10)]),
+    # crossing the prime meridian of the GFS grids
+    (-10, 10, LON_FRAME['gfs'], [(350, 360), (0, 10)]),
+    # crossing the antimeridian of the CMEMS grids
+    (170, 190, LON_FRAME['wave'], [(170, 180), (-180, -170)]),
+    (-190, -170, LON_FRAME['wave'], [(170, 180), (-180, -170)]),
+    # whole globe
+    (-180, 180, LON_FRAME['gfs'], [(0, 360)]),
+    (-10, 400, LON_FRAME['wave'], [(-180, 180)]),
+])
+def test_get_lon_ranges(lon_lo, lon_hi, frame_lo, expected):
+    assert get_lon_ranges(lon_lo, lon_hi, frame_lo) == expected
+
+
+def test_get_lon_ranges_on_seam():
+    # a box ending on the seam does not need a second range
+    assert get_lon_ranges(350, 360, 0) == [(350, 360)]
+    assert get_lon_ranges(-10, 0, 0) == [(350, 360)]
+
+
+def get_piece(lons) -> xr.Dataset:
+    lons = np.asarray(lons, dtype=float)
+    return xr.Dataset({'t': (('lat', 'lon'), np.tile(lons % 360, (2, 1)))}, coords=dict(lat=[0., 1.], lon=lons))
+
+
+def test_stitch_prime_meridian():
+    # subsets of the ranges [(350, 360), (0, 10)] of the GFS grid, both contain the grid column on the seam
+    pieces = [get_piece(np.arange(350, 360.5, 2.5)), get_piece(np.arange(0, 10.5, 2.5))]
+    ds = stitch(pieces, 'lon', -10)
+    np.testing.assert_array_equal(ds.lon.values, np.arange(-10, 10.5, 2.5))
+    # the values move with their coordinates
+    np.testing.assert_array_equal(ds.t.values[0], np.arange(-10, 10.5, 2.5) % 360)
+    assert ds.lon.to_index().is_monotonic_increasing
+
+
+def test_stitch_antimeridian():
+    pieces = [get_piece(np.arange(170, 180.5, 5)), get_piece(np.arange(-180, -169.5, 5))]
+    ds = stitch(pieces, 'lon', 170)
+    np.testing.assert_array_equal(ds.lon.values, [170, 175, 180, 185, 190])
+
+
+def test_stitch_empty_piece():
+    # the range (178, 180) of a grid ending at 177.5
+    ds = stitch([get_piece([]), get_piece([-180, -177.5])], 'lon', 178)
+    np.testing.assert_array_equal(ds.lon.values, [180, 182.5])
+
+
+def test_stitch_single_piece():
+    ds = stitch([get_piece([340, 345, 350])], 'lon', -20)
+    np.testing.assert_array_equal(ds.lon.values, [-20, -15, -10])
+
+
+def test_to_request_frame():
+    ds = to_request_frame(get_piece([0, 90, 270, 359]), 'lon', -180)
+    np.testing.assert_array_equal(ds.lon.values, [0, 90, -90, -1])
+
+
+def test_get_stitched():
+    requests = []
+
+    def fetch(west, east):
+        requests.append((west, east))
+        return get_piece(np.arange(west, east + 0.5, 5))
+
+    ds = get_stitched(fetch, 170, 190, LON_FRAME['wave'], 'lon')
+    assert requests == [(170, 180), (-180, -170)]
+    np.testing.assert_array_equal(ds.lon.values, [170, 175, 180, 185, 190])
+
+
+def get_global_grid() -> xr.Dataset:
+    lons = np.round(np.arange(-180, 180, 0.05), 2)
+    times = pd.date_range('2021-01-01', periods=8, freq='3h')
+    return xr.Dataset({'VHM0': (('time', 'latitude', 'longitude'), np.tile(lons, (len(times), 5, 1)))},
+                      coords=dict(time=times, latitude=np.arange(-1, 1.5, 0.5), longitude=lons))
+
+
+@pytest.mark.parametrize('lon_lo, lon_hi', [(179.5, 179.95), (-179.95, -179.5), (179.8, 180.3)])
+def test_motu_box_crossing_the_antimeridian(monkeypatch, lon_lo, lon_hi):
+    grid = get_global_grid()
+    boxes = []
+
+    def try_get_data(url):
+        # the Motu subset of the box requested by the url
+        query = parse_qs(urlparse(url).query)
+        x_lo, x_hi = float(query['x_lo'][0]), float(query['x_hi'][0])
+        boxes.append((x_lo, x_hi))
+        return grid.sel(longitude=slice(x_lo, x_hi))
+
+    monkeypatch.setattr(weather, 'try_get_data', try_get_data)
+    monkeypatch.setattr(weather, 'get_first_cmems_datetime', lambda product, product_type: datetime(
+        2020, 1, 1, tzinfo=timezone.utc))
+    ds, _ = weather.get_global_wave(datetime(2021, 1, 1, 3), datetime(2021, 1, 1, 6), 0, 0.5, lon_lo, lon_hi,
+                                    variables=['VHM0'])
+    # every request is a box of the native range -180..180
+    assert all(-180 <= x_lo < x_hi <= 180 for x_lo, x_hi in boxes)
+    assert len(boxes) == 2
+    # the parts are stitched into the frame of the request, the values move with their longitudes
+    assert ds.longitude.to_index().is_monotonic_increasing
+    assert ds.longitude.values[0] <= lon_lo and ds.longitude.values[-1] >= lon_hi
+    np.testing.assert_allclose((ds.VHM0.values[0, 0] + 180) % 360, (ds.longitude.values + 180) % 360)
@@ -0,0 +1,228 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+import asyncio
+import threading
+import time
+
+import pytest
+from aiohttp import web
+
+from EnvironmentalData.fetch_engine import FetchEngine, FetchRequest
+from utilities import resilience
+
+BODY = b'0123456789' * 10000
+
+
+class StubServer:
+    """
+        Local aiohttp server on its own event loop thread, recording the requests and the maximal number of requests
+        served at once.
+    """
+
+    def __init__(self):
+        self.hits = dict()
+        self.active = 0
+        self.max_active = 0
+        # responses of /flaky/<name> before it succeeds
+        self.failures = dict()
+        self.resume = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def count(self, request: web.Request) -> None:
+        self.hits[request.path] = self.hits.get(request.path, 0) + 1
+
+    async def data(self, request: web.Request) -> web.Response:
+        self.count(request)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.05)
+            return web.Response(body=BODY + request.match_info['name'].encode())
+        finally:
+            self.active -= 1
+
+    async def slow(self, request: web.Request) -> web.StreamResponse:
+        # the first half of the body is sent before the test lets the response continue
+        self.count(request)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(BODY[:len(BODY) // 2])
+        await self.loop.run_in_executor(None, self.resume.wait, 5)
+        await response.write(BODY[len(BODY) // 2:])
+        await response.write_eof()
+        return response
+
+    async def flaky(self, request: web.Request) -> web.Response:
+        self.count(request)
+        name = request.match_info['name']
+        if self.failures.get(name, 0) > 0:
+            self.failures[name] -= 1
+            return web.Response(status=503)
+        return web.Response(body=BODY)
+
+    async def status(self, request: web.Request) -> web.Response:
+        self.count(request)
+        return web.Response(status=int(request.match_info['code']))
+
+    async def ticket(self, request: web.Request) -> web.Response:
+        self.count(request)
+        return web.Response(body=request.query.get('ticket', '').encode())
+
+    def start(self) -> str:
+        app = web.Application()
+        app.add_routes([web.get('/data/{name}', self.data), web.get('/slow', self.slow),
+                        web.get('/flaky/{name}', self.flaky), web.get('/status/{code}', self.status),
+                        web.get('/ticket', self.ticket)])
+        self.runner = web.AppRunner(app)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.runner.setup(), self.loop).result()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        asyncio.run_coroutine_threadsafe(site.start(), self.loop).result()
+        port = site._server.sockets[0].getsockname()[1]
+        return 'http://127.0.0.1:%d' % port
+
+    def stop(self) -> None:
+        self.resume.set()
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    stub.url = stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture(autouse=True)
+def endpoint():
+    # the retry and circuit breaker state of the local endpoint is shared by all requests to it
+    resilience._endpoints.pop('127.0.0.1', None)
+    resilience.configure('127.0.0.1', base_delay=0.01, max_delay=0.05)
+    yield resilience.get_endpoint('127.0.0.1')
+    resilience._endpoints.pop('127.0.0.1', None)
+
+
+def test_host_limit(server, tmp_path):
+    engine = FetchEngine(host_limits={'127.0.0.1': 2})
+    requests = [FetchRequest('%s/data/%d' % (server.url, i), Path(tmp_path, '%d.nc' % i)) for i in range(8)]
+    results = engine.run(requests)
+    assert results == [request.file_path for request in requests]
+    assert server.max_active == 2
+    for i, request in enumerate(requests):
+        assert request.file_path.read_bytes() == BODY + str(i).encode()
+    assert list(tmp_path.glob('*.part')) == []
+
+
+def test_part_file_renamed_when_complete(server, tmp_path):
+    request = FetchRequest(server.url + '/slow', Path(tmp_path, 'slow.nc'))
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(FetchEngine().run([request])))
+    thread.start()
+    part_path = Path(tmp_path, 'slow.nc.part')
+    deadline = time.monotonic() + 5
+    while not (part_path.exists() and part_path.stat().st_size > 0) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the response is streamed into the part file, the target appears only once the body is complete
+    assert part_path.exists()
+    assert not request.file_path.exists()
+    server.resume.set()
+    thread.join()
+    assert results == [request.file_path]
+    assert request.file_path.read_bytes() == BODY
+    assert not part_path.exists()
+
+
+def test_retry_transient_status(server, tmp_path):
+    server.failures['a'] = 2
+    request = FetchRequest(server.url + '/flaky/a', Path(tmp_path, 'a.nc'))
+    assert FetchEngine().run([request]) == [request.file_path]
+    assert server.hits['/flaky/a'] == 3
+    assert request.file_path.read_bytes() == BODY
+
+
+def test_error_results(server, tmp_path):
+    requests = [FetchRequest(server.url + '/status/404', Path(tmp_path, 'missing.nc')),
+                FetchRequest(server.url + '/data/ok', Path(tmp_path, 'ok.nc'))]
+    missing, ok = FetchEngine().run(requests)
+    # errors of the request itself are returned in place of the path and not retried
+    assert isinstance(missing, resilience.HTTPStatusError)
+    assert missing.status == 404
+    assert server.hits['/status/404'] == 1
+    assert ok == requests[1].file_path
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['ok.nc']
+
+
+def test_retries_exhausted(server, tmp_path, endpoint):
+    endpoint.max_attempts = 3
+    server.failures['b'] = 10
+    request = FetchRequest(server.url + '/flaky/b', Path(tmp_path, 'b.nc'))
+    result, = FetchEngine().run([request])
+    assert isinstance(result, resilience.HTTPStatusError)
+    assert result.status == 503
+    assert server.hits['/flaky/b'] == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_circuit_breaker(server, tmp_path, endpoint):
+    endpoint.max_attempts = 1
+    endpoint.failure_threshold = 2
+    server.failures['c'] = 10
+    engine = FetchEngine(host_limits={'127.0.0.1': 1})
+    results = engine.run([FetchRequest(server.url + '/flaky/c', Path(tmp_path, '%d.nc' % i)) for i in range(2)])
+    assert all(isinstance(result, resilience.HTTPStatusError) for result in results)
+    assert endpoint.opened_at is not None
+    # the open circuit rejects further requests without contacting the service
+    result, = engine.run([FetchRequest(server.url + '/flaky/c', Path(tmp_path, 'open.nc'))])
+    assert isinstance(result, resilience.CircuitOpenException)
+    assert resilience.get_circuit_open(result) is result
+    assert server.hits['/flaky/c'] == 2
+
+
+def test_connection_error(tmp_path, endpoint):
+    endpoint.max_attempts = 2
+    # a port nobody listens on
+    request = FetchRequest('http://127.0.0.1:9/data', Path(tmp_path, 'refused.nc'))
+    result, = FetchEngine().run([request])
+    assert resilience.is_transient(result)
+    assert endpoint.failures == 2
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_prepare(server, tmp_path):
+    request = FetchRequest(server.url + '/ticket', Path(tmp_path, 'ticket.nc'),
+                           prepare=lambda url: url + '?ticket=ST-1')
+    assert FetchEngine().run([request]) == [request.file_path]
+    assert request.file_path.read_bytes() == b'ST-1'
+
+
+def test_no_requests():
+    assert FetchEngine().run([]) == []
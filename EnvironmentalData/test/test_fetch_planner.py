@@ -0,0 +1,100 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+import numpy as np
+import pandas as pd
+
+from EnvironmentalData import fetch_planner
+
+COL_DICT = {'time': 'time', 'lat': 'lat', 'lon': 'lon'}
+VARIABLES = dict(gfs=['Temperature_surface'], wave=['VHM0', 'VTPK'], phy=[], wind=[])
+
+
+def get_track(days: int, rows_per_day: int = 24, speed: float = 0.05, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n = days * rows_per_day
+    times = pd.Timestamp('2021-01-01') + pd.to_timedelta(np.arange(n) * 24 / rows_per_day, unit='h')
+    df = pd.DataFrame({'time': times, 'lat': 30 + np.cumsum(rng.normal(0, speed, n)),
+                       'lon': -60 + np.cumsum(np.full(n, speed))})
+    # the planner does not depend on the order of the rows
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def assert_covers(plan, n_rows: int) -> None:
+    rows = np.concatenate([window.rows for window in plan.windows])
+    np.testing.assert_array_equal(np.sort(rows), np.arange(n_rows))
+
+
+def test_plan_track_covers_all_rows():
+    df = get_track(30)
+    plan = fetch_planner.plan_track(df, COL_DICT, VARIABLES)
+    assert_covers(plan, len(df))
+    # the windows follow the track and need less than its bbox
+    assert plan.expected_bytes < plan.single_box_bytes
+
+
+def test_plan_track_windows_in_time_order():
+    df = get_track(30)
+    plan = fetch_planner.plan_track(df, COL_DICT, VARIABLES)
+    for earlier, later in zip(plan.windows, plan.windows[1:]):
+        assert earlier.envelope['date_hi'] <= later.envelope['date_lo']
+
+
+def test_plan_track_stationary_track_is_one_window():
+    df = get_track(10, speed=0)
+    plan = fetch_planner.plan_track(df, COL_DICT, VARIABLES)
+    assert len(plan.windows) == 1
+
+
+def test_plan_track_budget():
+    df = get_track(30, speed=0.5)
+    unbounded = fetch_planner.plan_track(df, COL_DICT, VARIABLES)
+    max_bytes = max(window.expected_bytes for window in unbounded.windows) // 2
+    plan = fetch_planner.plan_track(df, COL_DICT, VARIABLES, max_bytes=max_bytes)
+    assert_covers(plan, len(df))
+    assert all(window.expected_bytes <= max_bytes for window in plan.windows)
+    assert len(plan.windows) > len(unbounded.windows)
+
+
+def test_plan_track_merges_cheap_windows():
+    # short windows are merged as long as this saves the request overhead
+    df = get_track(20, rows_per_day=4, speed=0.001)
+    plan = fetch_planner.plan_track(df, COL_DICT, VARIABLES)
+    assert len(plan.windows) < 20
+
+
+def test_estimate():
+    envelope = dict(date_lo=pd.Timestamp('2021-01-01'), date_hi=pd.Timestamp('2021-01-02'), lat_lo=10, lat_hi=12,
+                    lon_lo=-1, lon_hi=1)
+    products = fetch_planner.estimate(envelope, VARIABLES)
+    assert set(products) == {'gfs', 'wave'}
+    assert products['wave']['transfer_bytes'] == products['wave']['grid_cells'] * 2 * fetch_planner.BYTES_PER_VALUE
+    assert products['wave']['remote_requests'] == 1
+    # one request per GFS file of both days and the last file of the previous day, twice for the prime meridian
+    assert products['gfs']['remote_requests'] == (2 * fetch_planner.GFS_FILES_PER_DAY + 1) * 2
+    # the CMEMS products are requested twice for the antimeridian
+    envelope.update(lon_lo=179.5, lon_hi=180.5)
+    assert fetch_planner.estimate(envelope, VARIABLES)['wave']['remote_requests'] == 2
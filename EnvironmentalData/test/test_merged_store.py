@@ -0,0 +1,73 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from EnvironmentalData import merged_store
+
+
+def write_csv(path: Path, rows: list) -> Path:
+    pd.DataFrame(rows, columns=['BaseDateTime', 'LAT', 'LON', 'VHM0']).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def root(tmp_path) -> Path:
+    return Path(tmp_path, 'store')
+
+
+def test_add_and_query(tmp_path, root):
+    csv_path = write_csv(Path(tmp_path, 'AIS_2020_03_01.csv'), [['2020-03-01 00:00:00', 1., 1., 1.],
+                                                                 ['2020-03-01 01:00:00', 25., -95., 2.],
+                                                                 ['2020-04-01 00:00:00', 1., 1., 3.]])
+    assert merged_store.add_file(csv_path, root) == 3
+    assert len(merged_store.query(root)) == 3
+    res = merged_store.query(root, lat_lo=20, lon_hi=-90)
+    assert list(res.VHM0) == [2.]
+    res = merged_store.query(root, date_lo=pd.Timestamp('2020-03-15'), variables=['VHM0'])
+    assert list(res.VHM0) == [3.]
+    with pytest.raises(ValueError):
+        merged_store.query(root, variables=['unknown'])
+
+
+def test_add_file_again_replaces_all_partitions(tmp_path, root):
+    csv_path = write_csv(Path(tmp_path, 'AIS_2020_03_01.csv'), [['2020-03-01 00:00:00', 1., 1., 1.],
+                                                                 ['2020-04-01 00:00:00', 25., 1., 2.]])
+    other = write_csv(Path(tmp_path, 'AIS_2020_03_011.csv'), [['2020-03-01 00:00:00', 1., 1., 9.]])
+    merged_store.add_file(csv_path, root)
+    merged_store.add_file(other, root)
+    # the new run falls into one partition only, the rows of the old one must not be returned anymore
+    write_csv(csv_path, [['2020-03-01 00:00:00', 1., 1., 5.]])
+    merged_store.add_file(csv_path, root)
+    assert sorted(merged_store.query(root).VHM0) == [5., 9.]
+    assert len(merged_store.get_partition_files(root, 'AIS_2020_03_01')) == 1
+
+
+def test_query_empty_store(root):
+    assert len(merged_store.query(root)) == 0
@@ -0,0 +1,165 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from EnvironmentalData import weather
+from utilities import helper_functions
+
+COL_DICT = {'time': 'BaseDateTime', 'lat': 'LAT', 'lon': 'LON'}
+TIMES = pd.date_range('2021-01-01', periods=8, freq='3h')
+
+
+def get_wave() -> xr.Dataset:
+    lats, lons = np.arange(0, 3.), np.arange(0, 3.)
+    # the values encode the position of their grid cell
+    values = np.arange(len(TIMES))[:, None, None] * 100 + lats[None, :, None] * 10 + lons[None, None, :]
+    return xr.Dataset({'VHM0': (('time', 'latitude', 'longitude'), values),
+                       'VTPK': (('time', 'latitude', 'longitude'), -values)},
+                      coords=dict(time=TIMES, latitude=lats, longitude=lons))
+
+
+def get_points(times, lats, lons) -> tuple:
+    return xr.DataArray(pd.DatetimeIndex(times).values), xr.DataArray(lats), xr.DataArray(lons)
+
+
+def test_select_grid_points():
+    res = weather.select_grid_points(get_wave(), 'wave', *get_points(TIMES[[1, 2]], [0.9, 1.8], [0.1, 1.6]),
+                                     ['VHM0', 'VTPK'])
+    np.testing.assert_array_equal(res.VHM0.values, [110, 222])
+    np.testing.assert_array_equal(res.VTPK.values, [-110, -222])
+
+
+def test_select_grid_points_outside_of_the_grid():
+    res = weather.select_grid_points(get_wave(), 'wave', *get_points(TIMES[[0, 0]], [1., 5.], [1., 1.]), ['VHM0'])
+    assert res.VHM0.values[0] == 11
+    assert np.isnan(res.VHM0.values[1])
+
+
+def test_select_grid_points_missing_variables():
+    # variables missing in a subset are kept as NaN columns in the requested order
+    res = weather.select_grid_points(get_wave(), 'wave', *get_points(TIMES[:2], [0., 1.], [0., 1.]),
+                                     ['VMDR', 'VHM0'])
+    assert list(res.columns) == ['VMDR', 'VHM0']
+    assert res.VMDR.isna().all()
+    res = weather.select_grid_points(get_wave(), 'wave', *get_points(TIMES[:2], [0., 1.], [0., 1.]), ['VMDR'])
+    assert list(res.columns) == ['VMDR'] and len(res) == 2
+
+
+@pytest.mark.parametrize('sampling', weather.SAMPLING_MODES)
+def test_enrich_chunk_columns(sampling):
+    df = pd.DataFrame({'BaseDateTime': TIMES[[0, 3]], 'LAT': [0.5, 1.5], 'LON': [1., 1.2]})
+    res = weather.enrich_chunk(df, [(get_wave(), 'wave', ['VHM0', 'VMDR', 'VTPK'])], COL_DICT, sampling)
+    assert list(res.columns) == ['BaseDateTime', 'LAT', 'LON', 'VHM0', 'VMDR', 'VTPK']
+    assert res.VMDR.isna().all() and res.VHM0.notna().all()
+
+
+@pytest.fixture
+def track(tmp_path, monkeypatch) -> Path:
+    monkeypatch.setattr(helper_functions, 'CHUNK_SIZE', 2)
+    path = Path(tmp_path, 'track.csv')
+    pd.DataFrame({'BaseDateTime': TIMES[:6].strftime('%Y-%m-%d %H:%M:%S'), 'LAT': np.linspace(0, 2, 6),
+                  'LON': np.linspace(2, 0, 6)}).to_csv(path, index=False)
+    return path
+
+
+class FakeProducts:
+    """
+        Replacement of `weather.fetch_products` returning the wave test grid, failing at the call `fail_at`.
+    """
+
+    def __init__(self, fail_at: int = None):
+        self.calls = 0
+        self.fail_at = fail_at
+
+    def __call__(self, date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, gfs, wind, wave, phy) -> list:
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise ConnectionError('remote service down')
+        return [(get_wave(), 'wave', wave)]
+
+
+def append(in_path: Path, out_path: Path = None):
+    return weather.append_to_csv(in_path, out_path, gfs=[], wind=[], phy=[], wave=['VHM0'], sampling='nearest')
+
+
+def test_append_to_csv_resume(track, tmp_path, monkeypatch):
+    out_path = Path(tmp_path, 'merged.csv')
+    failing = FakeProducts(fail_at=2)
+    monkeypatch.setattr(weather, 'fetch_products', failing)
+    with pytest.raises(helper_functions.FileFailedException):
+        append(track, out_path)
+    assert not out_path.exists()
+    # the second run only enriches the chunks that were not completed
+    resumed = FakeProducts()
+    monkeypatch.setattr(weather, 'fetch_products', resumed)
+    append(track, out_path)
+    assert resumed.calls == 2
+    merged = pd.read_csv(out_path)
+    assert list(merged.columns) == ['BaseDateTime', 'LAT', 'LON', 'VHM0']
+    assert len(merged) == 6 and merged.VHM0.notna().all()
+    assert not Path(str(out_path) + '.parts').exists()
+
+
+def test_append_to_csv_without_output(track, tmp_path, monkeypatch):
+    monkeypatch.setattr(weather, 'fetch_products', FakeProducts())
+    append(track)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['track.csv']
+    # the original error is raised without an output path
+    monkeypatch.setattr(weather, 'fetch_products', FakeProducts(fail_at=1))
+    with pytest.raises(ConnectionError):
+        append(track)
+
+
+def test_iter_merged_chunks_fetches_window_by_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(helper_functions, 'CHUNK_SIZE', 4)
+    times = pd.date_range('2021-01-01', periods=8, freq='12h')
+    path = Path(tmp_path, 'track.csv')
+    pd.DataFrame({'BaseDateTime': times.strftime('%Y-%m-%d %H:%M:%S'), 'LAT': np.linspace(0, 2, 8),
+                  'LON': np.linspace(0, 20, 8)}).to_csv(path, index=False)
+    grid = xr.Dataset({'VHM0': (('time', 'latitude', 'longitude'), np.ones((len(times), 3, 21)))},
+                      coords=dict(time=times, latitude=np.arange(0, 3.), longitude=np.arange(0, 21.)))
+    events = []
+
+    def fetch_products(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, gfs, wind, wave, phy):
+        events.append(('fetch', date_lo, date_hi))
+        return [(grid, 'wave', wave)]
+
+    monkeypatch.setattr(weather, 'fetch_products', fetch_products)
+    monkeypatch.setattr(weather, 'close_products', lambda products: events.append(('close',)))
+    chunks = list(weather.iter_merged_chunks(path, COL_DICT, gfs=[], wind=[], wave=['VHM0'], phy=[],
+                                             sampling='nearest'))
+    assert [len(chunk) for chunk in chunks] == [4, 4]
+    assert all(chunk.VHM0.notna().all() for chunk in chunks)
+    # every window is released before the next one is retrieved and none covers the whole track
+    assert [event[0] for event in events] == ['fetch', 'close'] * (len(events) // 2)
+    assert len(events) // 2 >= 2
+    assert all(event[2] - event[1] < times[-1] - times[0] for event in events if event[0] == 'fetch')
@@ -24,28 +24,24 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
 # Public License for more details.
 #
+from collections import OrderedDict
 from datetime import datetime, timedelta, date, timezone
 from glob import glob
 from pathlib import Path
 import logging
-import time
 import traceback
 
-from motu_utils.utils_cas import authenticate_CAS_for_URL
-from motu_utils.utils_http import open_url
-from pydap.cas.get_cookies import setup_session
-from pydap.client import open_url as open_url_pydap
-from scipy.signal import argrelextrema
-from siphon import http_util
-from siphon.catalog import TDSCatalog
 from xarray.backends import NetCDF4DataStore
 import numpy as np
 import pandas as pd
 import requests.exceptions
 import xarray as xr
 
-from EnvironmentalData import config
-from utilities import helper_functions
+# the clients of the remote services (siphon for NCSS, pydap for OPeNDAP, aiohttp and motu_utils in fetch_engine) are
+# imported by the functions using them, so importing this module does not load every backend
+from EnvironmentalData import bbox, catalog_cache, config, fetch_planner, mirror_store
+from EnvironmentalData.assembler import TimeAssembler
+from utilities import helper_functions, resilience
 
 logger = logging.getLogger(__name__)
 
@@ -130,8 +126,12 @@ WAVE_VAR_LIST = get_parameter_list(WAVE_VAR_DICT)
 WIND_VAR_LIST = get_parameter_list(WIND_VAR_DICT)
 DAILY_PHY_VAR_LIST = get_parameter_list(DAILY_PHY_VAR_DICT)
 GFS_25_VAR_LIST = get_parameter_list(GFS_25_VAR_DICT)
+# the GFS 0.50 analysis uses the same variable names, the ones missing in a file are skipped
+GFS_50_VAR_LIST = GFS_25_VAR_LIST
+# the products are sampled at the points by interpolation or by the values of the nearest grid cells
+SAMPLING_MODES = ['linear', 'nearest']
 
-def get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
+def get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables: list = None):
     """
         retrieve all wave variables for a specific timestamp, latitude, longitude concidering
         the temporal resolution of the dataset to calculate interpolated values
@@ -173,27 +173,26 @@ def get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
     x_lo = float(lon_lo) - offset
     x_hi = float(lon_hi) + offset
 
-    if Path(VM_FOLDER).exists():
-        logger.debug('Accessing local data %s' % VM_FOLDER)
-        datasets_paths = []
-        for day in range((t_hi - t_lo).days + 1):
-            dt = t_lo + timedelta(day)
-            path = Path(VM_FOLDER, '%s' % dt.year, '%.2d' % dt.month, '%.2d' % dt.day, '*.nc')
-            dataset = list(glob(str(path)))
-            if len(dataset) > 0:
-                datasets_paths.append(sorted(dataset)[0])
-        ds_nc = xr.open_mfdataset(datasets_paths)
-        if ds_nc.coords['latitude'].values[0] == ds_nc.coords['latitude'].max():
-            tmp = y_lo
-            y_lo = y_hi
-            y_hi = tmp
-        if ds_nc.coords['longitude'].values[0] == ds_nc.coords['longitude'].max():
-            tmp = x_lo
-            x_lo = x_hi
-            x_hi = tmp
-        dataset = ds_nc.sel(longitude=slice(x_lo, x_hi), latitude=slice(y_lo, y_hi),
-                            time=slice(t_lo, t_hi)).compute()
-    else:
+    def fetch(x_lo, x_hi):
+        dataset = mirror_store.select('wave', t_lo, t_hi, y_lo, y_hi, x_lo, x_hi, variables)
+        if dataset is not None:
+            return dataset
+        if Path(VM_FOLDER).exists():
+            logger.debug('Accessing local data %s' % VM_FOLDER)
+            datasets_paths = []
+            for day in range((t_hi - t_lo).days + 1):
+                dt = t_lo + timedelta(day)
+                path = Path(VM_FOLDER, '%s' % dt.year, '%.2d' % dt.month, '%.2d' % dt.day, '*.nc')
+                dataset = list(glob(str(path)))
+                if len(dataset) > 0:
+                    datasets_paths.append(sorted(dataset)[0])
+            ds_nc = select_variables(xr.open_mfdataset(datasets_paths), variables)
+            lat_slice, lon_slice = slice(y_lo, y_hi), slice(x_lo, x_hi)
+            if ds_nc.coords['latitude'].values[0] == ds_nc.coords['latitude'].max():
+                lat_slice = slice(y_hi, y_lo)
+            if ds_nc.coords['longitude'].values[0] == ds_nc.coords['longitude'].max():
+                lon_slice = slice(x_hi, x_lo)
+            return ds_nc.sel(longitude=lon_slice, latitude=lat_slice, time=slice(t_lo, t_hi)).compute()
         url = base_url + '&service=' + service + '&product=' + product + '&x_lo={0}&x_hi={1}&y_lo={2}&y_hi={3}&t_lo={4}&t_hi={5}&mode=console'.format(
             x_lo, x_hi, y_lo,
             y_hi,
@@ -201,23 +200,45 @@ def get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
                 t_lo),
             helper_functions.date_to_str(
                 t_hi))
+        return try_get_data(url + get_variable_params(variables))
+
+    # a box crossing the antimeridian is retrieved in two parts
+    return bbox.get_stitched(fetch, x_lo, x_hi, bbox.LON_FRAME['wave'], 'longitude'), 'wave'
+
+
+def get_variable_params(variables: list = None) -> str:
+    """
+        Motu parameters restricting the download to `variables`, the product is downloaded completely without them.
+    """
+    return ''.join('&variable=%s' % var for var in variables or [])
+
 
-        dataset = try_get_data(url)
-    return dataset, 'wave'
+def select_variables(ds: xr.Dataset, variables: list = None) -> xr.Dataset:
+    """
+        Lazily restrict a local dataset to the available `variables`, all variables if `variables` is `None`.
+    """
+    if variables is None:
+        return ds
+    return ds[[var for var in variables if var in ds.data_vars]]
 
 
 def try_get_data(url):
+    from EnvironmentalData import fetch_engine
     try:
-        url_auth = authenticate_CAS_for_URL(url, config['UN_CMEMS'], config['PW_CMEMS'])
-        response = open_url(url_auth)
-        read_bytes = response.read()
-        return xr.open_dataset(read_bytes)
+        # the subset is streamed to disk instead of being read into memory
+        request = fetch_engine.motu_request(url, config['UN_CMEMS'], config['PW_CMEMS'])
+        dataset = fetch_engine.fetch_datasets([request])[0]
+        if isinstance(dataset, Exception):
+            raise dataset
+        return dataset
+    except resilience.CircuitOpenException as e:
+        raise e
     except Exception as e:
         logger.error(traceback.format_exc())
         raise ValueError('Error:', e, 'Request: ', url)
 
 
-def get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
+def get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables: list = None):
     logger.debug('obtaining WIND_GLO_WIND_L4_NRT_OBSERVATIONS dataset for DATE [%s, %s] LAT [%s, %s] LON [%s, %s]' % (
         str(date_lo), str(date_hi), str(lat_lo), str(lat_hi), str(lon_lo), str(lon_hi)))
 
@@ -257,26 +278,25 @@ def get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
     x_lo = float(lon_lo) - offset
     x_hi = float(lon_hi) + offset
 
-    if Path(VM_FOLDER).exists():
-        logger.debug('Accessing local data %s' % VM_FOLDER)
-        datasets_paths = []
-        for day in range((t_hi - t_lo).days + 1):
-            dt = t_lo + timedelta(day)
-            path = Path(VM_FOLDER, '%s' % dt.year, '%.2d' % dt.month, '%.2d' % dt.day, '*.nc')
-            dataset = list(glob(str(path)))
-            datasets_paths.extend(dataset)
-        ds_nc = xr.open_mfdataset(datasets_paths)
-        if ds_nc.coords['lat'].values[0] == ds_nc.coords['lat'].max():
-            tmp = y_lo
-            y_lo = y_hi
-            y_hi = tmp
-        if ds_nc.coords['lon'].values[0] == ds_nc.coords['lon'].max():
-            tmp = x_lo
-            x_lo = x_hi
-            x_hi = tmp
-        dataset = ds_nc.sel(lon=slice(x_lo, x_hi), lat=slice(y_lo, y_hi),
-                            time=slice(t_lo, t_hi)).compute()
-    else:
+    def fetch(x_lo, x_hi):
+        dataset = mirror_store.select('wind', t_lo, t_hi, y_lo, y_hi, x_lo, x_hi, variables)
+        if dataset is not None:
+            return dataset
+        if Path(VM_FOLDER).exists():
+            logger.debug('Accessing local data %s' % VM_FOLDER)
+            datasets_paths = []
+            for day in range((t_hi - t_lo).days + 1):
+                dt = t_lo + timedelta(day)
+                path = Path(VM_FOLDER, '%s' % dt.year, '%.2d' % dt.month, '%.2d' % dt.day, '*.nc')
+                dataset = list(glob(str(path)))
+                datasets_paths.extend(dataset)
+            ds_nc = select_variables(xr.open_mfdataset(datasets_paths), variables)
+            lat_slice, lon_slice = slice(y_lo, y_hi), slice(x_lo, x_hi)
+            if ds_nc.coords['lat'].values[0] == ds_nc.coords['lat'].max():
+                lat_slice = slice(y_hi, y_lo)
+            if ds_nc.coords['lon'].values[0] == ds_nc.coords['lon'].max():
+                lon_slice = slice(x_hi, x_lo)
+            return ds_nc.sel(lon=lon_slice, lat=lat_slice, time=slice(t_lo, t_hi)).compute()
         url = base_url + '&service=' + service + '&product=' + product + '&x_lo={0}&x_hi={1}&y_lo={2}&y_hi={3}&t_lo={4}&t_hi={5}&mode=console'.format(
             x_lo, x_hi, y_lo,
             y_hi,
@@ -284,50 +304,59 @@ def get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
                 t_lo),
             helper_functions.date_to_str(
                 t_hi))
-        dataset = try_get_data(url)
-    return dataset, 'wind'
+        return try_get_data(url + get_variable_params(variables))
+
+    # a box crossing the antimeridian is retrieved in two parts
+    return bbox.get_stitched(fetch, x_lo, x_hi, bbox.LON_FRAME['wind'], 'lon'), 'wind'
+
+
+def get_assembled(assembler: TimeAssembler, product: str) -> xr.Dataset:
+    dataset = assembler.to_dataset()
+    if dataset is None:
+        raise ValueError('No %s data is available for the requested time range' % product)
+    if len(assembler.missing) > 0:
+        logger.warning('%s dataset is missing the time steps %s' % (
+            product, ', '.join(str(time) for time in assembler.missing)))
+    return dataset
 
 
-def get_GFS_prognoses(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi):
+def get_GFS_prognoses(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, variables: list = None):
+    from siphon.ncss import NCSS
+    var_list = GFS_25_VAR_LIST if variables is None else variables
     offset = 0.25
-    # check meridian bbox for GFS 50
-    if lon_lo < 0 < lon_hi:
-        logger.debug(
-            'GFS prognoses dataset: splitting the requested bbox over the prime meridian into LON [%s, %s] and LON [%s, %s]' % (
-                lon_lo, -0.25, 0, lon_hi))
-        a = get_GFS_prognoses(start_date, end_date, lat_lo, lat_hi, lon_lo, -0.25)
-        b = get_GFS_prognoses(start_date, end_date, lat_lo, lat_hi, 0, lon_hi)
-        return xr.combine_by_coords([a, b], coords=['longitude'], combine_attrs='override',
-                                    compat='override').squeeze()
-
-    end_cat = TDSCatalog(
-        catalog_url="http://thredds.ucar.edu/thredds/catalog/grib/NCEP/GFS/"
-                    "Global_0p25deg/catalog.xml?dataset=grib/NCEP/GFS/Global_0p25deg/Best"
-    )
-    ds_subset = end_cat.datasets[0].subset()
-    query = ds_subset.query().lonlat_box(north=lat_hi + offset, south=lat_lo - offset,
-                                         east=lon_hi + offset,
-                                         west=lon_lo - offset).time_range(end_date + timedelta(
-        hours=0 if end_date == start_date + timedelta(days=1) else 3), end_date + timedelta(
-        days=1)).variables(*GFS_25_VAR_LIST)
+    datasets = catalog_cache.get_datasets('ucar', "http://thredds.ucar.edu/thredds/catalog/grib/NCEP/GFS/"
+                                                  "Global_0p25deg/catalog.xml?dataset=grib/NCEP/GFS/Global_0p25deg/Best")
+    ds_subset = resilience.call('ucar', NCSS, catalog_cache.get_ncss_url(next(iter(datasets.values()))))
     try:
-        data = ds_subset.get_data(query)
-        x_arr = xr.open_dataset(NetCDF4DataStore(data))[GFS_25_VAR_LIST]
-        if 'time1' in list(x_arr.coords):
-            x_arr = x_arr.rename({'time1': 'time', 'reftime1': 'reftime'})
-        if 'height_above_ground' in list(x_arr.coords):
-            x_arr = x_arr.rename({'height_above_ground': 'height_above_ground4'})
-        if 'lon' in list(x_arr.coords):
-            x_arr = x_arr.rename({'lon': 'longitude'})
-        if 'lat' in list(x_arr.coords):
-            x_arr = x_arr.rename({'lat': 'latitude'})
-        return x_arr
+        pieces = []
+        # one request per contiguous range of the native 0..360 grid
+        for west, east in bbox.get_lon_ranges(lon_lo - offset, lon_hi + offset, bbox.LON_FRAME['gfs']):
+            query = ds_subset.query().lonlat_box(north=lat_hi + offset, south=lat_lo - offset, east=east,
+                                                 west=west).time_range(end_date + timedelta(
+                hours=0 if end_date == start_date + timedelta(days=1) else 3), end_date + timedelta(
+                days=1)).variables(*var_list)
+            data = resilience.call('ucar', ds_subset.get_data, query)
+            x_arr = xr.open_dataset(NetCDF4DataStore(data))[var_list]
+            if 'time1' in list(x_arr.coords):
+                x_arr = x_arr.rename({'time1': 'time', 'reftime1': 'reftime'})
+            if 'height_above_ground' in list(x_arr.coords):
+                x_arr = x_arr.rename({'height_above_ground': 'height_above_ground4'})
+            if 'lon' in list(x_arr.coords):
+                x_arr = x_arr.rename({'lon': 'longitude'})
+            if 'lat' in list(x_arr.coords):
+                x_arr = x_arr.rename({'lat': 'latitude'})
+            pieces.append(x_arr)
+        return bbox.stitch(pieces, 'longitude', lon_lo - offset)
     except Exception as e:
-        print(e)
+        if isinstance(e, resilience.CircuitOpenException):
+            raise e
         logger.warning(traceback.format_exc())
 
 
-def get_GFS(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
+def get_GFS(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables: list = None):
+    from siphon import http_util
+    from siphon.ncss import NCSSQuery
+    from EnvironmentalData import fetch_engine
     logger.debug('obtaining GFS 0.25 dataset for DATE [%s, %s] LAT [%s, %s] LON [%s, %s]' % (
         str(date_lo), str(date_hi), str(lat_lo), str(lat_hi), str(lon_lo), str(lon_hi)))
     start_date = datetime(date_lo.year, date_lo.month, date_lo.day) - timedelta(days=1)
@@ -335,140 +364,131 @@ def get_GFS(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
     # consider the supported time range
     if datetime(2004, 3, 1) < start_date < datetime(2015, 1, 15):
         logger.debug('GFS 0.25 DATASET is out of supported range')
-        return get_GFS_50(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi)
+        return get_GFS_50(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables)
     elif datetime(2004, 3, 1) > start_date:
         raise ValueError('Out of Range values')
 
     # offset according to the dataset resolution
     offset = 0.25
-    x_arr_list = []
+    var_list = GFS_25_VAR_LIST if variables is None else variables
+    dataset = mirror_store.select('gfs', start_date, datetime(date_hi.year, date_hi.month, date_hi.day) + timedelta(
+        days=1), lat_lo - offset, lat_hi + offset, lon_lo - offset, lon_hi + offset, variables)
+    if dataset is not None:
+        return dataset, 'gfs'
+    # the fragments of the 3 hourly forecasts are written into the time axis from midnight to midnight as they arrive
+    assembler = TimeAssembler(pd.date_range(start_date + timedelta(days=1),
+                                            datetime(date_hi.year, date_hi.month, date_hi.day) + timedelta(days=1),
+                                            freq='%dH' % fetch_planner.PRODUCT_GRID['gfs'][1]))
     base_url = 'https://thredds.rda.ucar.edu/thredds/catalog/files/g/ds084.1'
     # calculate a day prior for midnight interpolation
-    http_util.session_manager.set_session_options(auth=(config['UN_RDA'], config['PW_RDA']))
+    auth = (config['UN_RDA'], config['PW_RDA'])
+    http_util.session_manager.set_session_options(auth=auth)
+    # one query per contiguous range of the native 0..360 grid
+    queries = [NCSSQuery().lonlat_box(north=lat_hi + offset, south=lat_lo - offset, east=east,
+                                      west=west).variables(*var_list)
+               for west, east in bbox.get_lon_ranges(lon_lo - offset, lon_hi + offset, bbox.LON_FRAME['gfs'])]
+    # subset requests of the archive files by name, fetched concurrently
+    subset_requests = dict()
     if (start_date + timedelta(days=4)).date() < date.today():
         try:
-            start_cat = TDSCatalog(
-                "%s/%s/%s%.2d%.2d/catalog.xml" % (
-                    base_url, start_date.year, start_date.year, start_date.month, start_date.day))
+            start_datasets = catalog_cache.get_datasets('rda', "%s/%s/%s%.2d%.2d/catalog.xml" % (
+                base_url, start_date.year, start_date.year, start_date.month, start_date.day), start_date)
             name = 'gfs.0p25.%s%.2d%.2d18.f006.grib2' % (start_date.year, start_date.month, start_date.day)
-            ds_subset = start_cat.datasets[name].subset()
-            query = ds_subset.query().lonlat_box(north=lat_hi + offset, south=lat_lo - offset, east=lon_hi + offset,
-                                                 west=lon_lo - offset).variables(*GFS_25_VAR_LIST)
+            subset_requests[name] = [fetch_engine.ncss_request(catalog_cache.get_ncss_url(start_datasets[name]),
+                                                               query, auth=auth) for query in queries]
         except Exception as e:
             # TODO be MORE specific regarding the errors to swallow and to not catch nearly all exceptions
             # e.g. do not catch ConnectionError
             # Exceptions are swallowed because the temporal offset at the beginning can result in ignorable errors
-            if isinstance(e, requests.exceptions.ConnectionError):
+            if isinstance(e, (requests.exceptions.ConnectionError, resilience.CircuitOpenException)):
                 raise e
             else:
                 logger.warning('grib2 file error: {}'.format(str(e)))
-        try:
-            data = ds_subset.get_data(query)
-            x_arr = xr.open_dataset(NetCDF4DataStore(data)).drop_dims(['bounds_dim'])[GFS_25_VAR_LIST]
-            if 'time1' in list(x_arr.coords):
-                x_arr = x_arr.rename({'time1': 'time'})
-            x_arr_list.append(x_arr)
-        except Exception as e:
-            logger.warning('Exception thrown: {}'.format(str(e)))
-            logger.warning('dataset %s is not complete' % name)
     for day in range((date_hi - date_lo).days + 1):
         end_date = datetime(date_lo.year, date_lo.month, date_lo.day) + timedelta(days=day)
 
         # check for real time dataset (today - 4) - 17 in the future
         if (end_date + timedelta(days=4)).date() > date.today():
-            x_arr_list.append(get_GFS_prognoses(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi))
+            x_arr = get_GFS_prognoses(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, variables)
+            if x_arr is not None:
+                assembler.add(x_arr)
         else:
-            end_cat = TDSCatalog(
-                "%s/%s/%s%.2d%.2d/catalog.xml" % (base_url, end_date.year, end_date.year, end_date.month, end_date.day))
+            end_datasets = catalog_cache.get_datasets('rda', "%s/%s/%s%.2d%.2d/catalog.xml" % (
+                base_url, end_date.year, end_date.year, end_date.month, end_date.day), end_date)
             for cycle in [0, 6, 12, 18]:
                 for hours in [3, 6]:
                     name = 'gfs.0p25.%s%.2d%.2d%.2d.f0%.2d.grib2' % (
                         end_date.year, end_date.month, end_date.day, cycle, hours)
-                    if name in list(end_cat.datasets):
-                        ds_subset = end_cat.datasets[name].subset()
-                        query = ds_subset.query().lonlat_box(north=lat_hi + offset,
-                                                             south=lat_lo - offset,
-                                                             east=lon_hi + offset,
-                                                             west=lon_lo - offset).variables(*GFS_25_VAR_LIST)
-                        try:
-                            data = ds_subset.get_data(query)
-                            x_arr = xr.open_dataset(NetCDF4DataStore(data)).drop_dims(['bounds_dim'])[GFS_25_VAR_LIST]
-                            if 'time1' in list(x_arr.coords):
-                                x_arr = x_arr.rename({'time1': 'time'})
-                            x_arr_list.append(x_arr)
-                        except Exception as e:
-                            logger.warning('Exception thrown: {}'.format(str(e)))
-                            logger.warning('dataset %s is not complete' % name)
+                    if name in end_datasets:
+                        subset_requests[name] = [fetch_engine.ncss_request(
+                            catalog_cache.get_ncss_url(end_datasets[name]), query, auth=auth) for query in queries]
                     else:
                         logger.warning('dataset %s is not found' % name)
-    combined_xarrays = xr.combine_by_coords(x_arr_list,
-                                            coords=['time', 'reftime'],
-                                            combine_attrs='override',
-                                            compat='override').squeeze().dropna('time')
-    combined_xarrays['longitude'] = xr.where(combined_xarrays['longitude'] > 180, combined_xarrays['longitude'] - 360,
-                                             combined_xarrays['longitude'])
-    return combined_xarrays, 'gfs'
-
-
-def get_GFS_50(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
-    # check meridian bbox for GFS 50
-    if lon_lo < 0 and lon_hi > 0:
-        logger.debug(
-            'GFS 0.50 dataset: splitting the requested bbox over the prime meridian into LON [%s, %s] and LON [%s, %s]' % (
-                lon_lo, -0.5, 0, lon_hi))
-        a = get_GFS_50(date_lo, date_hi, lat_lo, lat_hi, lon_lo, -0.5)[0]
-        b = get_GFS_50(date_lo, date_hi, lat_lo, lat_hi, 0, lon_hi)[0]
-        return xr.combine_by_coords([a, b], coords=['lon'], combine_attrs='override',
-                                    compat='override').squeeze(), 'gfs_50'
+    results = iter(fetch_engine.fetch_datasets([request for name_requests in subset_requests.values()
+                                                for request in name_requests]))
+    for name, name_requests in subset_requests.items():
+        pieces = [next(results) for _ in name_requests]
+        try:
+            for result in pieces:
+                if isinstance(result, Exception):
+                    raise result
+            x_arr = bbox.stitch([result.drop_dims(['bounds_dim'])[var_list] for result in pieces], 'longitude',
+                                lon_lo - offset)
+            if 'time1' in list(x_arr.coords):
+                x_arr = x_arr.rename({'time1': 'time'})
+            assembler.add(x_arr)
+        except Exception as e:
+            if isinstance(e, resilience.CircuitOpenException):
+                raise e
+            logger.warning('Exception thrown: {}'.format(str(e)))
+            logger.warning('dataset %s is not complete' % name)
+    return get_assembled(assembler, 'GFS 0.25'), 'gfs'
+
+
+def get_GFS_50(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables: list = None):
+    from siphon.ncss import NCSS
     logger.debug('obtaining GFS 0.50 dataset for DATE [%s, %s] LAT [%s, %s] LON [%s, %s]' % (
         str(date_lo), str(date_hi), str(lat_lo), str(lat_hi), str(lon_lo), str(lon_hi)))
     base_url = 'https://www.ncei.noaa.gov/thredds/model-gfs-g4-anl-files-old/'
     # offset according to the dataset resolution
     offset = 0.5
-    x_arr_list = []
+    var_list = GFS_50_VAR_LIST if variables is None else variables
     start_date = datetime(date_lo.year, date_lo.month, date_lo.day) - timedelta(days=1)
-    for day in range((date_hi - start_date).days + 1):
+    dataset = mirror_store.select('gfs_50', start_date, datetime(date_hi.year, date_hi.month, date_hi.day) + timedelta(
+        days=1), lat_lo - offset, lat_hi + offset, lon_lo - offset, lon_hi + offset, variables)
+    if dataset is not None:
+        return dataset, 'gfs_50'
+    lon_ranges = bbox.get_lon_ranges(lon_lo - offset, lon_hi + offset, bbox.LON_FRAME['gfs_50'])
+    days = (date_hi - start_date).days + 1
+    assembler = TimeAssembler(pd.date_range(start_date + timedelta(hours=3), start_date + timedelta(days=days),
+                                            freq='3H'))
+    for day in range(days):
         dt = datetime(start_date.year, start_date.month, start_date.day) + timedelta(days=day)
-        catalog = TDSCatalog(
-            '%s%s%.2d/%s%.2d%.2d/catalog.xml' % (base_url, dt.year, dt.month, dt.year, dt.month, dt.day))
+        datasets = catalog_cache.get_datasets('ncei', '%s%s%.2d/%s%.2d%.2d/catalog.xml' % (
+            base_url, dt.year, dt.month, dt.year, dt.month, dt.day), dt)
         for hour in [3, 6]:
             for cycle in [0, 6, 12, 18]:
-                attempts = 0
-                while True:
-                    try:
-                        attempts += 1
-                        name = 'gfsanl_4_%s%.2d%.2d_%.2d00_00%s.grb2' % (dt.year, dt.month, dt.day, cycle, hour)
-                        if name in list(catalog.datasets):
-                            ds_subset = catalog.datasets[name].subset()
-                            query = ds_subset.query().lonlat_box(north=lat_hi + offset, south=lat_lo - offset,
-                                                                 east=lon_hi + offset, west=lon_lo - offset).variables(
-                                *GFS_50_VAR_LIST)
-
-                            data = ds_subset.get_data(query)
-                            x_arr = xr.open_dataset(NetCDF4DataStore(data))
-                            if 'time1' in list(x_arr.coords):
-                                x_arr = x_arr.rename({'time1': 'time'})
-                            x_arr_list.append(x_arr)
-                        else:
-                            logger.warning('dataset %s is not found' % name)
-                        break
-                    except Exception as e:
-                        logger.error(traceback.format_exc())
-                        logger.error(str(e))
-                        logger.error('Filename %s - Failed connecting to GFS Server - number of attempts: %d' % (
-                            name, attempts))
-                        if attempts > 15:
-                            raise e
-                        time.sleep(2)
-
-    combined_xarrays = xr.combine_by_coords(x_arr_list, coords=['time'], combine_attrs='override',
-                                            compat='override').squeeze()
-    combined_xarrays['lon'] = xr.where(combined_xarrays['lon'] > 180, combined_xarrays['lon'] - 360,
-                                       combined_xarrays['lon'])
-    return combined_xarrays, 'gfs_50'
-
-
-def get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
+                name = 'gfsanl_4_%s%.2d%.2d_%.2d00_00%s.grb2' % (dt.year, dt.month, dt.day, cycle, hour)
+                if name in datasets:
+                    ds_subset = resilience.call('ncei', NCSS, catalog_cache.get_ncss_url(datasets[name]))
+                    pieces = []
+                    for west, east in lon_ranges:
+                        query = ds_subset.query().lonlat_box(north=lat_hi + offset, south=lat_lo - offset,
+                                                             east=east, west=west).variables(
+                            *[v for v in var_list if v in ds_subset.variables])
+                        data = resilience.call('ncei', ds_subset.get_data, query)
+                        pieces.append(xr.open_dataset(NetCDF4DataStore(data)))
+                    x_arr = bbox.stitch(pieces, 'lon', lon_lo - offset)
+                    if 'time1' in list(x_arr.coords):
+                        x_arr = x_arr.rename({'time1': 'time'})
+                    assembler.add(x_arr)
+                else:
+                    logger.warning('dataset %s is not found' % name)
+
+    return get_assembled(assembler, 'GFS 0.50'), 'gfs_50'
+
+
+def get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables: list = None):
     logger.debug('obtaining GLOBAL_ANALYSIS_FORECAST_PHY Daily dataset for DATE [%s, %s] LAT [%s, %s] LON [%s, %s]' % (
         str(date_lo), str(date_hi), str(lat_lo), str(lat_hi), str(lon_lo), str(lon_hi)))
     # offset according to the dataset resolution
@@ -503,30 +523,30 @@ def get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
     z_hi = 0.50
     z_lo = 0.49
 
-    if Path(VM_FOLDER).exists():
-        logger.debug('Accessing local data %s' % VM_FOLDER)
-        datasets_paths = []
-        for day in range((t_hi - t_lo).days + 1):
-            dt = t_lo + timedelta(day)
-            path = Path(VM_FOLDER, '%s' % dt.year, '%.2d' % dt.month, '%.2d' % dt.day,
-                        'mercatorpsy4v3r1_gl12_mean_%s%.2d%.2d_*.nc' % (dt.year, dt.month, dt.day) if NRT_FLAG
-                        else 'mercatorglorys12v1_gl12_mean_%s%.2d%.2d_*.nc' % (dt.year, dt.month, dt.day))
-            dataset = list(glob(str(path)))
-            if len(dataset) > 0:
-                datasets_paths.append(dataset[0])
-
-        ds_nc = xr.open_mfdataset(datasets_paths)
-        if ds_nc.coords['latitude'].values[0] == ds_nc.coords['latitude'].max():
-            tmp = y_lo
-            y_lo = y_hi
-            y_hi = tmp
-        if ds_nc.coords['longitude'].values[0] == ds_nc.coords['longitude'].max():
-            tmp = x_lo
-            x_lo = x_hi
-            x_hi = tmp
-        dataset = ds_nc.sel(longitude=slice(x_lo, x_hi), latitude=slice(y_lo, y_hi),
-                            time=slice(t_lo, t_hi), depth=slice(z_lo, z_hi)).compute()
-    else:
+    def fetch(x_lo, x_hi):
+        dataset = mirror_store.select('phy', t_lo, t_hi, y_lo, y_hi, x_lo, x_hi, variables)
+        if dataset is not None:
+            return dataset
+        if Path(VM_FOLDER).exists():
+            logger.debug('Accessing local data %s' % VM_FOLDER)
+            datasets_paths = []
+            for day in range((t_hi - t_lo).days + 1):
+                dt = t_lo + timedelta(day)
+                path = Path(VM_FOLDER, '%s' % dt.year, '%.2d' % dt.month, '%.2d' % dt.day,
+                            'mercatorpsy4v3r1_gl12_mean_%s%.2d%.2d_*.nc' % (dt.year, dt.month, dt.day) if NRT_FLAG
+                            else 'mercatorglorys12v1_gl12_mean_%s%.2d%.2d_*.nc' % (dt.year, dt.month, dt.day))
+                dataset = list(glob(str(path)))
+                if len(dataset) > 0:
+                    datasets_paths.append(dataset[0])
+
+            ds_nc = select_variables(xr.open_mfdataset(datasets_paths), variables)
+            lat_slice, lon_slice = slice(y_lo, y_hi), slice(x_lo, x_hi)
+            if ds_nc.coords['latitude'].values[0] == ds_nc.coords['latitude'].max():
+                lat_slice = slice(y_hi, y_lo)
+            if ds_nc.coords['longitude'].values[0] == ds_nc.coords['longitude'].max():
+                lon_slice = slice(x_hi, x_lo)
+            return ds_nc.sel(longitude=lon_slice, latitude=lat_slice, time=slice(t_lo, t_hi),
+                             depth=slice(z_lo, z_hi)).compute()
         url = base_url + '&service=' + service + '&product=' + product + \
               '&x_lo={0}&x_hi={1}&y_lo={2}&y_hi={3}&t_lo={4}&t_hi={5}&z_lo={6}&z_hi={7}&mode=console'.format(x_lo, x_hi,
                                                                                                              y_lo,
@@ -537,8 +557,10 @@ def get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi):
                                                                                                              helper_functions.date_to_str(
                                                                                                                  t_hi),
                                                                                                              z_lo, z_hi)
-        dataset = try_get_data(url)
-    return dataset, 'phy'
+        return try_get_data(url + get_variable_params(variables))
+
+    # a box crossing the antimeridian is retrieved in two parts
+    return bbox.get_stitched(fetch, x_lo, x_hi, bbox.LON_FRAME['phy'], 'longitude'), 'phy'
 
 
 def interpolate(ds: xr.Dataset, ds_name: str, time_points: xr.DataArray, lat_points: xr.DataArray,
@@ -560,7 +582,6 @@ def interpolate(ds: xr.Dataset, ds_name: str, time_points: xr.DataArray, lat_poi
     elif ds_name == 'phy':
         res = ds.interp(longitude=lon_points, latitude=lat_points, time=time_points).to_dataframe()[
             var_list].reset_index(drop=True)
-    ds.close()
     return res
 
 
@@ -587,8 +608,180 @@ def select_grid_point(ds: xr.Dataset, ds_name: str, time_point: datetime, lat_po
     return res.fillna(value=0)
 
 
-def append_to_csv(in_path: Path, out_path: Path = None, gfs=None, wind=None, wave=None, phy=None, col_dict={},
-                  metadata={}, webapp=False):
+def get_nearest_indexer(index: pd.Index, points) -> np.ndarray:
+    """
+        Positions of the grid cells of `index` nearest to `points`, -1 for points outside of the grid like `interp`
+        does not extrapolate either.
+    """
+    points = pd.Index(np.asarray(points))
+    positions = index.get_indexer(points, method='nearest')
+    positions[np.asarray((points < index.min()) | (points > index.max()))] = -1
+    return positions
+
+
+def select_grid_points(ds: xr.Dataset, ds_name: str, time_points: xr.DataArray, lat_points: xr.DataArray,
+                       lon_points: xr.DataArray, var_list: list) -> pd.DataFrame:
+    """
+        Values of the grid points nearest to all points at once, the points share the dimension of `time_points`.
+        Further dimensions like depth or height levels are reduced to their first level. Points outside of the grid
+        and variables missing in `ds` are NaN, so the columns are always `var_list`.
+    """
+    lon_name, lat_name = ('lon', 'lat') if ds_name in ['wind', 'gfs_50'] else ('longitude', 'latitude')
+    available = [var for var in var_list if var in ds.data_vars]
+    positions = {name: get_nearest_indexer(ds.indexes[name], points.values)
+                 for name, points in [(lon_name, lon_points), (lat_name, lat_points), ('time', time_points)]}
+    outside = np.any([pos < 0 for pos in positions.values()], axis=0)
+    values = dict()
+    if len(available) > 0:
+        res = ds[available].isel({name: xr.DataArray(np.maximum(pos, 0), dims=time_points.dims)
+                                  for name, pos in positions.items()})
+        res = res.isel({dim: 0 for dim in res.dims if dim not in time_points.dims})
+        values = {var: np.where(outside, np.nan, res[var].values) for var in available}
+    return pd.DataFrame(values, index=pd.RangeIndex(len(outside))).reindex(columns=var_list)
+
+
+def regrid_nearest(ds: xr.Dataset, coords: dict) -> xr.Dataset:
+    """
+        Values of the grid cells of `ds` nearest to the regular grid given by 1-d `coords` by dimension name, the
+        cheap counterpart of `ds.interp(**coords)`.
+    """
+    positions = {name: get_nearest_indexer(ds.indexes[name], values) for name, values in coords.items()}
+    res = ds.isel({name: np.maximum(pos, 0) for name, pos in positions.items()})
+    res = res.assign_coords({name: np.asarray(values) for name, values in coords.items()})
+    for name, pos in positions.items():
+        if (pos < 0).any():
+            res = res.where(xr.DataArray(pos >= 0, dims=name))
+    return res
+
+
+def check_extent(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi) -> None:
+    """
+        Raise a `ValueError` if the space-time box exceeds the limits of the web application.
+    """
+    if (date_hi - date_lo).days > 30:
+        error = 'Exceeds temporal extent: requested days exceed 30 days: {} - {} = {} days'.format(
+            date_hi, date_lo, (date_hi - date_lo).days
+        )
+        logger.debug(error)
+        raise ValueError(error)
+
+    if abs(lat_hi - lat_lo) + abs(lon_hi - lon_lo) > 150:
+        error = 'Exceeds spatial extent: longitude and latitude extent combined exceed 150°: ' + \
+                'Lat: {}° - {}° = {}°; Lon: {}° - {}° = {}°; {}° + {}° = {}°'.format(
+                    lat_hi, lat_lo, abs(lat_hi - lat_lo),
+                    lon_hi, lon_lo, abs(lon_hi - lon_lo),
+                    abs(lat_hi - lat_lo), abs(lon_hi - lon_lo), abs(lon_hi - lon_lo) + abs(lat_hi - lat_lo)
+                )
+        logger.debug(error)
+        raise ValueError(error)
+
+
+def get_envelope(df: pd.DataFrame, col_dict: dict) -> dict:
+    """
+        Space-time box covering all rows of `df` as keyword arguments for the product functions.
+    """
+    return dict(date_lo=df[col_dict['time']].min(), date_hi=df[col_dict['time']].max(),
+                lat_lo=df[col_dict['lat']].min(), lat_hi=df[col_dict['lat']].max(),
+                lon_lo=df[col_dict['lon']].min(), lon_hi=df[col_dict['lon']].max())
+
+
+def merge_envelopes(a: dict, b: dict) -> dict:
+    if a is None:
+        return b
+    return {key: min(a[key], b[key]) if key.endswith('_lo') else max(a[key], b[key]) for key in a}
+
+
+def scan_envelope(csv_file, col_dict: dict) -> dict:
+    """
+        Read only the time and position columns of `csv_file` chunk by chunk and return the space-time box of all rows.
+    """
+    envelope = None
+    for df_chunk in pd.read_csv(csv_file, usecols=[col_dict['time'], col_dict['lat'], col_dict['lon']],
+                                parse_dates=[col_dict['time']], date_parser=helper_functions.str_to_date,
+                                chunksize=helper_functions.CHUNK_SIZE):
+        if len(df_chunk) > 0:
+            envelope = merge_envelopes(envelope, get_envelope(df_chunk, col_dict))
+    return envelope
+
+
+def fetch_products(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, gfs, wind, wave, phy) -> list:
+    """
+        Retrieve every product with at least one requested variable once for the given space-time box.
+
+        :returns: list of `(dataset, dataset name, requested variables)` in the column order of the merged output
+    """
+    products = []
+    for get_product, var_list in [(get_GFS, gfs), (get_global_phy_daily, phy), (get_global_wind, wind),
+                                  (get_global_wave, wave)]:
+        if len(var_list) > 0:
+            # only the requested variables are transferred and decoded
+            ds, ds_name = get_product(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi, variables=var_list)
+            products.append((ds.load(), ds_name, var_list))
+    return products
+
+
+def close_products(products: list) -> None:
+    for ds, _, _ in products:
+        ds.close()
+
+
+def enrich_chunk(df_chunk: pd.DataFrame, products: list, col_dict: dict, sampling: str = 'linear') -> pd.DataFrame:
+    """
+        Append the values of all `products` to the rows of `df_chunk`, interpolated or of the nearest grid cells
+        according to `sampling`. Every product adds the columns of all its requested variables in both modes,
+        variables missing in a subset are NaN, so all chunks of a file have the same columns.
+    """
+    sample = select_grid_points if sampling == 'nearest' else interpolate
+    # query parameters
+    time_points = xr.DataArray(list(df_chunk[col_dict['time']].values))
+    lat_points = xr.DataArray(list(df_chunk[col_dict['lat']].values))
+    lon_points = xr.DataArray(list(df_chunk[col_dict['lon']].values))
+    df_chunk = df_chunk.reset_index(drop=True)
+    return pd.concat([df_chunk] + [sample(ds, ds_name, time_points, lat_points, lon_points,
+                                          [var for var in var_list if var in ds.data_vars]).reindex(columns=var_list)
+                                   for ds, ds_name, var_list in products], axis=1)
+
+
+def iter_merged_chunks(in_file, col_dict: dict, gfs, wind, wave, phy, sampling: str = 'linear'):
+    """
+        Yield the rows of the csv `in_file` chunk by chunk, each enriched window by window like by `enrich_track`, so
+        only the subsets of one window are held at a time.
+    """
+    for df_chunk in pd.read_csv(in_file, parse_dates=[col_dict['time']], date_parser=helper_functions.str_to_date,
+                                chunksize=helper_functions.CHUNK_SIZE):
+        # remove index column if exists
+        df_chunk.drop(['Unnamed: 0'], axis=1, errors='ignore', inplace=True)
+        yield enrich_track(df_chunk, col_dict, gfs, wind, wave, phy,
+                           max_bytes=helper_functions.get_subset_budget('merge'), sampling=sampling)
+
+
+def enrich_track(df_chunk: pd.DataFrame, col_dict: dict, gfs, wind, wave, phy, max_bytes: int = None,
+                 sampling: str = 'linear') -> pd.DataFrame:
+    """
+        Enrich the rows of `df_chunk` window by window according to the fetch plan of the track. The subsets of a
+        window are expected to stay below `max_bytes` as far as the track can be split in time.
+    """
+    df_chunk.reset_index(drop=True, inplace=True)
+    plan = fetch_planner.plan_track(df_chunk, col_dict, dict(gfs=gfs, phy=phy, wind=wind, wave=wave),
+                                    max_bytes=max_bytes)
+    logger.debug('Fetch plan for %d rows: %s' % (len(df_chunk), str(plan)))
+    enriched = []
+    for window in plan.windows:
+        products = fetch_products(**window.envelope, gfs=gfs, wind=wind, wave=wave, phy=phy)
+        try:
+            df_window = enrich_chunk(df_chunk.iloc[window.rows], products, col_dict, sampling)
+        finally:
+            close_products(products)
+        # restore the original order of the rows
+        df_window.index = window.rows
+        enriched.append(df_window)
+    return pd.concat(enriched).sort_index()
+
+
+def get_merge_settings(gfs=None, wind=None, wave=None, phy=None, col_dict={}) -> tuple:
+    """
+        Column names and requested variables of step 3 with the defaults for MarineCadastre files.
+    """
     if not bool(col_dict):
         # default for marinecadastre
         col_dict = {'time': 'BaseDateTime', 'lat': 'LAT', 'lon': 'LON'}
@@ -600,117 +793,198 @@ def append_to_csv(in_path: Path, out_path: Path = None, gfs=None, wind=None, wav
         wind = WIND_VAR_LIST
     if gfs is None:
         gfs = GFS_25_VAR_LIST
-    logger.debug('append_environment_data in file %s' % in_path)
+    return col_dict, dict(gfs=gfs, wind=wind, wave=wave, phy=phy)
 
-    header = True
-    try:
-        for df_chunk in pd.read_csv(in_path, parse_dates=[col_dict['time']], date_parser=helper_functions.str_to_date,
-                                    chunksize=helper_functions.CHUNK_SIZE):
-            if len(df_chunk) > 1:
 
-                # date_lo = df_chunk[col_dict['time']].min()
-                # date_hi = df_chunk[col_dict['time']].max()
+def read_merge_chunks(in_path: Path, col_dict: dict, variables: dict, checkpoint, **read_csv_kwargs):
+    """
+        Enumerate the chunks of the csv `in_path` in the chunk size of `checkpoint`, which is determined on the first
+        run and kept to resume it. Without a checkpoint, the chunk size is determined for this run only.
+    """
+    dtype = {col_dict['lat']: 'float32', col_dict['lon']: 'float32'}
+    chunk_size = checkpoint.chunk_size if checkpoint is not None else None
+    if chunk_size is None:
+        # the interpolated values are added as float64 columns
+        chunk_size = helper_functions.get_csv_chunk_size(
+            in_path, 'merge', extra_bytes_per_row=8 * sum(len(var_list) for var_list in variables.values()),
+            dtype=dtype)
+        if checkpoint is not None:
+            checkpoint.chunk_size = chunk_size
+    return enumerate(pd.read_csv(in_path, parse_dates=[col_dict['time']], date_parser=helper_functions.str_to_date,
+                                 dtype=dtype, chunksize=chunk_size, **read_csv_kwargs))
+
 
+def append_to_csv(in_path: Path, out_path: Path = None, gfs=None, wind=None, wave=None, phy=None, col_dict={},
+                  metadata={}, webapp=False, sampling='linear', check=None):
+    """
+        Enrich the rows of `in_path` chunk by chunk and write them to `out_path`. `check` is called before a chunk
+        is committed and before `out_path` is written, see `helper_functions.ChunkCheckpoint`.
+    """
+    col_dict, variables = get_merge_settings(gfs, wind, wave, phy, col_dict)
+    logger.debug('append_environment_data in file %s' % in_path)
+
+    # the enriched chunks are kept across failed runs, except for requests of the web application
+    checkpoint = None
+    if out_path:
+        checkpoint = helper_functions.ChunkCheckpoint(in_path, out_path, check, col_dict=col_dict,
+                                                      sampling=sampling, **variables)
+    try:
+        for index, df_chunk in read_merge_chunks(in_path, col_dict, variables, checkpoint):
+            if len(df_chunk) > 1 and (checkpoint is None or not checkpoint.is_done(index)):
                 # remove index column if exists
                 df_chunk.drop(['Unnamed: 0'], axis=1, errors='ignore', inplace=True)
 
-                # if (date_hi - date_lo).days > 15:
-                #     # discrete requests according to local maxima of the 1d data
-                #     lon_maxima = argrelextrema(np.array(df_chunk[col_dict['lon']].values), np.greater,
-                #                                order=(len(df_chunk) // 12))[0]
-                #     lat_maxima = argrelextrema(np.array(df_chunk[col_dict['lat']].values), np.greater,
-                #                                order=(len(df_chunk) // 12))[0]
-                #     local_maxima_index = lat_maxima if len(lat_maxima) > len(lon_maxima) else lon_maxima
-                # else:
-                #     df_chunk.sort_values([col_dict['lat']], inplace=True)
-                #     local_maxima_index = argrelextrema(np.array(df_chunk[col_dict['lon']].values), np.greater,
-                #                                        order=(len(df_chunk) // 12))[0]
-                # start_index = 0
-                # for index in list(local_maxima_index) + [-1]:
-                df_chunk_sub = df_chunk
-                # start_index = index
-
-                # retrieve the data for each file once
-                lat_hi = df_chunk_sub[col_dict['lat']].max()
-                lon_hi = df_chunk_sub[col_dict['lon']].max()
-
-                lat_lo = df_chunk_sub[col_dict['lat']].min()
-                lon_lo = df_chunk_sub[col_dict['lon']].min()
-
-                date_lo = df_chunk_sub[col_dict['time']].min()
-                date_hi = df_chunk_sub[col_dict['time']].max()
-
-                if webapp and (date_hi - date_lo).days > 30:
-                    error = 'Exceeds temporal extent: requested days exceed 30 days: {} - {} = {} days'.format(
-                        date_hi, date_lo, (date_hi - date_lo).days
-                    )
-                    logger.debug(error)
-                    raise ValueError(error)
-
-                if webapp and abs(lat_hi - lat_lo) + abs(lon_hi - lon_lo) > 150:
-                    error = 'Exceeds spatial extent: longitude and latitude extent combined exceed 150°: ' + \
-                            'Lat: {}° - {}° = {}°; Lon: {}° - {}° = {}°; {}° + {}° = {}°'.format(
-                                lat_hi, lat_lo, abs(lat_hi - lat_lo),
-                                lon_hi, lon_lo, abs(lon_hi - lon_lo),
-                                abs(lat_hi - lat_lo), abs(lon_hi - lon_lo), abs(lon_hi - lon_lo) + abs(lat_hi - lat_lo)
-                            )
-                    logger.debug(error)
-                    raise ValueError(error)
-
-                # query parameters
-                time_points = xr.DataArray(list(df_chunk_sub[col_dict['time']].values))
-                lat_points = xr.DataArray(list(df_chunk_sub[col_dict['lat']].values))
-                lon_points = xr.DataArray(list(df_chunk_sub[col_dict['lon']].values))
-                df_chunk_sub.reset_index(drop=True, inplace=True)
-                if len(gfs) > 0:
-                    df_chunk_sub = pd.concat(
-                        [df_chunk_sub,
-                         interpolate(*get_GFS(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi), time_points,
-                                     lat_points, lon_points, gfs)], axis=1)
-
-                if len(phy) > 0:
-                    df_chunk_sub = pd.concat(
-                        [df_chunk_sub,
-                         interpolate(*get_global_phy_daily(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi),
-                                     time_points,
-                                     lat_points, lon_points, phy)], axis=1)
-
-                if len(wind) > 0:
-                    df_chunk_sub = pd.concat(
-                        [df_chunk_sub,
-                         interpolate(*get_global_wind(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi),
-                                     time_points,
-                                     lat_points,
-                                     lon_points, wind)], axis=1)
-
-                if len(wave) > 0:
-                    df_chunk_sub = pd.concat(
-                        [df_chunk_sub,
-                         interpolate(*get_global_wave(date_lo, date_hi, lat_lo, lat_hi, lon_lo, lon_hi),
-                                     time_points,
-                                     lat_points,
-                                     lon_points, wave)], axis=1)
-                if bool(metadata) and header:
-                    helper_functions.create_csv(df_chunk_sub, metadata, out_path, index=False)
-                    header = False
-                else:
-                    df_chunk_sub.to_csv(out_path, mode='a', header=header, index=False)
-                    header = False  # TODO add metadata later
+                if webapp:
+                    check_extent(**get_envelope(df_chunk, col_dict))
+
+                df_chunk = enrich_track(df_chunk, col_dict, **variables,
+                                        max_bytes=helper_functions.get_subset_budget('merge'), sampling=sampling)
+                if checkpoint is not None:
+                    checkpoint.commit(index, df_chunk)
+        if checkpoint is not None:
+            checkpoint.finish(metadata)
+    except helper_functions.OwnershipLost as e:
+        # the output and the parts belong to another process
+        raise e
     except Exception as e:
         # discard the file in case of an error to resume later properly
         if out_path:
+            if webapp:
+                checkpoint.discard()
             out_path.unlink(missing_ok=True)
             raise helper_functions.FileFailedException(out_path.name, e)
         raise e
 
 
+# number of retrieved tiles kept by the tile scheduler if no memory budget is set for stage merge
+TILE_CACHE_SIZE = 32
+
+
+class TileScheduler:
+    """
+        Enrich several files with the tiles of a global plan, so the subsets of days and regions shared by the files
+        are retrieved once instead of once per file. The retrieved tiles are kept until no chunk of the remaining files
+        falls into them or the cache exceeds the subset budget of stage merge.
+    """
+
+    def __init__(self, files: list, gfs=None, wind=None, wave=None, phy=None, col_dict={}, sampling='linear'):
+        self.col_dict, self.variables = get_merge_settings(gfs, wind, wave, phy, col_dict)
+        self.sampling = sampling
+        self.plan = fetch_planner.TilePlan(self.variables)
+        self.paths = dict()
+        self.checkpoints = dict()
+        self.products = OrderedDict()
+        self.fetched = 0
+        for in_path, out_path in files:
+            # only the time and position columns are read to plan the tiles
+            try:
+                checkpoint = None
+                if out_path:
+                    checkpoint = helper_functions.ChunkCheckpoint(in_path, out_path, col_dict=self.col_dict,
+                                                                  sampling=sampling, **self.variables)
+                for index, df_chunk in read_merge_chunks(in_path, self.col_dict, self.variables, checkpoint,
+                                                         usecols=list(self.col_dict.values())):
+                    if len(df_chunk) > 1 and (checkpoint is None or not checkpoint.is_done(index)):
+                        self.plan.add(in_path.name, index, df_chunk, self.col_dict)
+            except Exception as e:
+                raise helper_functions.FileFailedException(in_path.name, e)
+            self.paths[in_path.name] = (in_path, out_path)
+            self.checkpoints[in_path.name] = checkpoint
+        logger.info('Tile plan of step 3: %s' % str(self.plan))
+
+    @property
+    def files(self) -> list:
+        """
+            `(in_path, out_path)` of the files, files without chunks left first and the others by their first timestamp.
+        """
+        names = [name for name in self.paths if name not in self.plan.first_times] + self.plan.files()
+        return [self.paths[name] for name in names]
+
+    def get_products(self, tile: tuple) -> list:
+        if tile in self.products:
+            self.products.move_to_end(tile)
+            return self.products[tile]
+        products = fetch_products(**self.plan.envelopes[tile], **self.variables)
+        self.fetched += 1
+        self.products[tile] = products
+        budget = helper_functions.get_subset_budget('merge')
+        while len(self.products) > 1 and (len(self.products) > TILE_CACHE_SIZE if budget is None else
+                                          sum(ds.nbytes for p in self.products.values() for ds, _, _ in p) > budget):
+            evicted, evicted_products = self.products.popitem(last=False)
+            logger.debug('Evicting tile %s referenced by %d chunk(s)' % (str(evicted),
+                                                                          self.plan.references[evicted]))
+            close_products(evicted_products)
+        return products
+
+    def release(self, name: str, index: int = None) -> None:
+        for tile in self.plan.release(name, index):
+            products = self.products.pop(tile, None)
+            if products is not None:
+                close_products(products)
+
+    def skip(self, in_path: Path) -> None:
+        """
+            Release the tiles of a file that is not enriched by this scheduler, e.g. if another worker claimed it.
+        """
+        self.release(in_path.name)
+
+    def append_to_csv(self, in_path: Path, metadata={}, check=None) -> None:
+        """
+            Enrich the file `in_path` with the planned tiles, `check` is called before a chunk is committed and before
+            the output is written, see `helper_functions.ChunkCheckpoint`.
+        """
+        name = in_path.name
+        in_path, out_path = self.paths[name]
+        checkpoint = self.checkpoints[name]
+        if checkpoint is not None:
+            checkpoint.check = check
+        logger.debug('append_environment_data in file %s' % in_path)
+        try:
+            for index, df_chunk in read_merge_chunks(in_path, self.col_dict, self.variables, checkpoint):
+                if (name, index) not in self.plan.chunks:
+                    continue
+                # remove index column if exists
+                df_chunk.drop(['Unnamed: 0'], axis=1, errors='ignore', inplace=True)
+                df_chunk.reset_index(drop=True, inplace=True)
+                enriched = []
+                for tile, rows in fetch_planner.get_tiles(df_chunk, self.col_dict).items():
+                    df_tile = enrich_chunk(df_chunk.iloc[rows], self.get_products(tile), self.col_dict,
+                                           self.sampling)
+                    # restore the original order of the rows
+                    df_tile.index = rows
+                    enriched.append(df_tile)
+                if checkpoint is not None:
+                    checkpoint.commit(index, pd.concat(enriched).sort_index())
+                self.release(name, index)
+            if checkpoint is not None:
+                checkpoint.finish(metadata)
+        except helper_functions.OwnershipLost as e:
+            # the output and the parts belong to another process
+            self.release(name)
+            raise e
+        except Exception as e:
+            # discard the file in case of an error to resume later properly
+            if out_path:
+                out_path.unlink(missing_ok=True)
+                raise helper_functions.FileFailedException(out_path.name, e)
+            raise e
+
+    def close(self) -> None:
+        logger.info('Retrieved %d tile(s) for %d planned tile(s)' % (self.fetched, len(self.plan.envelopes)))
+        for products in self.products.values():
+            close_products(products)
+        self.products.clear()
+
+
 def get_cmems_data_store(product, product_type, username, password):
+    from pydap.cas.get_cookies import setup_session
+    from pydap.client import open_url as open_url_pydap
     cas_url = 'https://cmems-cas.cls.fr/cas/login'
-    session = setup_session(cas_url, username, password)
+    session = resilience.call('cmems', setup_session, cas_url, username, password)
     session.cookies.set("CASTGC", session.cookies.get_dict()['CASTGC'])
     url = f'https://{product_type}.cmems-du.eu/thredds/dodsC/{product}'
     try:
-        data_store = xr.backends.PydapDataStore(open_url_pydap(url, session=session))
+        data_store = xr.backends.PydapDataStore(resilience.call('cmems', open_url_pydap, url, session=session))
     except Exception as err:
         raise err
     return data_store
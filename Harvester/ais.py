@@ -24,21 +24,28 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
 # Public License for more details.
 #
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
+import json
 import logging
 import os
+import re
 import shutil
+import time
 import typing
 import warnings
 import zipfile
 
 from bs4 import BeautifulSoup
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import requests
 
-from utilities.helper_functions import FileFailedException, Failed_Files, check_dir, CHUNK_SIZE
+from job_state import JobState
+from utilities import resilience
+from utilities.helper_functions import FileFailedException, Failed_Files, check_dir, CHUNK_SIZE, bytes_per_row, \
+    get_chunk_size, get_csv_chunk_size
 
 pd.options.mode.chained_assignment = None
 
@@ -47,59 +54,170 @@ logger = logging.getLogger(__name__)
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
-def get_files_list(year: int, exclude_to_resume: typing.List[str]) -> typing.List[str]:
-    # url link to data
-    url = "https://coast.noaa.gov/htdata/CMSP/AISDataHandler/{0}/".format(year)
+AIS_URL = "https://coast.noaa.gov/htdata/CMSP/AISDataHandler/{0}/"
 
-    # request the html file
-    html_text = requests.get(url).text
+# manifests of the NOAA index per year: ETag, Last-Modified and the listed zip files with their sizes. A manifest is
+# revalidated once per run, later calls are answered from here.
+_manifests = dict()
+# sizes of the listed zip files per year by their href
+_file_sizes = dict()
+# directory to persist the manifests between runs, see `set_manifest_dir`
+MANIFEST_DIR = None
 
-    # parse the html
-    soup = BeautifulSoup(html_text, 'html.parser')
 
-    # iterate over the <a> tags and save each in a list
+def set_manifest_dir(manifest_dir: Path) -> None:
+    global MANIFEST_DIR
+    MANIFEST_DIR = manifest_dir
+    MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def parse_size(size: str) -> typing.Optional[int]:
+    """
+        Parse a size of the index listing like `512`, `98K` or `1.2G` into bytes.
+    """
+    match = re.fullmatch(r'([0-9.]+)\s*([KMG]?)', size.strip())
+    if match is None:
+        return None
+    return int(float(match.group(1)) * {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}[match.group(2)])
+
+
+def parse_index(html_text: str) -> typing.List[dict]:
+    """
+        List the zip files of the NOAA index page with their size if the listing contains it.
+    """
+    soup = BeautifulSoup(html_text, 'html.parser')
     files = []
     for a in soup.find_all('a', href=True):
         if a.text and a.text.endswith('zip'):
             name = a['href'].split('.')[0]
             name = name.split('/')[-1] if len(name.split('/')) > 1 else name
-            if name + '.csv' in exclude_to_resume + Failed_Files or name + '.gdb' in exclude_to_resume + Failed_Files or name + '.zip' in Failed_Files:
-                continue
-            files.append(a['href'])
+            # the size is the last column of a table row or the last token after the link in a <pre> listing
+            row = a.find_parent('tr')
+            columns = [td.get_text() for td in row.find_all('td')] if row is not None else \
+                str(a.next_sibling or '').split()
+            size = next((parse_size(column) for column in reversed(columns) if parse_size(column) is not None), None)
+            files.append(dict(href=a['href'], name=name, size=size))
+    return files
+
+
+def _manifest_path(year: int) -> typing.Optional[Path]:
+    return Path(MANIFEST_DIR, 'ais_index_%s.json' % year) if MANIFEST_DIR is not None else None
+
+
+def get_manifest(year: int) -> typing.List[dict]:
+    """
+        Files listed in the NOAA index of `year`. The index is revalidated on the first call of a run and only
+        downloaded and parsed again if it changed according to its ETag or Last-Modified header.
+    """
+    if year in _manifests:
+        return _manifests[year]['files']
+    manifest = None
+    if _manifest_path(year) is not None and _manifest_path(year).exists():
+        with open(_manifest_path(year)) as f:
+            manifest = json.load(f)
+    headers = dict()
+    if manifest is not None:
+        if manifest.get('etag'):
+            headers['If-None-Match'] = manifest['etag']
+        if manifest.get('last_modified'):
+            headers['If-Modified-Since'] = manifest['last_modified']
+    try:
+        response = resilience.call('noaa', requests.get, AIS_URL.format(year), headers=headers, timeout=60)
+        if response.status_code == 304 and manifest is not None:
+            logger.debug('AIS index of year %s is unchanged' % year)
+        else:
+            response.raise_for_status()
+            manifest = dict(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'),
+                            files=parse_index(response.text))
+            if _manifest_path(year) is not None:
+                with open(_manifest_path(year), 'w') as f:
+                    json.dump(manifest, f)
+    except (requests.exceptions.RequestException, resilience.CircuitOpenException) as e:
+        if manifest is None:
+            raise e
+        logger.warning('Could not revalidate AIS index of year %s, using the cached one: %s' % (year, str(e)))
+    _file_sizes[year] = {f['href']: f['size'] for f in manifest['files']}
+    _manifests[year] = manifest
+    return manifest['files']
+
+
+def prefetch_manifests(years: typing.List[int]) -> None:
+    """
+        Retrieve the manifests of all `years` in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=min(len(years), 8)) as executor:
+        futures = {executor.submit(get_manifest, year): year for year in years}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning('Could not retrieve AIS index of year %s: %s' % (futures[future], str(e)))
+
+
+def get_file_size(year: int, zipped_file_name: str) -> typing.Optional[int]:
+    if year not in _file_sizes:
+        get_manifest(year)
+    return _file_sizes[year].get(zipped_file_name)
+
+
+def get_files_list(year: int, exclude_to_resume: typing.List[str]) -> typing.List[str]:
+    excluded = set(exclude_to_resume) | set(Failed_Files)
+    failed = set(Failed_Files)
+    files = []
+    for f in get_manifest(year):
+        if f['name'] + '.csv' in excluded or f['name'] + '.gdb' in excluded or f['name'] + '.zip' in failed:
+            continue
+        files.append(f['href'])
     return files
 
 
 def chunkify_gdb(gdb_file: Path, file_path: Path) -> None:
-    end = CHUNK_SIZE
+    # geopandas is only needed for the File Geodatabases of the years before 2015
+    import geopandas as gpd
+    chunk_size = CHUNK_SIZE
     start = 0
     header = True
     while True:
-        gdf_chunk = gpd.read_file(gdb_file, rows=slice(start, end))
+        gdf_chunk = gpd.read_file(gdb_file, rows=slice(start, start + chunk_size))
         if len(gdf_chunk) == 0: break
         gdf_chunk['LON'] = gdf_chunk.geometry.apply(lambda point: point.x)
         gdf_chunk['LAT'] = gdf_chunk.geometry.apply(lambda point: point.y)
         gdf_chunk.drop(columns=['geometry'], inplace=True)
         gdf_chunk.to_csv(file_path, mode='a', header=header, index=False)
-        start = end
-        end += CHUNK_SIZE
+        start += len(gdf_chunk)
+        if header:
+            # size the following chunks according to the memory used by the first one
+            chunk_size = get_chunk_size('download', bytes_per_row(gdf_chunk))
         header = False
 
 
 def download_file(zipped_file_name: str, download_dir: Path, year: int) -> str:
     try:
         # url link to data
-        url = "https://coast.noaa.gov/htdata/CMSP/AISDataHandler/{0}/".format(year)
-        logger.info('downloading AIS file: %s' % zipped_file_name)
+        url = AIS_URL.format(year)
+        size = get_file_size(year, zipped_file_name)
+        logger.info('downloading AIS file: %s (%s)' % (
+            zipped_file_name, '%.1f MB' % (size / 2 ** 20) if size is not None else 'unknown size'))
 
         # download zip file using wget with url and file name
-        with requests.get(os.path.join(url, zipped_file_name), stream=True) as req:
-            req.raise_for_status()
-            zipped_file_name = zipped_file_name.split('/')[-1] if len(
-                zipped_file_name.split('/')) > 1 else zipped_file_name
-            with open(zipped_file_name, "wb") as handle:
-                for chunk in req.iter_content(chunk_size=8192):
-                    handle.write(chunk)
-                handle.close()
+        remote_file_name = zipped_file_name
+        zipped_file_name = zipped_file_name.split('/')[-1] if len(
+            zipped_file_name.split('/')) > 1 else zipped_file_name
+
+        def download():
+            with requests.get(os.path.join(url, remote_file_name), stream=True, timeout=60) as req:
+                req.raise_for_status()
+                downloaded, progress_step = 0, 100 * 2 ** 20
+                with open(zipped_file_name, "wb") as handle:
+                    for chunk in req.iter_content(chunk_size=8192):
+                        handle.write(chunk)
+                        downloaded += len(chunk)
+                        if size and downloaded // progress_step > (downloaded - len(chunk)) // progress_step:
+                            logger.debug('downloaded %d%% of %s' % (
+                                min(100, downloaded * 100 // size), zipped_file_name))
+
+        # a broken transfer is downloaded again from the start
+        resilience.call('noaa', download)
         # extract each zip file into output directory then delete it
         with zipfile.ZipFile(zipped_file_name, 'r') as zip_ref:
             for f in zip_ref.infolist():
@@ -128,48 +246,112 @@ def download_file(zipped_file_name: str, download_dir: Path, year: int) -> str:
         raise FileFailedException(zipped_file_name, e)
 
 
-def download_year_AIS(year: int, download_dir: Path) -> None:
+def get_csv_name(zipped_file_name: str) -> str:
+    return zipped_file_name.split('/')[-1].split('.')[0] + '.csv'
+
+
+def download_year_AIS(year: int, download_dir: Path, state: JobState = None) -> None:
     # create a directory named after the given year if not exist
     resume_download = []
-    if download_dir.exists():
+    if state is not None:
+        resume_download = list(state.files(year, 'download'))
+    elif download_dir.exists():
         resume_download = check_dir(download_dir)
     files = get_files_list(year, exclude_to_resume=resume_download)
+    if state is not None:
+        files = [f for f in files if state.in_shard(get_csv_name(f))]
+    sizes = [get_file_size(year, zip_file_name) or 0 for zip_file_name in files]
+    logger.info('Downloading %d AIS files of year %s with %.1f GB' % (len(files), year, sum(sizes) / 2 ** 30))
     #  download
-    for zip_file_name in files:
-        download_file(zip_file_name, download_dir, year)
+    downloaded = 0
+    started = time.time()
+    for zip_file_name, size in zip(files, sizes):
+        file_name = get_csv_name(zip_file_name)
+        with state.lease(year, file_name) if state else nullcontext(True) as claimed:
+            if not claimed or (state and state.is_done(year, file_name, 'download')):
+                continue
+            with state.track(year, file_name, 'download', Path(download_dir, file_name)) if state else nullcontext():
+                download_file(zip_file_name, download_dir, year)
+        downloaded += size
+        if downloaded > 0 and sum(sizes) > 0:
+            remaining = (time.time() - started) * (sum(sizes) - downloaded) / downloaded
+            logger.info('Downloaded %.1f of %.1f GB of year %s, approx. %d minutes remaining' % (
+                downloaded / 2 ** 30, sum(sizes) / 2 ** 30, year, remaining // 60))
+
 
+# columns not needed after subsampling, they are not read at all
+DROPPED_COLUMNS = ['Unnamed: 0', 'MMSI', 'VesselName', 'CallSign', 'Cargo', 'TranscieverClass', 'ReceiverType',
+                   'ReceiverID']
 
-def rm_sec(date: datetime) -> datetime:
-    return date.replace(second=0, tzinfo=None)
+# dtypes of the MarineCadastre formats, columns not listed are read with the default dtypes:
+# - 'gdb': 2009 - 2014, file geodatabases converted to csv by `chunkify_gdb`, numeric status codes, no vessel type
+# - 'csv': since 2015, textual status until 2017, numeric status codes since 2018
+AIS_SCHEMAS = {
+    'gdb': {'LAT': 'float32', 'LON': 'float32', 'SOG': 'float32', 'COG': 'float32', 'Heading': 'float32',
+            'ROT': 'float32', 'VoyageID': 'float32', 'Status': 'category'},
+    'csv': {'LAT': 'float32', 'LON': 'float32', 'SOG': 'float32', 'COG': 'float32', 'Heading': 'float32',
+            'VesselType': 'float32', 'Length': 'float32', 'Width': 'float32', 'Draft': 'float32',
+            'IMO': 'category', 'Status': 'category'},
+}
+
+# `Status` values of vessels under way in the textual and numeric (read as category) formats
+UNDER_WAY_STATUS = ['under way using engine', 'under way sailing', '0', '8', '0.0', '8.0']
+UNDEFINED_STATUS = ['undefind']
+VESSEL_TYPES = [1003, 1004, 1016]
+VESSEL_TYPE_RANGE = (70, 89)
+
+
+def get_ais_schema(file_name: str) -> dict:
+    year = re.search(r'(20[0-9]{2})', str(file_name))
+    return AIS_SCHEMAS['gdb' if year is not None and int(year.group(1)) <= 2014 else 'csv']
+
+
+def category_mask(series: pd.Series, values: list) -> np.ndarray:
+    """
+        Vectorized `series.isin(values)` for a categorical series evaluated once per category.
+    """
+    # code -1 (missing value) selects the appended False
+    allowed = np.append(series.cat.categories.astype(str).isin(values), False)
+    return allowed[series.cat.codes.values]
+
+
+def filter_under_way(df_chunk: pd.DataFrame) -> pd.DataFrame:
+    if 'Status' not in df_chunk.columns:
+        return df_chunk
+    sog = df_chunk['SOG'].values
+    under_way = category_mask(df_chunk['Status'], UNDER_WAY_STATUS)
+    if 'VesselType' in df_chunk.columns:
+        vessel_type = df_chunk['VesselType'].values
+        under_way |= (sog > 7) & category_mask(df_chunk['Status'], UNDEFINED_STATUS)
+        under_way &= np.isin(vessel_type, VESSEL_TYPES) | (
+                (vessel_type >= VESSEL_TYPE_RANGE[0]) & (vessel_type <= VESSEL_TYPE_RANGE[1]))
+    return df_chunk[under_way & (sog > 3)]
 
 
 def subsample_file(file_name, download_dir, filtered_dir, min_time_interval) -> str:
     logging.info("Subsampling  %s " % str(file_name))
     header = True
+    file_path = Path(filtered_dir, str(file_name))
 
     try:
-        for df_chunk in pd.read_csv(Path(download_dir, file_name), chunksize=CHUNK_SIZE):
-            df_chunk = df_chunk.drop(['Unnamed: 0', 'MMSI', 'VesselName', 'CallSign', 'Cargo', 'TranscieverClass',
-                                      'ReceiverType', 'ReceiverID'], axis=1, errors='ignore')
+        file_columns = pd.read_csv(Path(download_dir, file_name), nrows=0).columns
+        read_csv_kwargs = dict(usecols=[col for col in file_columns if col not in DROPPED_COLUMNS],
+                               dtype=get_ais_schema(file_name))
+        for df_chunk in pd.read_csv(Path(download_dir, file_name), **read_csv_kwargs,
+                                    chunksize=get_csv_chunk_size(Path(download_dir, file_name), 'subsample',
+                                                                 **read_csv_kwargs)):
             df_chunk = df_chunk.dropna()
-            df_chunk['SOG'] = pd.to_numeric(df_chunk['SOG'])
-            if 'VesselType' in df_chunk.columns:
-                df_chunk = df_chunk.query(
-                    '(Status == "under way using engine" or Status == "under way sailing" or  Status == 8 or  Status == 0 or (SOG > 7 &  Status == "undefind")) & (VesselType == 1003 or VesselType == 1004 or VesselType == 1016 or 89 >= VesselType >= 70) & SOG > 3')
-            elif 'Status' in df_chunk.columns:
-                df_chunk = df_chunk.query(
-                    '(Status == "under way using engine" or Status == "under way sailing" or  Status == 8 or  Status == 0) & SOG > 3')
+            df_chunk = filter_under_way(df_chunk)
 
             df_chunk = df_chunk.drop(['Status'], axis=1, errors='ignore')
 
             # parse and set seconds to zero
             df_chunk['BaseDateTime'] = pd.to_datetime(
-                df_chunk.BaseDateTime, format='%Y-%m-%dT%H:%M:%S', exact=True, errors='raise').apply(rm_sec)
+                df_chunk.BaseDateTime, format='%Y-%m-%dT%H:%M:%S', exact=True, errors='raise').dt.floor('T')
             df_chunk.index = df_chunk.BaseDateTime
             df_chunk = df_chunk.resample("%dT" % int(min_time_interval)).last()
             df_chunk.reset_index(drop=True, inplace=True)
             df_chunk = df_chunk.dropna()
-            file_path = Path(filtered_dir, str(file_name))
             df_chunk.to_csv(file_path, mode='a', header=header, index=False , date_format='%Y-%m-%d %H:%M:%S')
             header = False
     except Exception as e:
@@ -179,12 +361,22 @@ def subsample_file(file_name, download_dir, filtered_dir, min_time_interval) ->
         raise FileFailedException(str(file_name), e)
 
 
-def subsample_year_AIS_to_CSV(year: int, download_dir: Path, filtered_dir: Path, min_time_interval: int = 30) -> None:
+def subsample_year_AIS_to_CSV(year: int, download_dir: Path, filtered_dir: Path, min_time_interval: int = 30,
+                              state: JobState = None) -> None:
     logger.info('Subsampling year {0} to {1} minutes.'.format(
         year, min_time_interval))
-    # check already processed files in the
-    resume = check_dir(filtered_dir) + Failed_Files
-
-    files = [f for f in sorted(os.listdir(str(download_dir)), key=str.lower) if f.endswith('.csv') and f not in resume]
+    if state is not None:
+        resume = state.files(int(year), 'subsample') | set(Failed_Files)
+        files = sorted([f for f in state.files(int(year), 'download') if f not in resume and state.in_shard(f)],
+                       key=str.lower)
+    else:
+        # check already processed files in the
+        resume = set(check_dir(filtered_dir) + Failed_Files)
+        files = [f for f in sorted(os.listdir(str(download_dir)), key=str.lower)
+                 if f.endswith('.csv') and f not in resume]
     for file in files:
-        subsample_file(file, download_dir, filtered_dir, min_time_interval)
+        with state.lease(int(year), file) if state else nullcontext(True) as claimed:
+            if not claimed or (state and state.is_done(int(year), file, 'subsample')):
+                continue
+            with state.track(int(year), file, 'subsample', Path(filtered_dir, file)) if state else nullcontext():
+                subsample_file(file, download_dir, filtered_dir, min_time_interval)
@@ -0,0 +1,301 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from contextlib import contextmanager
+from pathlib import Path
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import typing
+import zlib
+
+from utilities.helper_functions import OwnershipLost
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['download', 'subsample', 'merge']
+# seconds after which a lease that was not renewed can be claimed by another worker
+LEASE_DURATION = 600
+
+
+class LeaseLost(OwnershipLost):
+    """
+        The lease of a file expired and may have been claimed by another worker, its results must not be committed.
+    """
+
+    def __init__(self, file_name: str):
+        super().__init__('Lost the lease of file %s' % file_name)
+        self.file_name = file_name
+
+
+def file_checksum(file_path: Path) -> str:
+    checksum = 1
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            checksum = zlib.adler32(block, checksum)
+    return 'adler32:%08x' % checksum
+
+
+def get_shard(file_name: str, shard_count: int) -> int:
+    """
+        Stable shard of a file, computed from the name without extension to be the same for all stages.
+    """
+    return zlib.crc32(Path(file_name).stem.encode()) % shard_count
+
+
+class JobState:
+    """
+        Embedded SQLite store of the processing state of every AIS file and stage, used to schedule and resume work
+        without listing the data directories. Several workers sharing the store claim files with expiring leases.
+    """
+
+    def __init__(self, db_path: Path, shard: typing.Tuple[int, int] = (0, 1), owner: str = None,
+                 lease_duration: int = LEASE_DURATION):
+        self.db_path = db_path
+        self.shard = shard
+        self.owner = owner if owner else '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease_duration = lease_duration
+        # files leased by this worker and the event set by the heartbeat once the lease is lost
+        self.leases = dict()
+        self._lock = threading.Lock()
+        # autocommit, transactions are started explicitly where needed
+        self.connection = sqlite3.connect(str(db_path), timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                year INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                output TEXT,
+                bytes INTEGER,
+                checksum TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started REAL,
+                finished REAL,
+                error TEXT,
+                PRIMARY KEY (year, file_name, stage)
+            )''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                year INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (year, file_name)
+            )''')
+
+    def _execute(self, sql: str, parameters=()) -> list:
+        with self._lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def start(self, year: int, file_name: str, stage: str, output: Path) -> None:
+        self._execute('''
+            INSERT INTO files (year, file_name, stage, status, output, attempts, started)
+            VALUES (?, ?, ?, 'running', ?, 1, ?)
+            ON CONFLICT (year, file_name, stage) DO UPDATE SET
+                status = 'running', output = excluded.output, attempts = attempts + 1, started = excluded.started,
+                finished = NULL, error = NULL''', (year, file_name, stage, str(output), time.time()))
+
+    def finish(self, year: int, file_name: str, stage: str, output: Path) -> None:
+        """
+            Record `stage` of `file_name` as done. A file leased by this worker is only committed while the lease is
+            still held, otherwise `LeaseLost` is raised.
+        """
+        size, checksum = None, None
+        if output.exists():
+            size, checksum = os.path.getsize(output), file_checksum(output)
+        parameters = (str(output), size, checksum, time.time(), year, file_name, stage)
+        if (year, file_name) not in self.leases:
+            self._execute('''
+                UPDATE files SET status = 'done', output = ?, bytes = ?, checksum = ?, finished = ?, error = NULL
+                WHERE year = ? AND file_name = ? AND stage = ?''', parameters)
+            return
+        self.check_lease(year, file_name)
+        with self._lock:
+            cursor = self.connection.execute('''
+                UPDATE files SET status = 'done', output = ?, bytes = ?, checksum = ?, finished = ?, error = NULL
+                WHERE year = ? AND file_name = ? AND stage = ? AND EXISTS (
+                    SELECT 1 FROM leases WHERE leases.year = files.year AND leases.file_name = files.file_name
+                    AND leases.owner = ? AND leases.expires > ?)''', parameters + (self.owner, time.time()))
+        if cursor.rowcount == 0:
+            raise LeaseLost(file_name)
+
+    def fail(self, year: int, file_name: str, stage: str, reason: str) -> None:
+        self._execute('''
+            UPDATE files SET status = 'failed', finished = ?, error = ?
+            WHERE year = ? AND file_name = ? AND stage = ?''', (time.time(), reason, year, file_name, stage))
+
+    @contextmanager
+    def track(self, year: int, file_name: str, stage: str, output: Path):
+        """
+            Record the processing of `file_name` in `stage` writing to `output`.
+        """
+        self.start(year, file_name, stage, output)
+        try:
+            yield
+        except LeaseLost as e:
+            # the state of the file belongs to the worker that claimed it since
+            raise e
+        except Exception as e:
+            self.fail(year, file_name, stage, type(e).__name__)
+            raise e
+        self.finish(year, file_name, stage, output)
+
+    def files(self, year: int, stage: str, status: str = 'done') -> typing.Set[str]:
+        return set(row[0] for row in self._execute(
+            'SELECT file_name FROM files WHERE year = ? AND stage = ? AND status = ?', (year, stage, status)))
+
+    def is_done(self, year: int, file_name: str, stage: str) -> bool:
+        return len(self._execute(
+            "SELECT 1 FROM files WHERE year = ? AND file_name = ? AND stage = ? AND status = 'done'",
+            (year, file_name, stage))) > 0
+
+    def in_shard(self, file_name: str) -> bool:
+        index, count = self.shard
+        return count == 1 or get_shard(file_name, count) == index
+
+    def claim(self, year: int, file_name: str) -> bool:
+        """
+            Lease `file_name` to this worker unless another worker holds a lease that has not expired yet.
+        """
+        now = time.time()
+        with self._lock:
+            # take the write lock before reading to make the check and the claim atomic across processes
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.connection.execute('SELECT owner, expires FROM leases WHERE year = ? AND file_name = ?',
+                                               (year, file_name)).fetchall()
+                claimed = len(rows) == 0 or rows[0][0] == self.owner or rows[0][1] < now
+                if claimed:
+                    if len(rows) > 0 and rows[0][0] != self.owner:
+                        logger.warning('Reclaiming stale lease of file %s from %s' % (file_name, rows[0][0]))
+                    self.connection.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)',
+                                            (year, file_name, self.owner, now + self.lease_duration))
+                self.connection.execute('COMMIT')
+            except Exception as e:
+                self.connection.execute('ROLLBACK')
+                raise e
+        return claimed
+
+    def renew(self, year: int, file_name: str) -> bool:
+        with self._lock:
+            cursor = self.connection.execute(
+                'UPDATE leases SET expires = ? WHERE year = ? AND file_name = ? AND owner = ?',
+                (time.time() + self.lease_duration, year, file_name, self.owner))
+        return cursor.rowcount > 0
+
+    def release(self, year: int, file_name: str) -> None:
+        self._execute('DELETE FROM leases WHERE year = ? AND file_name = ? AND owner = ?',
+                      (year, file_name, self.owner))
+
+    def check_lease(self, year: int, file_name: str) -> None:
+        """
+            Raise `LeaseLost` if this worker lost the lease of `file_name`, to be called before committing results.
+        """
+        lost = self.leases.get((year, file_name))
+        if lost is not None and lost.is_set():
+            raise LeaseLost(file_name)
+        if len(self._execute('SELECT 1 FROM leases WHERE year = ? AND file_name = ? AND owner = ? AND expires > ?',
+                             (year, file_name, self.owner, time.time()))) == 0:
+            raise LeaseLost(file_name)
+
+    @contextmanager
+    def lease(self, year: int, file_name: str):
+        """
+            Yield whether `file_name` could be claimed and keep the lease alive while the block runs. If the lease is
+            lost, the block is aborted at the next `check_lease` or `finish` without committing and the worker
+            continues with the next file.
+        """
+        if not self.claim(year, file_name):
+            logger.info('File %s is processed by another worker' % file_name)
+            yield False
+            return
+        stop = threading.Event()
+        lost = threading.Event()
+        self.leases[(year, file_name)] = lost
+
+        def heartbeat():
+            while not stop.wait(self.lease_duration / 3):
+                if not self.renew(year, file_name):
+                    logger.warning('Lost the lease of file %s' % file_name)
+                    lost.set()
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield True
+        except LeaseLost as e:
+            logger.warning('Aborting file %s without committing: %s' % (file_name, e))
+        finally:
+            stop.set()
+            thread.join()
+            del self.leases[(year, file_name)]
+            self.release(year, file_name)
+
+    def attempts(self, year: int, file_name: str, stage: str) -> int:
+        rows = self._execute('SELECT attempts FROM files WHERE year = ? AND file_name = ? AND stage = ?',
+                             (year, file_name, stage))
+        return rows[0][0] if len(rows) > 0 else 0
+
+    def import_directory(self, year: int, stage: str, directory: Path) -> None:
+        """
+            Register the csv files of `directory` as done once, if the store has no entries for `year` and `stage`
+            yet, e.g. for data harvested before the store was introduced.
+        """
+        if len(self._execute('SELECT 1 FROM files WHERE year = ? AND stage = ? LIMIT 1', (year, stage))) > 0:
+            return
+        entries = [(year, entry.name, stage, str(Path(directory, entry.name)), entry.stat().st_size)
+                   for entry in os.scandir(directory) if entry.name.endswith('.csv')]
+        logger.info('Importing %d existing files of stage %s of year %s' % (len(entries), stage, year))
+        with self._lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('''
+                INSERT OR IGNORE INTO files (year, file_name, stage, status, output, bytes)
+                VALUES (?, ?, ?, 'done', ?, ?)''', entries)
+            self.connection.execute('COMMIT')
+
+    def recover(self, year: int) -> None:
+        """
+            Discard the partially written outputs of files that were still running when a previous run crashed and
+            are not leased by a live worker.
+        """
+        for file_name, stage, output in self._execute("""
+                SELECT file_name, stage, output FROM files WHERE year = ? AND status = 'running' AND NOT EXISTS (
+                    SELECT 1 FROM leases WHERE leases.year = files.year AND leases.file_name = files.file_name
+                    AND leases.expires >= ? AND leases.owner != ?)""", (year, time.time(), self.owner)):
+            logger.warning('Discarding partial output %s of interrupted stage %s' % (output, stage))
+            if output:
+                Path(output).unlink(missing_ok=True)
+            self._execute('''
+                UPDATE files SET status = 'interrupted' WHERE year = ? AND file_name = ? AND stage = ?''',
+                          (year, file_name, stage))
+
+    def close(self) -> None:
+        self.connection.close()
@@ -32,10 +32,16 @@ import shutil
 import time
 import traceback
 
-from utilities.helper_functions import Failed_Files, SaveToFailedList, init_Failed_list, FileFailedException, check_dir
-from EnvironmentalData.weather import append_to_csv
+from utilities import resilience
+from utilities.profiling import StageProfiler
+from utilities.helper_functions import Failed_Files, SaveToFailedList, init_Failed_list, FileFailedException, \
+    parse_mem_budget, set_mem_budget
+from EnvironmentalData import catalog_cache, config, merged_store
+from EnvironmentalData.weather import append_to_csv, TileScheduler, SAMPLING_MODES
 
-from ais import download_year_AIS, subsample_year_AIS_to_CSV, download_file, get_files_list, subsample_file
+from ais import download_year_AIS, subsample_year_AIS_to_CSV, download_file, get_files_list, subsample_file, \
+    prefetch_manifests, set_manifest_dir, get_csv_name
+from job_state import JobState, STAGES, LEASE_DURATION
 
 logger = logging.getLogger(__name__)
 
@@ -79,6 +85,17 @@ def years_arg_parser(input: str) -> list[int]:
                 "'" + input + "' is not Valid. Expected input 'YYYY' , 'YYYY-YYYY' or 'YYYY,YYYY,YYYY'.")
 
 
+def shard_arg_parser(input: str) -> tuple[int, int]:
+    try:
+        index, count = [int(i) for i in input.split('/')]
+        if not 0 <= index < count:
+            raise ValueError
+        return index, count
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'" + input + "' is not Valid. Expected input 'i/N' with 0 <= i < N.")
+
+
 def init_directories(dir, year, minutes):
     download_dir = Path(dir, str(year))
     merged_dir = Path(dir, str(year) + '_merged_%s' % minutes)
@@ -110,112 +127,184 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--depth-first',
                         help='Clears the raw output directory in order to free memory.',
                         action='store_true')
+    parser.add_argument('--mem-budget',
+                        help="Memory budget to size the processed chunks, e.g. '4G' for all stages or per stage, e.g. "
+                             "'subsample=2G,merge=512M' (stages: download, subsample, merge). "
+                             "By default chunks of a fixed number of rows are processed.",
+                        type=parse_mem_budget, required=False, default=dict())
+    parser.add_argument('--shard',
+                        help="Process only the shard 'i/N' (0 <= i < N) of the files of each year, e.g. '0/4'. "
+                             "Workers sharing `dir` claim files with leases, so each file is processed once.",
+                        type=shard_arg_parser, required=False, default=(0, 1))
+    parser.add_argument('--lease-duration',
+                        help='Seconds after which the file lease of a worker that stopped renewing it expires and '
+                             'the file can be claimed by another worker.',
+                        type=int, required=False, default=LEASE_DURATION)
+    parser.add_argument('--partitioned',
+                        help="Also write the merged files into the dataset 'merged_<minutes>_partitioned' in `dir`, "
+                             'partitioned by year, month and grid cell for queries.',
+                        action='store_true')
+    parser.add_argument('--profile',
+                        help='Profile the steps and write a profile per year and step to the output directory, e.g. '
+                             "'profile_2020_merge.html'.",
+                        action='store_true')
+    parser.add_argument('--sampling',
+                        help="Sampling of the environmental data at the AIS points: 'linear' interpolation or the "
+                             "values of the 'nearest' grid cells, which is considerably faster.",
+                        choices=SAMPLING_MODES, required=False, default='linear')
     args, unknown = parser.parse_known_args()
+    # fail before any work if the service credentials are missing
+    config.load()
+    set_mem_budget(args.mem_budget)
     arg_string = 'Starting a task for year(s) %s with subsampling of %d minutes' % (
         ','.join(list(map(str, args.year))).join(['[', ']']), int(args.minutes))
 
     logger.info( arg_string + '. The output files will be saved to %s' % (args.dir if args.dir != '' else 'project directory'))
     args.dir = Path().absolute().parent if args.dir == '' else Path(args.dir)
     init_Failed_list(arg_string, args.dir)
+    set_manifest_dir(Path(args.dir, '.manifests'))
+    catalog_cache.set_cache_dir(Path(args.dir, '.catalogs'))
+    if args.depth_first or args.step in [0, 1, 2]:
+        # only the downloads and the file list of the depth-first mode need the NOAA index
+        prefetch_manifests(args.year)
+    state = JobState(Path(args.dir, 'harvester_state.sqlite'), shard=args.shard, lease_duration=args.lease_duration)
+    partitioned_dir = Path(args.dir, 'merged_%s_partitioned' % args.minutes)
     for year in args.year:
         logger.info('Processing year %s' % str(year))
         # initialize directories
         download_dir, filtered_dir, merged_dir = init_directories(args.dir, year, args.minutes)
-        merged_dir_list = check_dir(merged_dir)
-        filtered_dir_list = check_dir(filtered_dir)
-        download_dir_list = check_dir(download_dir)
+        for stage, stage_dir in zip(STAGES, [download_dir, filtered_dir, merged_dir]):
+            state.import_directory(year, stage, stage_dir)
+        state.recover(year)
+        profiler = StageProfiler(args.dir, 'profile_%s' % year, enabled=args.profile)
         if args.depth_first:
             logger.info('Task is started using Depth-first mode')
-            for file in get_files_list(year, exclude_to_resume=merged_dir_list):
-                file_name = file.split('.')[0] + '.csv'
-                file_failed = False
-                interval = 10
-                while True:
-                    try:
-                        if (args.step == 1 or not file_name in filtered_dir_list) and not file_name in download_dir_list:
-                            logger.info('STEP 1/3 downloading AIS data: %s' % file)
-                            file_name = download_file(file, download_dir, year)
-                        break
-                    except FileFailedException as e:
-                        logger.error(traceback.format_exc())
-                        logger.error('Error when downloading AIS data')
-                        if interval > 40:
-                            Failed_Files.append(e.file_name)
-                            logger.warning('Skipping steps 1, 2 and 3 for file %s after attempting %d times' % (
-                                file, interval // 10))
-                            SaveToFailedList(e.file_name, e.exceptionType, args.dir)
-                            interval = 10
-                            file_failed = True
-                            break
-                        logger.error('Re-run in {0} sec'.format(interval))
-                        time.sleep(interval)
-                        interval += 10
-                if args.step == 1:
+            for file in get_files_list(year, exclude_to_resume=state.files(year, 'merge')):
+                file_name = get_csv_name(file)
+                if not state.in_shard(file_name):
                     continue
-                while True:
-                    try:
-                        if file_failed: break
-                        if file_name in filtered_dir_list:
-                            logger.info(
-                                'STEP 2/3 File: %s has been already subsampled from a previous run.' % file_name)
+                with state.lease(year, file_name) as claimed:
+                    if not claimed or state.is_done(year, file_name, 'merge'):
+                        continue
+                    file_failed = False
+                    interval = 10
+                    while True:
+                        try:
+                            if (args.step == 1 or not state.is_done(year, file_name, 'subsample')) and \
+                                    not state.is_done(year, file_name, 'download'):
+                                logger.info('STEP 1/3 downloading AIS data: %s' % file)
+                                with state.track(year, file_name, 'download', Path(download_dir, file_name)), \
+                                        profiler.stage('download'):
+                                    file_name = download_file(file, download_dir, year)
                             break
-                        logger.info('STEP 2/3 subsampling CSV data: %s' % file_name)
-                        subsample_file(file_name, download_dir, filtered_dir, args.minutes)
-                        break
-                    except FileFailedException as e:
-                        logger.error(traceback.format_exc())
-                        logger.error('Error when subsampling CSV data')
-                        if interval > 40:
-                            Failed_Files.append(e.file_name)
-                            logger.warning(
-                                'Skipping steps 2, 3 for file %s after attempting %d times' % (file, interval // 10))
-                            SaveToFailedList(e.file_name, e.exceptionType, args.dir)
-                            interval = 10
-                            file_failed = True
+                        except FileFailedException as e:
+                            logger.error(traceback.format_exc())
+                            logger.error('Error when downloading AIS data')
+                            if resilience.get_circuit_open(e):
+                                # pause until the remote service may be available again, not counted as an attempt
+                                resilience.wait_for_circuit(resilience.get_circuit_open(e))
+                                continue
+                            if interval > 40:
+                                Failed_Files.append(e.file_name)
+                                logger.warning('Skipping steps 1, 2 and 3 for file %s after attempting %d times' % (
+                                    file, interval // 10))
+                                SaveToFailedList(e.file_name, e.exceptionType, args.dir)
+                                interval = 10
+                                file_failed = True
+                                break
+                            logger.error('Re-run in {0} sec'.format(interval))
+                            time.sleep(resilience.jitter(interval))
+                            interval += 10
+                    if args.step == 1:
+                        continue
+                    while True:
+                        try:
+                            if file_failed: break
+                            if state.is_done(year, file_name, 'subsample'):
+                                logger.info(
+                                    'STEP 2/3 File: %s has been already subsampled from a previous run.' % file_name)
+                                break
+                            logger.info('STEP 2/3 subsampling CSV data: %s' % file_name)
+                            with state.track(year, file_name, 'subsample', Path(filtered_dir, file_name)), \
+                                    profiler.stage('subsample'):
+                                subsample_file(file_name, download_dir, filtered_dir, args.minutes)
                             break
-                        logger.error('Re-run in {0} sec'.format(interval))
-                        time.sleep(interval)
-                        interval += 10
+                        except FileFailedException as e:
+                            logger.error(traceback.format_exc())
+                            logger.error('Error when subsampling CSV data')
+                            if resilience.get_circuit_open(e):
+                                # pause until the remote service may be available again, not counted as an attempt
+                                resilience.wait_for_circuit(resilience.get_circuit_open(e))
+                                continue
+                            if interval > 40:
+                                Failed_Files.append(e.file_name)
+                                logger.warning(
+                                    'Skipping steps 2, 3 for file %s after attempting %d times' % (file, interval // 10))
+                                SaveToFailedList(e.file_name, e.exceptionType, args.dir)
+                                interval = 10
+                                file_failed = True
+                                break
+                            logger.error('Re-run in {0} sec'.format(interval))
+                            time.sleep(resilience.jitter(interval))
+                            interval += 10
 
-                if args.clear and not file_failed:
-                    logger.info('Remove raw file %s' % file_name)
-                    if Path(download_dir, file_name).exists():
-                        os.remove(str(Path(download_dir, file_name)))
-                    else:
-                        logger.warning("File not found  %s " % str(Path(download_dir, file_name)))
+                    if args.clear and not file_failed:
+                        logger.info('Remove raw file %s' % file_name)
+                        if Path(download_dir, file_name).exists():
+                            os.remove(str(Path(download_dir, file_name)))
+                        else:
+                            logger.warning("File not found  %s " % str(Path(download_dir, file_name)))
 
-                while True:
-                    try:
-                        if file_failed: break
-                        logger.info('STEP 3/3 appending weather data: %s' % file_name)
-                        append_to_csv(Path(filtered_dir, file_name), Path(merged_dir, file_name))
-                        break
-                    except FileFailedException as e:
-                        logger.error(traceback.format_exc())
-                        logger.error('Error when appending environment data')
-                        if interval > 40:
-                            Failed_Files.append(e.file_name)
-                            logger.warning(
-                                'Skipping step 3 for file %s after attempting %d times' % (file, interval // 10))
-                            SaveToFailedList(e.file_name, e.exceptionType, args.dir)
+                    while True:
+                        try:
+                            if file_failed: break
+                            logger.info('STEP 3/3 appending weather data: %s' % file_name)
+                            with state.track(year, file_name, 'merge', Path(merged_dir, file_name)), \
+                                    profiler.stage('merge'):
+                                # the output and its parts are only written while the lease is held
+                                append_to_csv(Path(filtered_dir, file_name), Path(merged_dir, file_name),
+                                              sampling=args.sampling,
+                                              check=lambda: state.check_lease(year, file_name))
+                                state.check_lease(year, file_name)
+                                if args.partitioned:
+                                    merged_store.add_file(Path(merged_dir, file_name), partitioned_dir)
                             break
-                        logger.error('Re-run in {0} sec'.format(interval))
-                        time.sleep(interval)
-                        interval += 10
+                        except FileFailedException as e:
+                            logger.error(traceback.format_exc())
+                            logger.error('Error when appending environment data')
+                            if resilience.get_circuit_open(e):
+                                # pause until the remote service may be available again, not counted as an attempt
+                                resilience.wait_for_circuit(resilience.get_circuit_open(e))
+                                continue
+                            if interval > 40:
+                                Failed_Files.append(e.file_name)
+                                logger.warning(
+                                    'Skipping step 3 for file %s after attempting %d times' % (file, interval // 10))
+                                SaveToFailedList(e.file_name, e.exceptionType, args.dir)
+                                break
+                            logger.error('Re-run in {0} sec'.format(interval))
+                            time.sleep(resilience.jitter(interval))
+                            interval += 10
 
         else:
             if args.step != 0:
                 logger.info('Single step selected')
             if args.step == 0 or args.step == 1:
+                interval = 10
                 while True:
                     try:
                         logger.info('STEP 1/3 downloading AIS data')
                         # download AIS data
-                        download_year_AIS(year, download_dir)
+                        with profiler.stage('download'):
+                            download_year_AIS(year, download_dir, state)
                         break
                     except FileFailedException as e:
                         logger.error(traceback.format_exc())
                         logger.error('Error when downloading AIS data')
+                        if resilience.get_circuit_open(e):
+                            # pause until the remote service may be available again, not counted as an attempt
+                            resilience.wait_for_circuit(resilience.get_circuit_open(e))
+                            continue
                         if interval > 40:
                             Failed_Files.append(e.file_name)
                             logger.warning(
@@ -223,7 +312,7 @@ if __name__ == '__main__':
                             SaveToFailedList(e.file_name, e.exceptionType, args.dir)
                             interval = 10
                         logger.error('Re-run in {0} sec'.format(interval))
-                        time.sleep(interval)
+                        time.sleep(resilience.jitter(interval))
                         interval += 10
 
             if args.step == 0 or args.step == 2:
@@ -232,11 +321,16 @@ if __name__ == '__main__':
                 while True:
                     try:
                         logger.info('STEP 2/3 subsampling CSV data')
-                        subsample_year_AIS_to_CSV(str(year), download_dir, filtered_dir, args.minutes)
+                        with profiler.stage('subsample'):
+                            subsample_year_AIS_to_CSV(str(year), download_dir, filtered_dir, args.minutes, state)
                         break
                     except FileFailedException as e:
                         logger.error(traceback.format_exc())
                         logger.error('Error when subsampling CSV data')
+                        if resilience.get_circuit_open(e):
+                            # pause until the remote service may be available again, not counted as an attempt
+                            resilience.wait_for_circuit(resilience.get_circuit_open(e))
+                            continue
                         if interval > 40:
                             Failed_Files.append(e.file_name)
                             logger.warning('Skipping file step 2 for file %s after attempting %d times' % (
@@ -244,9 +338,15 @@ if __name__ == '__main__':
                             SaveToFailedList(e.file_name, e.exceptionType, args.dir)
                             interval = 10
                         logger.error('Re-run in {0} sec'.format(interval))
-                        time.sleep(interval)
+                        time.sleep(resilience.jitter(interval))
                     interval += 10
-                if args.clear:
+                if args.clear and args.shard[1] > 1:
+                    # the other shards may still work on their raw files
+                    logger.info('Remove subsampled raw files of shard %d/%d' % args.shard)
+                    for file in state.files(year, 'subsample'):
+                        if state.in_shard(file):
+                            Path(download_dir, file).unlink(missing_ok=True)
+                elif args.clear:
                     logger.info('Remove raw files and clear directory of year %s  ' % str(download_dir))
                     if download_dir.exists():
                         shutil.rmtree(download_dir)
@@ -257,13 +357,35 @@ if __name__ == '__main__':
                 while True:
                     try:
                         logger.info('STEP 3/3 appending weather data')
-                        for file in filtered_dir_list:
-                            if Path(merged_dir, file).exists() or file in Failed_Files: continue
-                            append_to_csv(Path(filtered_dir, file), Path(merged_dir, file))
+                        with profiler.stage('merge'):
+                            # the tiles shared by the files are retrieved once for all files of the year
+                            scheduler = TileScheduler(
+                                [(Path(filtered_dir, file), Path(merged_dir, file)) for file in
+                                 sorted(state.files(year, 'subsample') - state.files(year, 'merge'), key=str.lower)
+                                 if file not in Failed_Files and state.in_shard(file)], sampling=args.sampling)
+                            try:
+                                for in_path, out_path in scheduler.files:
+                                    with state.lease(year, in_path.name) as claimed:
+                                        if not claimed or state.is_done(year, in_path.name, 'merge'):
+                                            scheduler.skip(in_path)
+                                            continue
+                                        with state.track(year, in_path.name, 'merge', out_path):
+                                            # the output and its parts are only written while the lease is held
+                                            scheduler.append_to_csv(
+                                                in_path, check=lambda: state.check_lease(year, in_path.name))
+                                            state.check_lease(year, in_path.name)
+                                            if args.partitioned:
+                                                merged_store.add_file(out_path, partitioned_dir)
+                            finally:
+                                scheduler.close()
                         break
                     except FileFailedException as e:
                         logger.error(traceback.format_exc())
                         logger.error('Error when appending environment data')
+                        if resilience.get_circuit_open(e):
+                            # pause until the remote service may be available again, not counted as an attempt
+                            resilience.wait_for_circuit(resilience.get_circuit_open(e))
+                            continue
                         if interval > 40:
                             Failed_Files.append(e.file_name)
                             logger.warning(
@@ -271,5 +393,7 @@ if __name__ == '__main__':
                             SaveToFailedList(e.file_name, e.exceptionType, args.dir)
                             interval = 10
                         logger.error('Re-run in {0} sec'.format(interval))
-                        time.sleep(interval)
+                        time.sleep(resilience.jitter(interval))
                         interval += 10
+
+        profiler.save()
@@ -0,0 +1,130 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from datetime import datetime, timedelta, date
+from pathlib import Path
+import argparse
+import logging
+import os
+import traceback
+
+from EnvironmentalData import mirror_store
+from EnvironmentalData.weather import get_GFS, get_global_phy_daily, get_global_wind, get_global_wave, \
+    GFS_25_VAR_LIST, DAILY_PHY_VAR_LIST, WIND_VAR_LIST, WAVE_VAR_LIST
+
+logger = logging.getLogger(__name__)
+
+PRODUCTS = {'gfs': get_GFS, 'phy': get_global_phy_daily, 'wind': get_global_wind, 'wave': get_global_wave}
+PRODUCT_VARIABLES = {'gfs': GFS_25_VAR_LIST, 'phy': DAILY_PHY_VAR_LIST, 'wind': WIND_VAR_LIST, 'wave': WAVE_VAR_LIST}
+# regions of interest as (lat_lo, lat_hi, lon_lo, lon_hi)
+REGIONS = {
+    # bounding box of the exclusive economic zone of the contiguous United States
+    'us-eez': (23.0, 50.0, -131.0, -64.0),
+    'gulf-of-mexico': (17.5, 31.0, -98.0, -80.0),
+}
+
+
+def bbox_arg_parser(input: str) -> tuple:
+    try:
+        lat_lo, lat_hi, lon_lo, lon_hi = [float(v) for v in input.split(',')]
+        if not (-90 <= lat_lo < lat_hi <= 90 and -180 <= lon_lo < lon_hi <= 180):
+            raise ValueError
+        return lat_lo, lat_hi, lon_lo, lon_hi
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'" + input + "' is not Valid. Expected input 'lat_lo,lat_hi,lon_lo,lon_hi'.")
+
+
+def sync_product(product: str, region: str, bbox: tuple, start: datetime, end: datetime, mirror_dir: Path,
+                 variables: list = None) -> None:
+    """
+        Append the days between `start` and `end` that are not mirrored yet, a failed day is tried again with the
+        next run.
+    """
+    if variables is not None:
+        # only the variables of this product are requested from its service
+        variables = [var for var in variables if var in PRODUCT_VARIABLES[product]]
+        if len(variables) == 0:
+            logger.warning('None of the variables to mirror belongs to %s' % product)
+            return
+    failed = 0
+    for day in range((end - start).days + 1):
+        dt = start + timedelta(days=day)
+        # the dataset name differs for older GFS data
+        ds_names = ['gfs', 'gfs_50'] if product == 'gfs' else [product]
+        if any(str(dt.date()) in mirror_store.synced_days(mirror_store.get_store_path(mirror_dir, region, ds_name))
+               for ds_name in ds_names):
+            continue
+        logger.info('Mirroring %s of %s for region %s' % (product, str(dt.date()), region))
+        try:
+            ds, ds_name = PRODUCTS[product](dt, dt + timedelta(hours=23, minutes=59), *bbox, variables=variables)
+            try:
+                mirror_store.append_day(mirror_store.get_store_path(mirror_dir, region, ds_name), ds, ds_name, dt,
+                                        variables)
+            finally:
+                ds.close()
+        except Exception:
+            logger.error(traceback.format_exc())
+            logger.error('Could not mirror %s of %s' % (product, str(dt.date())))
+            failed += 1
+    if failed > 0:
+        logger.warning('%d days of %s could not be mirrored' % (failed, product))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Incrementally mirror environmental products of a region into local Zarr stores, which are '
+                    'preferred by the product functions if the environment variable MIRROR_DIR points to them.')
+    parser.add_argument('-r', '--region', help='The name of the region, one of %s or any name together with '
+                                               '--bbox.' % ', '.join(REGIONS), required=True, type=str)
+    parser.add_argument('-b', '--bbox', help="The bounding box 'lat_lo,lat_hi,lon_lo,lon_hi' of a custom region.",
+                        type=bbox_arg_parser, required=False)
+    parser.add_argument('-p', '--products', help='Comma separated products to mirror: %s' % ', '.join(PRODUCTS),
+                        type=lambda s: s.split(','), default=list(PRODUCTS))
+    parser.add_argument('-v', '--variables',
+                        help='Comma separated variables to mirror. By default all variables are mirrored; otherwise '
+                             'only requests for these variables are served from the mirror.',
+                        type=lambda s: s.split(','), required=False)
+    parser.add_argument('-s', '--start', help='First day to mirror as YYYY-MM-DD.', required=True,
+                        type=lambda s: datetime.strptime(s, '%Y-%m-%d'))
+    parser.add_argument('-e', '--end', help='Last day to mirror as YYYY-MM-DD, by default five days ago, the last '
+                                            'day of the GFS archive.', required=False,
+                        type=lambda s: datetime.strptime(s, '%Y-%m-%d'))
+    parser.add_argument('-d', '--dir', help='The mirror directory, by default the environment variable MIRROR_DIR.',
+                        default=os.environ.get('MIRROR_DIR'), type=str, required=False)
+    args = parser.parse_args()
+    if args.dir is None:
+        parser.error('the mirror directory is required, use --dir or MIRROR_DIR')
+    if args.bbox is None and args.region not in REGIONS:
+        parser.error('unknown region %s, add --bbox for a custom region' % args.region)
+    unknown_products = [p for p in args.products if p not in PRODUCTS]
+    if len(unknown_products) > 0:
+        parser.error('unknown products %s' % ', '.join(unknown_products))
+    bbox = args.bbox if args.bbox is not None else REGIONS[args.region]
+    end = args.end if args.end is not None else datetime.combine(date.today() - timedelta(days=5), datetime.min.time())
+    Path(args.dir, args.region).mkdir(parents=True, exist_ok=True)
+    for product in args.products:
+        sync_product(product, args.region, bbox, args.start, end, Path(args.dir), args.variables)
@@ -0,0 +1,89 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+
+import pytest
+
+import ais
+
+INDEX = '''<html><body><table>
+<tr><td><a href="AIS_2021_01_01.zip">AIS_2021_01_01.zip</a></td><td>2021-02-01 10:00</td><td>98M</td></tr>
+<tr><td><a href="AIS_2021_01_02.zip">AIS_2021_01_02.zip</a></td><td>2021-02-01 10:00</td><td>1.5G</td></tr>
+</table></body></html>'''
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, text: str = ''):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {'ETag': '"v1"'}
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeIndex:
+    """
+        Replacement of `requests.get` serving the index, unchanged if it is revalidated with its ETag.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        return FakeResponse(304) if headers.get('If-None-Match') == '"v1"' else FakeResponse(200, INDEX)
+
+
+@pytest.fixture
+def index(monkeypatch, tmp_path) -> FakeIndex:
+    index = FakeIndex()
+    monkeypatch.setattr(ais.requests, 'get', index)
+    monkeypatch.setattr(ais, '_manifests', dict())
+    monkeypatch.setattr(ais, '_file_sizes', dict())
+    monkeypatch.setattr(ais, 'MANIFEST_DIR', None)
+    return index
+
+
+def test_index_is_requested_once_per_run(index):
+    files = ais.get_files_list(2021, exclude_to_resume=['AIS_2021_01_01.csv'])
+    assert files == ['AIS_2021_01_02.zip']
+    assert ais.get_file_size(2021, 'AIS_2021_01_01.zip') == 98 * 2 ** 20
+    assert ais.get_file_size(2021, 'AIS_2021_01_02.zip') == int(1.5 * 2 ** 30)
+    assert ais.get_file_size(2021, 'AIS_2021_01_03.zip') is None
+    ais.get_manifest(2021)
+    assert len(index.requests) == 1
+
+
+def test_index_is_revalidated_in_the_next_run(index, monkeypatch, tmp_path):
+    ais.set_manifest_dir(Path(tmp_path, '.manifests'))
+    ais.get_manifest(2021)
+    # a new run loads the persisted manifest and only revalidates it
+    monkeypatch.setattr(ais, '_manifests', dict())
+    monkeypatch.setattr(ais, '_file_sizes', dict())
+    assert ais.get_file_size(2021, 'AIS_2021_01_01.zip') == 98 * 2 ** 20
+    assert [headers.get('If-None-Match') for headers in index.requests] == [None, '"v1"']
@@ -0,0 +1,202 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from EnvironmentalData import weather
+from Harvester.job_state import JobState, LeaseLost
+from utilities import helper_functions
+
+YEAR = 2021
+
+
+@pytest.fixture
+def db_path(tmp_path) -> Path:
+    return Path(tmp_path, 'state.sqlite')
+
+
+@pytest.fixture
+def output(tmp_path) -> Path:
+    path = Path(tmp_path, 'AIS_2021_01_01.csv')
+    path.write_text('a,b\n1,2\n')
+    return path
+
+
+def expire(state: JobState, file_name: str) -> None:
+    state._execute('UPDATE leases SET expires = 0 WHERE file_name = ?', (file_name,))
+
+
+def test_claim_is_exclusive(db_path):
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    assert a.claim(YEAR, 'f.csv')
+    assert not b.claim(YEAR, 'f.csv')
+    # claiming again extends the own lease
+    assert a.claim(YEAR, 'f.csv')
+    a.release(YEAR, 'f.csv')
+    assert b.claim(YEAR, 'f.csv')
+
+
+def test_stale_lease_is_reclaimed(db_path):
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    assert a.claim(YEAR, 'f.csv')
+    expire(a, 'f.csv')
+    assert b.claim(YEAR, 'f.csv')
+    assert not a.renew(YEAR, 'f.csv')
+    assert b.renew(YEAR, 'f.csv')
+
+
+def test_heartbeat_keeps_the_lease(db_path):
+    a, b = JobState(db_path, owner='a', lease_duration=0.3), JobState(db_path, owner='b')
+    with a.lease(YEAR, 'f.csv') as claimed:
+        assert claimed
+        time.sleep(0.6)
+        assert not b.claim(YEAR, 'f.csv')
+    # the lease is released after the block
+    assert b.claim(YEAR, 'f.csv')
+
+
+def test_lease_of_another_worker(db_path):
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    with a.lease(YEAR, 'f.csv') as claimed_a:
+        with b.lease(YEAR, 'f.csv') as claimed_b:
+            assert claimed_a and not claimed_b
+
+
+def test_track(db_path, output):
+    state = JobState(db_path, owner='a')
+    with state.lease(YEAR, output.name):
+        with state.track(YEAR, output.name, 'merge', output):
+            assert state.files(YEAR, 'merge', 'running') == {output.name}
+    assert state.is_done(YEAR, output.name, 'merge')
+    assert state.attempts(YEAR, output.name, 'merge') == 1
+    with pytest.raises(ValueError):
+        with state.track(YEAR, 'g.csv', 'merge', output):
+            raise ValueError()
+    assert state.files(YEAR, 'merge', 'failed') == {'g.csv'}
+
+
+def test_lost_lease_is_not_committed(db_path, output):
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    committed = False
+    with a.lease(YEAR, output.name) as claimed:
+        assert claimed
+        with a.track(YEAR, output.name, 'merge', output):
+            # the worker stalls, its lease expires and another worker claims the file
+            expire(a, output.name)
+            assert b.claim(YEAR, output.name)
+            b.start(YEAR, output.name, 'merge', output)
+        committed = True
+    # the lease block is aborted without committing and without touching the state of the new owner
+    assert not committed
+    assert not a.is_done(YEAR, output.name, 'merge')
+    assert a.files(YEAR, 'merge', 'running') == {output.name}
+    assert a._execute('SELECT owner FROM leases') == [('b',)]
+
+
+def test_lost_heartbeat_aborts_at_check(db_path):
+    a = JobState(db_path, owner='a', lease_duration=0.2)
+    checked = False
+    with a.lease(YEAR, 'f.csv'):
+        # another worker took over the lease, the next renewal fails
+        a._execute("UPDATE leases SET owner = 'b'")
+        time.sleep(0.3)
+        assert a.leases[(YEAR, 'f.csv')].is_set()
+        a.check_lease(YEAR, 'f.csv')
+        checked = True
+    assert not checked
+
+
+def test_check_lease(db_path):
+    a = JobState(db_path, owner='a')
+    with pytest.raises(LeaseLost):
+        a.check_lease(YEAR, 'f.csv')
+    with a.lease(YEAR, 'f.csv'):
+        a.check_lease(YEAR, 'f.csv')
+
+
+def test_recover(db_path, output):
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    a.start(YEAR, output.name, 'merge', output)
+    # the output of a crashed run without a live lease is discarded
+    b.recover(YEAR)
+    assert not output.exists()
+    assert b.files(YEAR, 'merge', 'interrupted') == {output.name}
+
+
+def test_recover_keeps_leased_files(db_path, output):
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    assert a.claim(YEAR, output.name)
+    a.start(YEAR, output.name, 'merge', output)
+    b.recover(YEAR)
+    assert output.exists()
+    assert b.files(YEAR, 'merge', 'running') == {output.name}
+
+
+def test_lost_lease_in_the_middle_of_a_merge(db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(helper_functions, 'CHUNK_SIZE', 2)
+    times = pd.date_range('2021-01-01', periods=6, freq='3h')
+    in_path = Path(tmp_path, 'track.csv')
+    pd.DataFrame({'BaseDateTime': times.strftime('%Y-%m-%d %H:%M:%S'), 'LAT': np.linspace(0, 2, 6),
+                  'LON': np.linspace(2, 0, 6)}).to_csv(in_path, index=False)
+    out_path = Path(tmp_path, 'merged', in_path.name)
+    out_path.parent.mkdir()
+    parts_dir = Path(str(out_path) + '.parts')
+    grid = xr.Dataset({'VHM0': (('time', 'latitude', 'longitude'), np.zeros((len(times), 3, 3)))},
+                      coords=dict(time=times, latitude=np.arange(0, 3.), longitude=np.arange(0, 3.)))
+    a, b = JobState(db_path, owner='a'), JobState(db_path, owner='b')
+    calls = []
+
+    def fetch_products(wave, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 2:
+            # the worker stalls, its lease expires and another worker takes over the file and its output
+            expire(a, in_path.name)
+            assert b.claim(YEAR, in_path.name)
+            out_path.write_text('output of b')
+            Path(parts_dir, 'part of b').write_text('')
+        return [(grid, 'wave', wave)]
+
+    monkeypatch.setattr(weather, 'fetch_products', fetch_products)
+    committed = False
+    with a.lease(YEAR, in_path.name) as claimed:
+        assert claimed
+        with a.track(YEAR, in_path.name, 'merge', out_path):
+            weather.append_to_csv(in_path, out_path, gfs=[], wind=[], phy=[], wave=['VHM0'], sampling='nearest',
+                                  check=lambda: a.check_lease(YEAR, in_path.name))
+        committed = True
+    # the merge is aborted before its second chunk, the output and the parts of the new owner are left untouched
+    assert not committed
+    assert len(calls) == 2
+    assert out_path.read_text() == 'output of b'
+    assert sorted(path.name for path in parts_dir.iterdir()) == ['manifest.json', 'part of b', 'part-000000.csv']
+    assert a.files(YEAR, 'merge', 'running') == {in_path.name}
+    assert a._execute('SELECT owner FROM leases') == [('b',)]
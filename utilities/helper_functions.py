@@ -26,18 +26,31 @@
 #
 from datetime import datetime, timezone
 from pathlib import Path
+import json
+import logging
+import shutil
 import typing
 import os
 
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 # string dates converters
 str_to_date = lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S')
 date_to_str = lambda x: x.strftime('%Y-%m-%dT%H:%M:%SZ')
 str_to_date_min = lambda x: datetime.strptime(x, '%Y-%m-%dT%H:%M')
 
-# Chunk size to manage huge files
+# Chunk size to manage huge files, used if no memory budget is set
 CHUNK_SIZE = 10000
+# memory budget in bytes per processing stage, see `set_mem_budget`
+MEM_BUDGET = dict()
+MEM_BUDGET_STAGES = ['download', 'subsample', 'merge']
+# share of a stage's memory budget for the rows of a chunk. The remainder is left for copies while processing and,
+# in stage 'merge', for the retrieved environmental subsets.
+ROWS_BUDGET_SHARE = {'download': 0.5, 'subsample': 0.25, 'merge': 0.25}
+MIN_CHUNK_SIZE = 1000
+MAX_CHUNK_SIZE = 5000000
 
 
 # Custom exception to retrieve file names with exception handling
@@ -49,6 +62,13 @@ class FileFailedException(Exception):
         super().__init__('Failed processing file %s' % file_name)
 
 
+class OwnershipLost(Exception):
+    """
+        Another process took over the output of a file, e.g. after the lease of a worker expired. Its output and parts
+        belong to the new owner and must neither be written nor removed.
+    """
+
+
 def SaveToFailedList(file_name, reason, work_dir):
     pd.DataFrame([[datetime.now().strftime("%Y-%m-%d %H:%M:%S"), file_name, reason]]).to_csv(
         Path(work_dir, 'FailedFilesList.csv'), mode='a', index=False, header=False)
@@ -59,9 +79,11 @@ Failed_Files = []
 
 
 def init_Failed_list(arg_string, work_dir):
+    # keep the failures of previous runs
+    file_path = Path(work_dir, 'FailedFilesList.csv')
     pd.DataFrame([[datetime.now().strftime("%Y-%m-%d %H:%M:%S"), arg_string, '']],
                  columns=['Timestamp', 'file_name', 'reason']).to_csv(
-        Path(work_dir, 'FailedFilesList.csv'), index=False)
+        file_path, mode='a', header=not file_path.exists(), index=False)
 
 
 def check_dir(dir_name: Path) -> typing.List[str]:
@@ -71,15 +93,131 @@ def check_dir(dir_name: Path) -> typing.List[str]:
     return sorted(os.listdir(dir_name), key=str.lower)
 
 
-def create_csv(df, metadata_dict, file_path, index=True):
+def csv_with_metadata(df, metadata_dict, index=True) -> str:
     """
-         create a csv file including a metadata object as a dictionary in the beginning of the file.
+         csv representation of `df` including a metadata object as a dictionary in the beginning.
      """
     csv_str = df.to_csv(index=index)
     csv_coma_line = csv_str[:csv_str.find('\n')].count(',') * ',' + '\n'
-    csv_str = csv_coma_line.join(metadata_dict.values()) + csv_coma_line + csv_str
+    return csv_coma_line.join(metadata_dict.values()) + csv_coma_line + csv_str
+
+
+def create_csv(df, metadata_dict, file_path, index=True):
+    """
+         create a csv file including a metadata object as a dictionary in the beginning of the file.
+     """
     with open(file_path, 'w', newline='', encoding='utf-8') as f:
-        f.write(csv_str)
+        f.write(csv_with_metadata(df, metadata_dict, index=index))
+
+
+class ChunkCheckpoint:
+    """
+        Part files of the processed chunks of `source` next to `out_path` with a manifest of the completed chunks, to
+        resume a failed run from the first incomplete chunk. The part files are concatenated into `out_path` once all
+        chunks are done. `check` is called before a part is committed and before `out_path` is replaced, it raises
+        `OwnershipLost` if the output is not owned by this process anymore.
+    """
+
+    def __init__(self, source: Path, out_path: Path, check: typing.Callable[[], None] = None, **settings):
+        self.out_path = out_path
+        self.check = check
+        self.parts_dir = Path(str(out_path) + '.parts')
+        stat = os.stat(source)
+        # the parts are only reused for the same input file and settings
+        self.identity = dict(source=str(source), size=stat.st_size, mtime=stat.st_mtime_ns, **settings)
+        self.manifest = dict(identity=self.identity, chunk_size=None, columns=None, chunks=dict())
+        manifest_path = Path(self.parts_dir, 'manifest.json')
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['identity'] == self.identity:
+                self.manifest = manifest
+                logger.info('Resuming %s after %d completed chunks' % (out_path.name, len(manifest['chunks'])))
+            else:
+                logger.warning('Discarding the parts of %s of a different input' % out_path.name)
+                shutil.rmtree(self.parts_dir)
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def chunk_size(self) -> typing.Optional[int]:
+        """
+            Chunk size of the previous run, the chunks have to be read in the same way to be skipped.
+        """
+        return self.manifest['chunk_size']
+
+    @chunk_size.setter
+    def chunk_size(self, chunk_size: int) -> None:
+        self.manifest['chunk_size'] = chunk_size
+        self._save_manifest()
+
+    def is_done(self, index: int) -> bool:
+        return str(index) in self.manifest['chunks']
+
+    def _save_manifest(self) -> None:
+        tmp_path = Path(self.parts_dir, 'manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, Path(self.parts_dir, 'manifest.json'))
+
+    def commit(self, index: int, df: pd.DataFrame) -> None:
+        """
+            Write the processed chunk `index` atomically and record it as done.
+        """
+        if self.check is not None:
+            self.check()
+        if self.manifest['columns'] is None:
+            self.manifest['columns'] = list(df.columns)
+        part_name = 'part-%06d.csv' % index
+        tmp_path = Path(self.parts_dir, part_name + '.tmp')
+        df.to_csv(tmp_path, header=False, index=False)
+        os.replace(tmp_path, Path(self.parts_dir, part_name))
+        self.manifest['chunks'][str(index)] = dict(file=part_name, rows=len(df))
+        self._save_manifest()
+
+    def finish(self, metadata: dict = None) -> None:
+        """
+            Concatenate the part files in chunk order into `out_path` and remove them.
+        """
+        if self.check is not None:
+            self.check()
+        tmp_path = Path(str(self.out_path) + '.tmp')
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as out:
+            if self.manifest['columns'] is not None:
+                header = pd.DataFrame(columns=self.manifest['columns'])
+                out.write(csv_with_metadata(header, metadata, index=False) if metadata else
+                          header.to_csv(index=False))
+            for index in sorted(self.manifest['chunks'], key=int):
+                with open(Path(self.parts_dir, self.manifest['chunks'][index]['file']), encoding='utf-8') as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(tmp_path, self.out_path)
+        self.discard()
+
+    def discard(self) -> None:
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+
+class TeeReader:
+    """
+        File-like wrapper that copies everything read from `stream` into `sink`, e.g. to parse an upload
+        while spooling it to disk for a second pass.
+    """
+
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sink.write(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def readline(self, size=-1):
+        line = self.stream.readline(size)
+        self.sink.write(line)
+        return line
 
 
 def convert_datetime(dt64):
@@ -98,4 +236,72 @@ def convert_datetime(dt64):
     elif dt64.dtype == '<M8[ps]' or dt64.dtype == '<m8[ps]':
         return datetime.fromtimestamp(dt64.astype(int) * 1e-12, tz=timezone.utc)
     else:
-        raise Excpetion("... do not know how to convert numpy.datetime64 with dtype '{}' to datetime.datetime object".format(dt64.dtype))
\ No newline at end of file
+        raise Excpetion("... do not know how to convert numpy.datetime64 with dtype '{}' to datetime.datetime object".format(dt64.dtype))
+
+
+def parse_mem_size(value: str) -> int:
+    """
+        Parse a memory size like `512M`, `2G` or `1.5G` into bytes.
+    """
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    value = value.strip().upper().rstrip('B')
+    if len(value) > 0 and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_mem_budget(value: str) -> dict:
+    """
+        Parse a memory budget for all stages like `4G` or per stage like `subsample=2G,merge=512M`.
+    """
+    budget = dict()
+    for part in value.split(','):
+        if '=' in part:
+            stage, size = part.split('=')
+            if stage.strip() not in MEM_BUDGET_STAGES:
+                raise ValueError('Unknown stage %s. Expected one of %s' % (stage, MEM_BUDGET_STAGES))
+            budget[stage.strip()] = parse_mem_size(size)
+        else:
+            budget.update({stage: parse_mem_size(part) for stage in MEM_BUDGET_STAGES})
+    return budget
+
+
+def set_mem_budget(budget: dict) -> None:
+    MEM_BUDGET.clear()
+    MEM_BUDGET.update(budget)
+
+
+def bytes_per_row(df: pd.DataFrame) -> float:
+    return df.memory_usage(index=True, deep=True).sum() / max(len(df), 1)
+
+
+def get_chunk_size(stage: str, row_bytes: float) -> int:
+    """
+        Number of rows per chunk of `stage` with rows of `row_bytes` bytes to stay within the stage's memory budget.
+    """
+    if stage not in MEM_BUDGET:
+        return CHUNK_SIZE
+    chunk_size = int(MEM_BUDGET[stage] * ROWS_BUDGET_SHARE[stage] / max(row_bytes, 1))
+    return min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+def get_csv_chunk_size(file_path: Path, stage: str, extra_bytes_per_row: float = 0, **read_csv_kwargs) -> int:
+    """
+        Chunk size for reading the csv `file_path` in `stage` based on the measured size of its first rows.
+        `extra_bytes_per_row` accounts for columns added while processing.
+    """
+    if stage not in MEM_BUDGET:
+        return CHUNK_SIZE
+    sample = pd.read_csv(file_path, nrows=MIN_CHUNK_SIZE, **read_csv_kwargs)
+    chunk_size = get_chunk_size(stage, bytes_per_row(sample) + extra_bytes_per_row)
+    logger.debug('Chunk size for %s in stage %s: %d rows' % (file_path, stage, chunk_size))
+    return chunk_size
+
+
+def get_subset_budget(stage: str):
+    """
+        Bytes of a stage's memory budget left for retrieved subsets or `None` if no budget is set.
+    """
+    if stage not in MEM_BUDGET:
+        return None
+    return int(MEM_BUDGET[stage] * (1 - ROWS_BUDGET_SHARE[stage]))
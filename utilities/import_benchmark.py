@@ -0,0 +1,84 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# modules whose import time matters for the start of a container or of a pool worker
+MODULES = ['EnvironmentalData.weather', 'EnvDataServer.app', 'utilities.helper_functions']
+ROOT_DIR = Path(__file__).parent.parent
+
+
+def measure(module: str, runs: int = 5) -> list:
+    """
+        Wall time in seconds of a fresh interpreter importing `module`, once per run.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT_DIR), os.environ.get('PYTHONPATH')])))
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import %s' % module], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def slowest_imports(module: str, top: int = 10) -> list:
+    """
+        `(cumulative seconds, name)` of the packages taking the longest to import, from `-X importtime`.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT_DIR), os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], env=env, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # the time of a package is the longest cumulative time of any of its modules
+        name = name.strip().split('.')[0]
+        if name != module.split('.')[0]:
+            imports[name] = max(imports.get(name, 0), int(cumulative) / 1e6)
+    return sorted(((seconds, name) for name, seconds in imports.items()), reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the time of importing the modules in a fresh interpreter.')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='Modules to import, by default %s' % MODULES)
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Imports per module.')
+    parser.add_argument('-t', '--top', type=int, default=10, help='Number of the slowest imports listed per module.')
+    args = parser.parse_args()
+    for module in args.modules:
+        times = measure(module, args.runs)
+        print('%s: median %.3f s, min %.3f s, max %.3f s (%d runs)' % (
+            module, statistics.median(times), min(times), max(times), len(times)))
+        for seconds, name in slowest_imports(module, args.top):
+            print('    %.3f s %s' % (seconds, name))
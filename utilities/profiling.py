@@ -0,0 +1,118 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import cProfile
+import io
+import logging
+import pstats
+
+logger = logging.getLogger(__name__)
+
+# number of functions listed in the text report of a cProfile profile
+STATS_LINES = 60
+
+
+def start():
+    """
+        Start a sampling profiler of the current thread, pyinstrument if installed and cProfile otherwise.
+    """
+    try:
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    except ImportError:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stop(profiler, previous=None):
+    """
+        Stop `profiler` and return its result, combined with the `previous` result of the same profiler type.
+    """
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        if previous is None:
+            return pstats.Stats(profiler)
+        previous.add(profiler)
+        return previous
+    from pyinstrument.session import Session
+    session = profiler.stop()
+    return Session.combine(previous, session) if previous is not None else session
+
+
+def save(result, stem: Path) -> list:
+    """
+        Write the profile `result` as `<stem>.html` and a flamegraph `<stem>.speedscope.json` (open with
+        https://www.speedscope.app) for pyinstrument or as `<stem>.pstats` and `<stem>.txt` for cProfile.
+
+        :returns: paths of the written files
+    """
+    stem.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(result, pstats.Stats):
+        paths = [Path(str(stem) + '.pstats'), Path(str(stem) + '.txt')]
+        result.dump_stats(str(paths[0]))
+        text = io.StringIO()
+        result.stream = text
+        result.sort_stats('cumulative').print_stats(STATS_LINES)
+        paths[1].write_text(text.getvalue())
+    else:
+        from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+        paths = [Path(str(stem) + '.html'), Path(str(stem) + '.speedscope.json')]
+        paths[0].write_text(HTMLRenderer().render(result))
+        paths[1].write_text(SpeedscopeRenderer().render(result))
+    logger.info('Saved profile %s' % ', '.join(str(path) for path in paths))
+    return paths
+
+
+class StageProfiler:
+    """
+        Profiles of the stages of a run accumulated over all calls of a stage. A disabled profiler does nothing.
+    """
+
+    def __init__(self, out_dir: Path, prefix: str = 'profile', enabled: bool = True):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.enabled = enabled
+        self.results = dict()
+
+    def stage(self, name: str):
+        return self._profile(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _profile(self, name: str):
+        profiler = start()
+        try:
+            yield
+        finally:
+            self.results[name] = stop(profiler, self.results.get(name))
+
+    def save(self) -> None:
+        for name, result in self.results.items():
+            save(result, Path(self.out_dir, '%s_%s' % (self.prefix, name)))
+        self.results.clear()
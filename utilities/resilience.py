@@ -0,0 +1,264 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+import asyncio
+import http.client
+import logging
+import random
+import socket
+import threading
+import time
+import typing
+
+import requests.exceptions
+
+logger = logging.getLogger(__name__)
+
+# remote services by host name suffix
+ENDPOINT_HOSTS = {
+    'cmems-du.eu': 'cmems',
+    'cmems-cas.cls.fr': 'cmems',
+    'rda.ucar.edu': 'rda',
+    'thredds.ucar.edu': 'ucar',
+    'ncei.noaa.gov': 'ncei',
+    'coast.noaa.gov': 'noaa',
+}
+
+# retry and circuit breaker settings used for every endpoint unless configured otherwise, see `configure`
+DEFAULTS = dict(
+    # attempts per call including the first one
+    max_attempts=5,
+    # delays in seconds of the exponential backoff, the actual delay is drawn uniformly from [0, delay]
+    base_delay=2,
+    max_delay=120,
+    # consecutive transient failures that open the circuit
+    failure_threshold=5,
+    # seconds the circuit stays open before a trial call is let through
+    reset_timeout=300,
+    # retries allowed per successful call and the number of retries that can be saved up
+    retry_ratio=0.2,
+    max_retry_tokens=10,
+)
+
+# HTTP status codes worth retrying
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# errors of unavailable services, HTTP clients may register theirs
+TRANSIENT_EXCEPTIONS = [requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError, URLError, http.client.HTTPException, socket.timeout,
+                        ConnectionError, TimeoutError, asyncio.TimeoutError]
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, url: str, status: int):
+        self.url = url
+        self.status = status
+        super().__init__('HTTP status %d of request %s' % (status, url))
+
+
+class CircuitOpenException(Exception):
+    def __init__(self, endpoint: str, retry_after: float):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__('Endpoint %s is unavailable, retry in %d sec' % (endpoint, retry_after))
+
+
+def is_transient(e: Exception) -> bool:
+    """
+        Whether `e` is caused by an unavailable or overloaded service rather than by the request itself.
+    """
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in TRANSIENT_STATUS_CODES
+    if isinstance(e, HTTPError):
+        return e.code in TRANSIENT_STATUS_CODES
+    if isinstance(e, HTTPStatusError):
+        return e.status in TRANSIENT_STATUS_CODES
+    return isinstance(e, tuple(TRANSIENT_EXCEPTIONS))
+
+
+class Endpoint:
+    """
+        Retry policy and circuit breaker of a remote service shared by all its callers.
+    """
+
+    def __init__(self, name: str, max_attempts: int, base_delay: float, max_delay: float, failure_threshold: int,
+                 reset_timeout: float, retry_ratio: float, max_retry_tokens: float):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_ratio = retry_ratio
+        self.max_retry_tokens = max_retry_tokens
+        self.retry_tokens = max_retry_tokens
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0., self.opened_at + self.reset_timeout - time.time())
+
+    def acquire(self) -> None:
+        """
+            Raise `CircuitOpenException` unless the circuit is closed or a single trial call may test the service.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.retry_after() > 0 or self.trial:
+                raise CircuitOpenException(self.name, max(self.retry_after(), 1))
+            # half open
+            self.trial = True
+
+    def success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.warning('Endpoint %s is available again, closing the circuit' % self.name)
+            self.failures, self.opened_at, self.trial = 0, None, False
+            self.retry_tokens = min(self.max_retry_tokens, self.retry_tokens + self.retry_ratio)
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                logger.error('Endpoint %s failed %d times in a row, opening the circuit for %d sec' % (
+                    self.name, self.failures, self.reset_timeout))
+                self.opened_at, self.trial = time.time(), False
+
+    def may_retry(self) -> bool:
+        with self._lock:
+            if self.retry_tokens < 1:
+                return False
+            self.retry_tokens -= 1
+            return True
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def retry_delay(self, e: Exception, attempt: int) -> float:
+        """
+            Record the failed `attempt` and return the delay before the next one, re-raise `e` if it is not retried.
+        """
+        if not is_transient(e):
+            # the service answered, the request itself is the problem
+            self.success()
+            raise e
+        self.failure()
+        if attempt >= self.max_attempts or self.opened_at is not None or not self.may_retry():
+            raise e
+        delay = self.backoff(attempt)
+        logger.warning('Transient error of endpoint %s (%s), attempt %d of %d, retry in %.1f sec' % (
+            self.name, str(e), attempt, self.max_attempts, delay))
+        return delay
+
+    def call(self, func: typing.Callable, *args, **kwargs):
+        """
+            Call `func` and retry it with exponential backoff on transient errors.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            attempt += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                time.sleep(self.retry_delay(e, attempt))
+                continue
+            self.success()
+            return result
+
+    async def call_async(self, func: typing.Callable, *args, **kwargs):
+        """
+            Await the coroutine function `func` like `call`, without blocking the event loop while waiting.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            attempt += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self.retry_delay(e, attempt))
+                continue
+            self.success()
+            return result
+
+
+_endpoints = dict()
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoint(name: str) -> Endpoint:
+    with _endpoints_lock:
+        if name not in _endpoints:
+            _endpoints[name] = Endpoint(name, **DEFAULTS)
+        return _endpoints[name]
+
+
+def configure(name: str, **kwargs) -> None:
+    endpoint = get_endpoint(name)
+    for key, value in kwargs.items():
+        if key not in DEFAULTS:
+            raise ValueError('Unknown setting %s' % key)
+        setattr(endpoint, key, value)
+
+
+def endpoint_of(url: str) -> str:
+    host = urlparse(url).hostname or ''
+    return next((name for suffix, name in ENDPOINT_HOSTS.items() if host.endswith(suffix)), host)
+
+
+def call(endpoint: str, func: typing.Callable, *args, **kwargs):
+    return get_endpoint(endpoint).call(func, *args, **kwargs)
+
+
+def get_circuit_open(e: Exception) -> typing.Optional[CircuitOpenException]:
+    """
+        The `CircuitOpenException` that caused `e`, if any.
+    """
+    while e is not None:
+        if isinstance(e, CircuitOpenException):
+            return e
+        e = getattr(e, 'original_exception', None) or e.__cause__ or e.__context__
+    return None
+
+
+def jitter(delay: float) -> float:
+    """
+        Randomize `delay` to spread the retries of concurrent workers.
+    """
+    return random.uniform(delay / 2, delay)
+
+
+def wait_for_circuit(e: CircuitOpenException) -> None:
+    logger.warning('Pausing until endpoint %s may be available again in %d sec' % (e.endpoint, e.retry_after))
+    time.sleep(e.retry_after)
@@ -0,0 +1,144 @@
+#   Copyright (C) 2021 - 2023 52°North Spatial Information Research GmbH
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# If the program is linked with libraries which are licensed under one of
+# the following licenses, the combination of the program with the linked
+# library is not considered a "derivative work" of the program:
+#
+#     - Apache License, version 2.0
+#     - Apache Software License, version 1.0
+#     - GNU Lesser General Public License, version 3
+#     - Mozilla Public License, versions 1.0, 1.1 and 2.0
+#     - Common Development and Distribution License (CDDL), version 1.0
+#
+# Therefore the distribution of the program linked with libraries licensed
+# under the aforementioned licenses, is permitted by the copyright holders
+# if the distribution is compliant with both the GNU General Public
+# License version 2 and the aforementioned licenses.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from utilities import helper_functions
+from utilities.helper_functions import parse_mem_size, parse_mem_budget, get_chunk_size, get_csv_chunk_size, \
+    get_subset_budget, ChunkCheckpoint
+
+
+@pytest.fixture
+def budget(monkeypatch) -> dict:
+    budget = dict()
+    monkeypatch.setattr(helper_functions, 'MEM_BUDGET', budget)
+    return budget
+
+
+@pytest.mark.parametrize('value, expected', [('512', 512), ('2K', 2048), ('512M', 512 * 2 ** 20),
+                                             ('1.5g', int(1.5 * 2 ** 30)), ('2GB', 2 * 2 ** 30)])
+def test_parse_mem_size(value, expected):
+    assert parse_mem_size(value) == expected
+
+
+def test_parse_mem_budget():
+    assert parse_mem_budget('1G') == dict(download=2 ** 30, subsample=2 ** 30, merge=2 ** 30)
+    assert parse_mem_budget('1G,merge=512M') == dict(download=2 ** 30, subsample=2 ** 30, merge=2 ** 29)
+    assert parse_mem_budget('subsample=2M') == dict(subsample=2 * 2 ** 20)
+    with pytest.raises(ValueError):
+        parse_mem_budget('upload=1G')
+
+
+def test_chunk_size_without_budget(budget, tmp_path):
+    assert get_chunk_size('merge', 100) == helper_functions.CHUNK_SIZE
+    assert get_csv_chunk_size(Path(tmp_path, 'missing.csv'), 'merge') == helper_functions.CHUNK_SIZE
+    assert get_subset_budget('merge') is None
+
+
+def test_chunk_size_from_budget(budget):
+    budget['merge'] = 100 * 2 ** 20
+    assert get_chunk_size('merge', 100) == int(100 * 2 ** 20 * helper_functions.ROWS_BUDGET_SHARE['merge'] / 100)
+    assert get_subset_budget('merge') == int(100 * 2 ** 20 * (1 - helper_functions.ROWS_BUDGET_SHARE['merge']))
+    # the chunk size is bounded for tiny and huge budgets
+    assert get_chunk_size('merge', 10 ** 9) == helper_functions.MIN_CHUNK_SIZE
+    budget['merge'] = 2 ** 50
+    assert get_chunk_size('merge', 1) == helper_functions.MAX_CHUNK_SIZE
+
+
+def test_csv_chunk_size(budget, tmp_path):
+    path = Path(tmp_path, 'in.csv')
+    pd.DataFrame({'a': range(100), 'b': ['x' * 10] * 100}).to_csv(path, index=False)
+    budget['subsample'] = 2 ** 30
+    small = get_csv_chunk_size(path, 'subsample')
+    # columns added while processing reduce the chunk size
+    assert get_csv_chunk_size(path, 'subsample', extra_bytes_per_row=1000) < small
+
+
+@pytest.fixture
+def source(tmp_path) -> Path:
+    path = Path(tmp_path, 'in.csv')
+    pd.DataFrame({'a': range(6)}).to_csv(path, index=False)
+    return path
+
+
+def get_chunk(index: int) -> pd.DataFrame:
+    return pd.DataFrame({'a': [2 * index, 2 * index + 1], 'b': [0.5 * index] * 2})
+
+
+def test_finish(source, tmp_path):
+    out_path = Path(tmp_path, 'out.csv')
+    checkpoint = ChunkCheckpoint(source, out_path, variables=['b'])
+    # the chunks are concatenated in chunk order, not in the order they were committed
+    for index in [1, 0, 2]:
+        checkpoint.commit(index, get_chunk(index))
+    checkpoint.finish()
+    pd.testing.assert_frame_equal(pd.read_csv(out_path), pd.concat([get_chunk(i) for i in range(3)],
+                                                                   ignore_index=True))
+    assert not Path(str(out_path) + '.parts').exists()
+
+
+def test_resume(source, tmp_path):
+    out_path = Path(tmp_path, 'out.csv')
+    checkpoint = ChunkCheckpoint(source, out_path, variables=['b'])
+    checkpoint.chunk_size = 2
+    checkpoint.commit(0, get_chunk(0))
+    checkpoint.commit(1, get_chunk(1))
+    # a new run with the same input and settings skips the completed chunks
+    resumed = ChunkCheckpoint(source, out_path, variables=['b'])
+    assert resumed.chunk_size == 2
+    assert resumed.is_done(0) and resumed.is_done(1) and not resumed.is_done(2)
+    resumed.commit(2, get_chunk(2))
+    resumed.finish({'created': 'created'})
+    lines = out_path.read_text().splitlines()
+    assert lines[0] == 'created,'
+    assert lines[1] == 'a,b'
+    assert len(lines) == 2 + 6
+
+
+def test_discard_parts_of_other_settings(source, tmp_path):
+    out_path = Path(tmp_path, 'out.csv')
+    checkpoint = ChunkCheckpoint(source, out_path, variables=['b'])
+    checkpoint.commit(0, get_chunk(0))
+    assert not ChunkCheckpoint(source, out_path, variables=['b', 'c']).is_done(0)
+
+
+def test_discard_parts_of_changed_input(source, tmp_path):
+    out_path = Path(tmp_path, 'out.csv')
+    ChunkCheckpoint(source, out_path).commit(0, get_chunk(0))
+    pd.DataFrame({'a': range(8)}).to_csv(source, index=False)
+    assert not ChunkCheckpoint(source, out_path).is_done(0)
+
+
+def test_discard(source, tmp_path):
+    out_path = Path(tmp_path, 'out.csv')
+    checkpoint = ChunkCheckpoint(source, out_path)
+    checkpoint.commit(0, get_chunk(0))
+    checkpoint.discard()
+    assert not Path(str(out_path) + '.parts').exists()
+    assert not out_path.exists()